@@ -8,18 +8,22 @@ if sys.platform == 'win32':
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session, g
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 from datetime import datetime
 import json
 from database import StockDatabase
+from payload_cache import PayloadCache
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
 # ✅ openpyxl imports
-from openpyxl import Workbook, load_workbook
+from openpyxl import Workbook
 from openpyxl.styles import Font
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils.exceptions import InvalidFileException
+from excel_import import ExcelSheet, IMPORT_CHUNK_SIZE, save_upload, discard_upload, upload_path
 import atexit
 import threading
 import time
@@ -42,6 +46,23 @@ app.secret_key = os.environ.get('SECRET_KEY', 'fallback-secret-for-dev')
 # Session timeout (30 يوم)
 app.config['PERMANENT_SESSION_LIFETIME'] = 2592000  # 30 days in seconds
 
+# حجم صفحة المنتجات (keyset pagination) والحد الأقصى المسموح بيه في ?limit=
+PRODUCTS_PAGE_SIZE = 30
+PRODUCTS_MAX_PAGE_SIZE = 200
+
+# حجم صفحة الـ logs (keyset pagination على created_date, id)
+LOGS_PAGE_SIZE = 100
+LOGS_MAX_PAGE_SIZE = 500
+
+# ملفات الـ Excel المتصدّرة بتفضل في الذاكرة لحد الحجم ده وبعدها بتتنقل لملف مؤقت
+EXPORT_SPOOL_MAX_SIZE = int(os.environ.get('EXPORT_SPOOL_MAX_SIZE', 16 * 1024 * 1024))
+
+# Dashboard / stock trend payloads (TTL + stale-while-revalidate, refreshed after stock changes)
+dashboard_cache = PayloadCache()
+
+# مدد الـ stock trend اللي الـ dashboard بيطلبها (+ 'lifetime') - أي مدة تانية بترجع 30
+TREND_DURATIONS = (7, 30, 60, 90, 180, 360, 365)
+
 # Remove or comment out the old simple login_required
 # We'll create a better one
 
@@ -55,6 +76,13 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def current_user_permissions():
+    """Permissions of the logged-in user - loaded once per request and kept on flask.g"""
+    if 'user_permissions' not in g:
+        user_id = session.get('user_id')
+        g.user_permissions = frozenset(db.get_user_permissions(user_id)) if user_id else frozenset()
+    return g.user_permissions
+
 def page_permission_required(page_key):
     """Decorator to check if user has permission for a specific page"""
     def decorator(f):
@@ -71,7 +99,7 @@ def page_permission_required(page_key):
                 return f(*args, **kwargs)
             
             # Check database permission
-            if not db.user_has_permission(user_id, page_key):
+            if page_key not in current_user_permissions():
                 flash('You do not have permission to access this page!', 'error')
                 return redirect(url_for('dashboard'))
             
@@ -95,7 +123,7 @@ def action_permission_required(page_key):
                 return f(*args, **kwargs)
             
             # Check permission
-            if not db.user_has_permission(user_id, page_key):
+            if page_key not in current_user_permissions():
                 flash('You do not have permission to perform this action!', 'error')
                 # Return to referrer or dashboard
                 return redirect(request.referrer or url_for('dashboard'))
@@ -105,6 +133,17 @@ def action_permission_required(page_key):
     return decorator
 
 
+def refreshes_dashboard(f):
+    """Stock-changing POST routes: schedule a debounced refresh of the cached dashboard"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        response = f(*args, **kwargs)
+        if request.method == 'POST':
+            dashboard_cache.mark_stale()
+        return response
+    return decorated_function
+
+
 @app.context_processor
 def inject_user_data():
     """Inject user permissions and info into all templates"""
@@ -134,8 +173,7 @@ def inject_user_data():
             is_super_admin = True
         else:
             # Get real permissions from database for regular users
-            permissions_list = db.get_user_permissions(user_id)
-            user_permissions = {perm: True for perm in permissions_list}
+            user_permissions = {perm: True for perm in current_user_permissions()}
             is_super_admin = False
         
         return {
@@ -323,6 +361,7 @@ def restore_on_startup():
             if brand_count == 0:
                 print("⚠️ Database is empty. Attempting restore from Dropbox...")
                 success = backup_system.restore_from_backup()
+                db.catalog.invalidate()
                 if not success:
                     print("⚠️ No backup found. Adding default data...")
                     db.add_default_data()
@@ -331,6 +370,11 @@ def restore_on_startup():
             else:
                 print(f"✅ Database OK: {brand_count} products found")
             
+            # The archived logs only live in the archive segments - the local disk is wiped on deploy
+            if not db.log_archive.has_manifest() and backup_system.dbx:
+                if backup_system.restore_log_archive(db.log_archive.directory):
+                    db.log_archive.reload()
+            
             # Restore logs if empty
             if logs_count == 0 and backup_system.dbx:
                 print("⚠️ Logs table is empty. Attempting to restore from backup...")
@@ -372,6 +416,10 @@ def auto_backup():
         backup_system.create_backup()
 
 # === LOGS BACKUP SYSTEM ===
+def log_archive_upload():
+    """Uploader for the log archive segments - None without Dropbox (see StockDatabase.archive_old_logs)"""
+    return backup_system.upload_log_archive_file if backup_system.dbx else None
+
 def daily_logs_backup():
     """Backup logs to Dropbox every 24 hours"""
     while True:
@@ -401,6 +449,9 @@ def daily_logs_backup():
                         if os.path.exists(backup_filename):
                             os.remove(backup_filename)
             
+            # Move logs past the retention window to the monthly archive segments
+            db.archive_old_logs(upload=log_archive_upload())
+            
         except Exception as e:
             print(f"❌ Error in logs backup: {e}")
 
@@ -415,6 +466,12 @@ def daily_snapshots():
     import time
     from datetime import datetime
     
+    # Fill the days the thread was not running (restarts, downtime) from stock_logs
+    try:
+        db.backfill_snapshots()
+    except Exception as e:
+        print(f"❌ Error backfilling snapshots: {e}")
+    
     # Wait until midnight on first run
     now = datetime.now()
     seconds_until_midnight = ((24 - now.hour - 1) * 3600 + 
@@ -457,6 +514,10 @@ def backup_on_exit():
     time.sleep(3)
     backup_system.create_backup()
 
+# الـ logs اللي لسه في queue الـ log writer تتكتب قبل النسخة الاحتياطية
+# (atexit بيشغل آخر function اتسجلت الأول)
+atexit.register(db.close_log_writer)
+
 # routes الجديدة للنسخ الاحتياطية
 @app.route('/admin/backup')
 @page_permission_required('backup_system')
@@ -495,6 +556,8 @@ def backup_status():
 def restore_backup(backup_name):
     """استرجاع نسخة احتياطية محددة"""
     success = backup_system.restore_from_backup(backup_name)
+    # the restore wrote the catalog through its own StockDatabase
+    db.catalog.invalidate()
     if success:
         flash(f'تم استرجاع البيانات من {backup_name} بنجاح!', 'success')
     else:
@@ -632,7 +695,7 @@ def dashboard():
     
     # Check if user has ANY permissions
     if user_id != 0:
-        user_permissions = db.get_user_permissions(user_id)
+        user_permissions = current_user_permissions()
         if not user_permissions:
             flash('⚠️ You have no page access! Please contact admin.', 'warning')
             return render_template('no_access.html')
@@ -642,88 +705,69 @@ def dashboard():
     if user_id == 0:  # Super Admin
         is_admin = True
     elif user_id:
-        user_permissions = db.get_user_permissions(user_id)
-        if 'user_management' in user_permissions:
+        if 'user_management' in current_user_permissions():
             is_admin = True
     
-    # Get basic statistics
-    products = db.get_all_products_with_details()
-    total_products = len(products)
-    total_stock_qty = db.get_total_stock_quantity()
-    
-    # Initialize with default values
-    stock_value = 0
-    stock_value_trend = {'dates': [], 'values': []}
+    payload = dashboard_cache.get(('dashboard', is_admin), lambda: build_dashboard_payload(is_admin))
+    return render_template('dashboard.html', is_admin=is_admin, **payload)
+
+
+def build_dashboard_payload(is_admin):
+    """Compute every dashboard widget - cached per admin / non-admin in dashboard_cache"""
+    # Independent analytics queries run in parallel - each on its own pooled connection
+    queries = {
+        'total_products': db.get_total_products_count,
+        'total_stock_qty': db.get_total_stock_quantity,
+        'stock_qty_trend': lambda: db.get_stock_quantity_trend(days=30),
+        'most_updated': lambda: db.get_most_updated_products(limit=10, days=30),
+        'top_brands': lambda: db.get_top_brands(limit=5),
+        'top_products_stock': lambda: db.get_top_products_by_stock(limit=10),
+        'products_by_category': db.get_products_by_category,
+        'system_counts': db.get_active_system_counts,
+    }
     
     # Get stock value (only for admins)
     if is_admin:
-        try:
-            stock_value = db.get_total_stock_value()
-            stock_value_trend = db.get_stock_value_trend(days=30)
-            
-            # ✅ Ensure it's a dict with proper structure
-            if not isinstance(stock_value_trend, dict):
-                stock_value_trend = {'dates': [], 'values': []}
-            if 'dates' not in stock_value_trend:
-                stock_value_trend['dates'] = []
-            if 'values' not in stock_value_trend:
-                stock_value_trend['values'] = []
-        except Exception as e:
-            print(f"Error getting stock value data: {e}")
-            stock_value = 0
-            stock_value_trend = {'dates': [], 'values': []}
-    
-    # Get trends and analytics
-    try:
-        stock_qty_trend = db.get_stock_quantity_trend(days=30)
-        
-        # ✅ Ensure proper structure
-        if not isinstance(stock_qty_trend, dict):
-            stock_qty_trend = {'dates': [], 'quantities': []}
-        if 'dates' not in stock_qty_trend:
-            stock_qty_trend['dates'] = []
-        if 'quantities' not in stock_qty_trend:
-            stock_qty_trend['quantities'] = []
-            
-    except Exception as e:
-        print(f"Error getting stock quantity trend: {e}")
-        stock_qty_trend = {'dates': [], 'quantities': []}
-    
-    try:
-        most_updated = db.get_most_updated_products(limit=10, days=30)
-    except Exception as e:
-        print(f"Error getting most updated products: {e}")
-        most_updated = []
-    
-    try:
-        top_brands = db.get_top_brands(limit=5)
-    except Exception as e:
-        print(f"Error getting top brands: {e}")
-        top_brands = []
-
-    try:
-        top_products_stock = db.get_top_products_by_stock(limit=10)
-    except Exception as e:
-        print(f"Error getting top products by stock: {e}")
-        top_products_stock = []
-
-    
-    try:
-        products_by_category = db.get_products_by_category()
-    except Exception as e:
-        print(f"Error getting products by category: {e}")
-        products_by_category = []
-    
-    try:
-        system_counts = db.get_active_system_counts()
-    except Exception as e:
-        print(f"Error getting system counts: {e}")
-        system_counts = {
+        queries['stock_value'] = db.get_total_stock_value
+        queries['stock_value_trend'] = lambda: db.get_stock_value_trend(days=30)
+    
+    results = db.run_parallel(queries, defaults={
+        'total_products': 0,
+        'total_stock_qty': 0,
+        'stock_value': 0,
+        'most_updated': [],
+        'top_brands': [],
+        'top_products_stock': [],
+        'products_by_category': [],
+        'system_counts': {
             'brands': 0,
             'categories': 0,
             'types': 0,
             'colors': 0
         }
+    })
+    
+    total_products = results['total_products']
+    total_stock_qty = results['total_stock_qty']
+    stock_value = results.get('stock_value', 0)
+    most_updated = results['most_updated']
+    top_brands = results['top_brands']
+    top_products_stock = results['top_products_stock']
+    products_by_category = results['products_by_category']
+    system_counts = results['system_counts']
+    
+    # ✅ Ensure trends are dicts with proper structure
+    stock_value_trend = results.get('stock_value_trend')
+    if not isinstance(stock_value_trend, dict):
+        stock_value_trend = {'dates': [], 'values': []}
+    stock_value_trend.setdefault('dates', [])
+    stock_value_trend.setdefault('values', [])
+    
+    stock_qty_trend = results['stock_qty_trend']
+    if not isinstance(stock_qty_trend, dict):
+        stock_qty_trend = {'dates': [], 'quantities': []}
+    stock_qty_trend.setdefault('dates', [])
+    stock_qty_trend.setdefault('quantities', [])
     
     # Prepare data for template
     stats = {
@@ -732,16 +776,16 @@ def dashboard():
         'stock_value': stock_value
     }
     
-    return render_template('dashboard.html',
-                         stats=stats,
-                         is_admin=is_admin,
-                         stock_qty_trend=stock_qty_trend,
-                         stock_value_trend=stock_value_trend,
-                         most_updated=most_updated,
-                         top_brands=top_brands,
-                         top_products_stock=top_products_stock,  # ✅ أضف ده
-                         products_by_category=products_by_category,
-                         system_counts=system_counts)
+    return {
+        'stats': stats,
+        'stock_qty_trend': stock_qty_trend,
+        'stock_value_trend': stock_value_trend,
+        'most_updated': most_updated,
+        'top_brands': top_brands,
+        'top_products_stock': top_products_stock,
+        'products_by_category': products_by_category,
+        'system_counts': system_counts
+    }
 
 # API endpoint for dynamic chart loading
 @app.route('/api/stock-trend')
@@ -750,34 +794,52 @@ def get_stock_trend_api():
     """Get stock trend data for specified duration"""
     duration = request.args.get('duration', '30')
     
-    # Convert to int or keep as 'lifetime'
+    # Convert to int or keep as 'lifetime' - only the dashboard's durations, each one is a cache key
     if duration != 'lifetime':
         try:
             duration = int(duration)
         except:
             duration = 30
-    
-    qty_trend = db.get_stock_quantity_trend(days=duration)
+        if duration not in TREND_DURATIONS:
+            duration = 30
     
     # Get value trend if admin
-    value_trend = None
     user_id = session.get('user_id')
     is_admin = False
     
     if user_id == 0:  # Super Admin
         is_admin = True
     elif user_id:
-        user_permissions = db.get_user_permissions(user_id)
-        if 'user_management' in user_permissions:
+        if 'user_management' in current_user_permissions():
             is_admin = True
     
-    if is_admin:
-        value_trend = db.get_stock_value_trend(days=duration)
+    # Optional filter: ?brand=<name or id>, ?category=<code> or ?type=<name or id>
+    dimension = None
+    for param, scope, catalog_dimension in (('brand', 'brand', 'brands'),
+                                            ('category', 'category', None),
+                                            ('type', 'type', 'product_types')):
+        value = request.args.get(param, '').strip()
+        if not value:
+            continue
+        if catalog_dimension:
+            dimension_id = db.catalog.id_for(catalog_dimension, value)
+            if dimension_id is None and value.isdigit() and db.catalog.name_for(catalog_dimension, int(value)):
+                dimension_id = int(value)
+            value = dimension_id
+        elif value not in db.get_categories_for_filter():
+            value = None
+        if value is None:
+            return jsonify({'success': False, 'error': f'Unknown {param}'}), 400
+        dimension = (scope, str(value))
+        break
+    
+    def build_trend():
+        return {
+            'quantity': db.get_stock_quantity_trend(days=duration, dimension=dimension),
+            'value': db.get_stock_value_trend(days=duration, dimension=dimension) if is_admin else None
+        }
     
-    return jsonify({
-        'quantity': qty_trend,
-        'value': value_trend
-    })
+    return jsonify(dashboard_cache.get(('stock-trend', duration, dimension, is_admin), build_trend))
 
 @app.route('/manage_brands')
 @page_permission_required('manage_brands')
@@ -1166,15 +1228,23 @@ def add_products_multi():
 def products_new():
     """صفحة عرض المنتجات المحسنة مع المقاس والـ Tags والصور"""
     search_term = request.args.get('search', '')
-    products = db.get_products_with_color_images(search_term)
-    return render_template('products_new.html', products=products, search_term=search_term)
+    products, next_cursor = db.get_products_page(search_term, limit=PRODUCTS_PAGE_SIZE)
+    stats = db.get_products_stats(search_term)
+    return render_template('products_new.html', products=products, search_term=search_term,
+                           next_cursor=next_cursor, stats=stats)
 
 @app.route('/search_products')
 @login_required
 def search_products():
-    """البحث في المنتجات - AJAX مع المقاس والـ Tags"""
+    """البحث في المنتجات - AJAX مع المقاس والـ Tags (صفحات: ?cursor=&limit=)"""
     search_term = request.args.get('q', '')
-    products = db.get_products_with_color_images(search_term)
+    cursor = request.args.get('cursor', '')
+    try:
+        limit = min(max(int(request.args.get('limit', PRODUCTS_PAGE_SIZE)), 1), PRODUCTS_MAX_PAGE_SIZE)
+    except ValueError:
+        limit = PRODUCTS_PAGE_SIZE
+    
+    products, next_cursor = db.get_products_page(search_term, cursor, limit)
     
     results = []
     for product in products:
@@ -1184,7 +1254,7 @@ def search_products():
             colors_with_stock.append(f"{color['name']}: {color['stock']}")
         
         # تحضير بيانات Tags
-        tags_list = [tag[1] for tag in product[12]] if product[12] else []
+        tags_list = [{'name': tag[1], 'color': tag[3]} for tag in product[12]] if product[12] else []
         
         results.append({
             'id': product[0],
@@ -1203,7 +1273,11 @@ def search_products():
             'created': product[9][:10] if product[9] else 'N/A'
         })
     
-    return jsonify({'products': results})
+    response = {'products': results, 'next_cursor': next_cursor, 'has_more': next_cursor is not None}
+    if not cursor:
+        # الإحصائيات مع أول صفحة بس
+        response['stats'] = db.get_products_stats(search_term)
+    return jsonify(response)
 
 @app.route('/product_details/<int:product_id>')
 @page_permission_required('product_details')
@@ -1255,6 +1329,7 @@ def inventory_management():
 
 @app.route('/update_inventory', methods=['POST'])
 @action_permission_required('bulk_inventory')
+@refreshes_dashboard
 def update_inventory():
     """تحديث المخزون بكميات جديدة"""
     try:
@@ -1308,10 +1383,11 @@ def update_inventory():
         # استخدام الدالة الموجودة أصلاً
         result = db.bulk_update_inventory(stock_updates)
         
-        # Log successful updates
+        # Log successful updates (one batch)
+        log_entries = []
         for update in stock_updates:
             if not update.get('skip_log', False) and 'old_stock' in update:
-                db.add_stock_log(
+                log_entries.append(dict(
                     operation_type='Bulk Update',
                     product_id=update['product_id'],
                     variant_id=update['variant_id'],
@@ -1326,8 +1402,9 @@ def update_inventory():
                     notes='Bulk inventory update',
                     source_page='Inventory Management',
                     source_url=request.url
-                )
-                logged_count += 1
+                ))
+        db.add_stock_logs_bulk(log_entries)
+        logged_count += len(log_entries)
         
         # تحقق من AJAX request
         is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
@@ -1404,9 +1481,11 @@ def inventory_search():
 # صفحات Excel Bulk Upload مع النظام المحدث
 @app.route('/bulk_upload_excel', methods=['GET', 'POST'])
 @page_permission_required('bulk_upload')
+@refreshes_dashboard
 def bulk_upload_excel():
     """Excel Bulk Upload"""
     if request.method == 'POST':
+        file_hash = None
         try:
             # Check if file exists
             if 'excel_file' not in request.files:
@@ -1426,112 +1505,156 @@ def bulk_upload_excel():
             
             print(f"📁 Processing file: {file.filename}")
             
-            # ✅ Read Excel with openpyxl (instead of pandas)
-            
-            wb = load_workbook(file, data_only=True)
-            sheet = wb.active
-            
-            # Get headers from first row
-            headers = [cell.value for cell in sheet[1] if cell.value]
-            
-            print(f"📊 Found {len(headers)} columns")
-            
-            # Check required columns
-            required_columns = [
-                'Product Code', 'Brand Name', 'Product Type', 'Category',
-                'Wholesale Price', 'Retail Price', 'Color Name', 'Stock'
-            ]
-            
-            missing_columns = [col for col in required_columns if col not in headers]
-            
-            if missing_columns:
-                flash(f'الأعمدة المطلوبة مفقودة: {", ".join(missing_columns)}', 'error')
-                return redirect(url_for('bulk_upload_excel'))
-            
-            # Convert rows to list of dictionaries
-            excel_data = []
-            row_count = 0
-            
-            for row in sheet.iter_rows(min_row=2, values_only=True):
-                # Skip empty rows
-                if not any(row):
-                    continue
-                
-                row_dict = {}
-                for idx, header in enumerate(headers):
-                    if idx < len(row):
-                        value = row[idx]
-                        # Convert to string and handle None
-                        row_dict[header] = str(value).strip() if value is not None else ''
-                    else:
-                        row_dict[header] = ''
-                
-                excel_data.append(row_dict)
-                row_count += 1
-            
-            print(f"📝 Loaded {row_count} rows")
-            
-            # Limit rows to prevent timeout
-            MAX_ROWS = 2000
-            if len(excel_data) > MAX_ROWS:
-                flash(f'⚠️ تحذير! الملف يحتوي على {len(excel_data)} صف. سيتم تحميل أول {MAX_ROWS} صف فقط.', 'warning')
-                excel_data = excel_data[:MAX_ROWS]
-                flash(f'تم تقليل البيانات إلى {MAX_ROWS} صف.', 'info')
+            # الملف بيتحفظ بالـ sha256 - نفس الملف لو اترفع تاني بيكمل الـ run اللي ما خلصتش
+            path, file_hash = save_upload(file)
+            run = db.get_unfinished_import_run(file_hash)
             
-            # Process the data
-            result = db.bulk_add_products_from_excel_enhanced(excel_data)
-            
-            if result['success']:
-                # Backup after successful upload
-                print("📦 Creating backup after bulk upload...")
-                time.sleep(2)
-                backup_success = backup_system.create_backup()
-                if backup_success:
-                    print("✅ Backup created successfully!")
-                else:
-                    print("❌ Backup failed!")
+            # ✅ Read Excel with openpyxl in read-only mode - rows are streamed in chunks
+            with ExcelSheet(path) as sheet:
+                print(f"📊 Found {len(sheet.headers)} columns")
                 
-                # Success message
-                success_msg = f"✅ تم رفع {result['success_count']} منتج من أصل {len(excel_data)} بنجاح!"
-                flash(success_msg, 'success')
+                # Check required columns
+                missing_columns = sheet.missing_columns()
                 
-                # Show created items
-                if result['created_brands']:
-                    flash(f"تم إضافة الماركات: {', '.join(result['created_brands'])}", 'info')
+                if missing_columns:
+                    if not run:
+                        discard_upload(file_hash)
+                    flash(f'الأعمدة المطلوبة مفقودة: {", ".join(missing_columns)}', 'error')
+                    return redirect(url_for('bulk_upload_excel'))
                 
-                if result['created_colors']:
-                    flash(f"تم إضافة الألوان: {', '.join(result['created_colors'])}", 'info')
-                
-                if result['created_types']:
-                    flash(f"تم إضافة الأنواع: {', '.join(result['created_types'])}", 'info')
-                
-                # Show errors if any
-                if result['failed_count'] > 0:
-                    flash(f'⚠️ فشل رفع {result["failed_count"]} منتج. يرجى مراجعة الأخطاء أدناه.', 'warning')
-                
-                # Show first 5 errors
-                for failed in result['failed_products'][:5]:
-                    flash(f"❌ صف {failed['row']}: {failed['error']}", 'error')
-                
-                if len(result['failed_products']) > 5:
-                    flash(f"⚠️ و {len(result['failed_products']) - 5} أخطاء أخرى...", 'warning')
+                if run:
+                    print(f"🔁 Resuming import run {run['id']} after chunk {run['last_chunk']}")
+                else:
+                    run_id = db.create_import_run(file.filename, file_hash, IMPORT_CHUNK_SIZE,
+                                                  sheet.row_estimate, session.get('username'))
+                    run = db.get_import_run(run_id)
                 
-                return redirect(url_for('products_new'))
+                # Process the data
+                result = db.bulk_add_products_from_excel_enhanced(sheet.chunks(run['chunk_size']), run['id'])
             
-            else:
-                error_msg = result.get('error', 'حدث خطأ غير متوقع')
-                flash(f'❌ {error_msg}', 'error')
-                print(f"❌ Bulk upload error: {error_msg}")
+            return import_result_response(result, run)
         
         except InvalidFileException:
+            discard_failed_upload(file_hash)
             flash('❌ الملف تالف أو ليس ملف Excel صالح!', 'error')
         
         except Exception as e:
+            discard_failed_upload(file_hash)
             error_msg = str(e)
             flash(f'❌ خطأ: {error_msg}', 'error')
             print(f"❌ Exception in bulk upload: {error_msg}")
     
-    return render_template('bulk_upload_excel.html')
+    return render_template('bulk_upload_excel.html', import_runs=db.get_unfinished_import_runs())
+
+def discard_failed_upload(file_hash):
+    """الملف المحفوظ بيتمسح لو الرفع فشل ومفيش run مستنياه يكمل"""
+    if not file_hash:
+        return
+    try:
+        if not db.get_unfinished_import_run(file_hash):
+            discard_upload(file_hash)
+    except Exception as e:
+        print(f"❌ Could not discard upload {file_hash}: {e}")
+
+@app.route('/bulk_upload_excel/resume/<int:run_id>', methods=['POST'])
+@page_permission_required('bulk_upload')
+@refreshes_dashboard
+def resume_import_run(run_id):
+    """كمل import run وقفت في النص (الـ worker وقع / الـ request خلص وقته) من آخر checkpoint"""
+    run = db.get_import_run(run_id)
+    if not run or run['status'] != 'running':
+        flash('❌ عملية الرفع دي مش موجودة أو خلصت بالفعل', 'error')
+        return redirect(url_for('bulk_upload_excel'))
+    
+    path = upload_path(run['file_hash'])
+    if not os.path.exists(path):
+        flash('❌ ملف الرفع مش موجود - ارفع الملف تاني عشان يكمل من آخر نقطة', 'error')
+        return redirect(url_for('bulk_upload_excel'))
+    
+    try:
+        print(f"🔁 Resuming import run {run_id} after chunk {run['last_chunk']}")
+        with ExcelSheet(path) as sheet:
+            result = db.bulk_add_products_from_excel_enhanced(sheet.chunks(run['chunk_size']), run_id)
+        return import_result_response(result, run)
+    except Exception as e:
+        flash(f'❌ خطأ: {e}', 'error')
+        print(f"❌ Exception resuming import run {run_id}: {e}")
+        return redirect(url_for('bulk_upload_excel'))
+
+@app.route('/bulk_upload_excel/cancel/<int:run_id>', methods=['POST'])
+@page_permission_required('bulk_upload')
+def cancel_import_run(run_id):
+    """إلغاء import run ما خلصتش - الدفعات اللي اتحفظت بتفضل زي ما هي"""
+    run = db.get_import_run(run_id)
+    if run and db.cancel_import_run(run_id):
+        discard_upload(run['file_hash'])
+        flash(f"تم إلغاء رفع {run['file_name']}", 'info')
+    else:
+        flash('❌ عملية الرفع دي مش موجودة أو خلصت بالفعل', 'error')
+    return redirect(url_for('bulk_upload_excel'))
+
+def import_result_response(result, run):
+    """رسائل نتيجة الرفع والـ redirect - الملف المحفوظ بيتمسح لما الـ run تخلص"""
+    print(f"📝 Loaded {result['total_rows']} rows")
+    
+    if result['success']:
+        discard_upload(run['file_hash'])
+        
+        # Backup after successful upload
+        print("📦 Creating backup after bulk upload...")
+        time.sleep(2)
+        backup_success = backup_system.create_backup()
+        if backup_success:
+            print("✅ Backup created successfully!")
+        else:
+            print("❌ Backup failed!")
+        
+        # Success message
+        success_msg = f"✅ تم رفع {result['success_count']} منتج من أصل {result['total_rows']} بنجاح!"
+        flash(success_msg, 'success')
+        if result['resumed_rows']:
+            flash(f"🔁 تم استكمال الرفع بعد أول {result['resumed_rows']} صف (كانت محفوظة بالفعل)", 'info')
+        flash(f"⚡ {result['rows_per_second']} صف/ثانية ({result['elapsed']} ثانية)", 'info')
+        flash(f"📊 جديد: {result['inserted_count']} | اتحدث: {result['updated_count']} | "
+              f"من غير تغيير: {result['unchanged_count']}", 'info')
+        
+        # Show created items
+        if result['created_brands']:
+            flash(f"تم إضافة الماركات: {', '.join(result['created_brands'])}", 'info')
+        
+        if result['created_colors']:
+            flash(f"تم إضافة الألوان: {', '.join(result['created_colors'])}", 'info')
+        
+        if result['created_types']:
+            flash(f"تم إضافة الأنواع: {', '.join(result['created_types'])}", 'info')
+        
+        # Show errors if any
+        if result['failed_count'] > 0:
+            flash(f'⚠️ فشل رفع {result["failed_count"]} منتج. يرجى مراجعة الأخطاء أدناه.', 'warning')
+        
+        # Show first 5 errors
+        for failed in result['failed_products'][:5]:
+            flash(f"❌ صف {failed['row']}: {failed['error']}", 'error')
+        
+        if len(result['failed_products']) > 5:
+            flash(f"⚠️ و {len(result['failed_products']) - 5} أخطاء أخرى...", 'warning')
+        
+        return redirect(url_for('products_new'))
+    
+    error_msg = result.get('error', 'حدث خطأ غير متوقع')
+    flash(f'❌ {error_msg}', 'error')
+    flash('🔁 الدفعات اللي اتحفظت مش هتتكرر - ارفع نفس الملف أو اضغط استكمال عشان يكمل من آخر نقطة', 'info')
+    print(f"❌ Bulk upload error: {error_msg}")
+    return redirect(url_for('bulk_upload_excel'))
+
+def write_only_header(ws, headers):
+    """Bold header row for a write_only worksheet (its cells can't be styled after append)"""
+    header_cells = []
+    for header in headers:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = Font(bold=True)
+        header_cells.append(cell)
+    ws.append(header_cells)
 
 @app.route('/export_products', methods=['GET', 'POST'])
 @page_permission_required('export_products')
@@ -1547,114 +1670,48 @@ def export_products():
             selected_products = request.form.getlist('product_codes')
             stock_filter = request.form.get('stock_filter', 'all')
             
-            # جلب كل المنتجات
-            all_products = db.get_products_with_color_images('')
-            
-            # تطبيق الفلاتر
-            filtered_data = []
-            
-            for product in all_products:
-                product_id = product[0]
-                product_code = product[1]
-                brand_name = product[2]
-                product_type = product[3]
-                category = product[4]
-                size = product[5]
-                wholesale = product[6]
-                retail = product[7]
-                colors_data = product[10]  # قائمة الألوان مع التفاصيل
-                tags = product[12] if len(product) > 12 else []
-                
-                # تطبيق فلاتر Brand, Category, Type, Product Code
-                if selected_brands and brand_name not in selected_brands:
-                    continue
-                if selected_categories and category not in selected_categories:
-                    continue
-                if selected_types and product_type not in selected_types:
-                    continue
-                if selected_products and product_code not in selected_products:
-                    continue
-                
-                # معالجة كل لون كصف منفصل
-                for color_info in colors_data:
-                    color_name = color_info['name']
-                    color_stock = color_info['stock']
-                    image_url = color_info['image_url'] or ''
-                    
-                    # تطبيق فلتر اللون
-                    if selected_colors and color_name not in selected_colors:
-                        continue
-                    
-                    # تطبيق فلتر المخزون
-                    if stock_filter == 'in_stock' and color_stock <= 0:
-                        continue
-                    elif stock_filter == 'out_of_stock' and color_stock > 0:
-                        continue
-                    elif stock_filter == 'low_stock' and (color_stock > 5 or color_stock <= 0):
-                        continue
-                    
-                    # تجهيز Tags كنص (مفصول بفواصل)
-                    tags_text = ','.join([tag[1] for tag in tags]) if tags else ''
-                    
-                    # إضافة الصف
-                    filtered_data.append({
-                        'Product Code': product_code,
-                        'Brand Name': brand_name,
-                        'Product Type': product_type,
-                        'Category': category,
-                        'Size': size or '',
-                        'Wholesale Price': wholesale,
-                        'Retail Price': retail,
-                        'Color Name': color_name,
-                        'Stock': color_stock,
-                        'Image URL': image_url,
-                        'Tags': tags_text
-                    })
-            
-            if not filtered_data:
-                flash('No products match the selected filters!', 'warning')
-                return redirect(url_for('export_products'))
-            
-            # ✅ إنشاء Excel باستخدام openpyxl
-            
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Products"
-            
-            # ✅ كتابة الـ Headers
-            headers = ['Product Code', 'Brand Name', 'Product Type', 'Category', 'Size', 
-                      'Wholesale Price', 'Retail Price', 'Color Name', 'Stock', 'Image URL', 'Tags']
-            ws.append(headers)
+            # ✅ إنشاء Excel (write_only) - الصفوف جاية من الـ SQL بالفلاتر chunk chunk
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("Products")
             
-            # ✅ تنسيق الـ Headers (bold)
-            for cell in ws[1]:
-                cell.font = Font(bold=True)
+            # ✅ كتابة الـ Headers (bold)
+            write_only_header(ws, ['Product Code', 'Brand Name', 'Product Type', 'Category', 'Size', 
+                                   'Wholesale Price', 'Retail Price', 'Color Name', 'Stock', 'Image URL', 'Tags'])
             
             # ✅ كتابة البيانات
-            for row_data in filtered_data:
-                ws.append([
-                    row_data['Product Code'],
-                    row_data['Brand Name'],
-                    row_data['Product Type'],
-                    row_data['Category'],
-                    row_data['Size'],
-                    row_data['Wholesale Price'],
-                    row_data['Retail Price'],
-                    row_data['Color Name'],
-                    row_data['Stock'],
-                    row_data['Image URL'],
-                    row_data['Tags']
-                ])
+            exported_count = 0
+            for rows in db.iter_export_variants(selected_brands, selected_categories, selected_types,
+                                                selected_colors, selected_products, stock_filter):
+                for (product_code, brand_name, product_type, category, size, wholesale, retail,
+                     color_name, color_stock, image_url, tags_text) in rows:
+                    ws.append([
+                        product_code,
+                        brand_name,
+                        product_type,
+                        category,
+                        size or '',
+                        wholesale,
+                        retail,
+                        color_name,
+                        color_stock,
+                        image_url or '',
+                        tags_text
+                    ])
+                exported_count += len(rows)
+            
+            if not exported_count:
+                flash('No products match the selected filters!', 'warning')
+                return redirect(url_for('export_products'))
             
-            # ✅ حفظ في BytesIO
-            output = BytesIO()
+            # ✅ حفظ في ملف مؤقت (في الذاكرة لحد EXPORT_SPOOL_MAX_SIZE وبعدها على الـ disk)
+            output = SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE)
             wb.save(output)
             output.seek(0)
             
             # تحديد اسم الملف حسب الفلاتر
             filename = f'products_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
             
-            flash(f'Exported {len(filtered_data)} product variants successfully!', 'success')
+            flash(f'Exported {exported_count} product variants successfully!', 'success')
             
             return send_file(
                 output,
@@ -1674,8 +1731,7 @@ def export_products():
     colors = [c[1] for c in db.get_all_colors()]
     
     # جلب كل أكواد المنتجات
-    all_products = db.get_products_with_color_images('')
-    product_codes = sorted(list(set([p[1] for p in all_products])))
+    product_codes = db.get_product_codes()
     
     return render_template('export_products.html',
                          brands=brands,
@@ -1807,6 +1863,7 @@ def edit_product(product_id):
 
 @app.route('/update_stock/<int:variant_id>', methods=['POST'])
 @action_permission_required('product_details')
+@refreshes_dashboard
 def update_stock(variant_id):
     """تحديث مخزون لون معين"""
     try:
@@ -1938,25 +1995,37 @@ def upload_color_image(variant_id):
     
     return redirect(request.referrer)
 
+def logs_filters_from_request():
+    """/logs filter args (operation, date_from / date_to, search) as get_logs_page / iter_logs kwargs"""
+    operation_filter = request.args.get('operation', '')
+    date_from = request.args.get('date_from', request.args.get('datefrom', ''))
+    date_to = request.args.get('date_to', request.args.get('dateto', ''))
+    search_term = request.args.get('search', '')
+    return {
+        'operation_filter': operation_filter if operation_filter and operation_filter != 'All' else None,
+        'date_from': date_from if date_from else None,
+        'date_to': date_to if date_to else None,
+        'search_term': search_term if search_term else None,
+    }
+
 @app.route('/logs')
 @page_permission_required('activity_logs')
 def logs():
     """Stock Activity Logs"""
     # Get filters
     operation_filter = request.args.get('operation', '')
-    date_from = request.args.get('datefrom', '')
-    date_to = request.args.get('dateto', '')
+    date_from = request.args.get('date_from', request.args.get('datefrom', ''))
+    date_to = request.args.get('date_to', request.args.get('dateto', ''))
     search_term = request.args.get('search', '')
-    limit = int(request.args.get('limit', 100))
-    
-    # Get logs
-    logs = db.get_all_logs(
-        limit=limit,
-        operation_filter=operation_filter if operation_filter and operation_filter != 'All' else None,
-        date_from=date_from if date_from else None,
-        date_to=date_to if date_to else None,
-        search_term=search_term if search_term else None
-    )
+    filters = logs_filters_from_request()
+    cursor = request.args.get('cursor', '')
+    try:
+        limit = min(max(int(request.args.get('limit', LOGS_PAGE_SIZE)), 1), LOGS_MAX_PAGE_SIZE)
+    except ValueError:
+        limit = LOGS_PAGE_SIZE
+    
+    # Get logs (one page, newest first)
+    logs, next_cursor = db.get_logs_page(cursor=cursor, limit=limit, **filters)
     
     # Get statistics
     stats = db.get_logs_stats()
@@ -1982,67 +2051,64 @@ def logs():
                           operation_filter=operation_filter,
                           date_from=date_from,
                           date_to=date_to,
-                          search_term=search_term)
+                          search_term=search_term,
+                          cursor=cursor,
+                          next_cursor=next_cursor,
+                          limit=limit)
 
 @app.route('/export_logs')
 @action_permission_required('activity_logs')
 def export_logs():
-    """Export logs to Excel"""
+    """Export logs to Excel - same filters as /logs, every matching row, streamed in chunks"""
     try:
-                
-        # Get all logs
-        logs = db.get_all_logs(limit=10000)  # Get more for export
+        filters = logs_filters_from_request()
         
-        # ✅ إنشاء Workbook
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Activity Logs"
+        # ✅ write_only Workbook: الصفوف بتتكتب على الـ disk أول بأول مش في الذاكرة
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Activity Logs")
         
-        # ✅ كتابة الـ Headers
+        # ✅ كتابة الـ Headers (bold)
         headers = ['Date', 'Time', 'Product Code', 'Brand', 'Type', 'Color', 
                   'Old Stock', 'New Stock', 'Change', 'Operation', 'Source Page', 
                   'User', 'Image URL']
-        ws.append(headers)
-        
-        # ✅ تنسيق الـ Headers (bold)
-        for cell in ws[1]:
-            cell.font = Font(bold=True)
-        
-        # ✅ كتابة البيانات
-        for log in logs:
-            # Parse created_date
-            created_date = log[16] if log[16] else ''
-            if created_date:
-                try:
-                    dt = datetime.fromisoformat(str(created_date))
-                    date_str = dt.strftime('%Y-%m-%d')
-                    time_str = dt.strftime('%H:%M:%S')
-                except:
-                    date_str = str(created_date)[:10]
-                    time_str = str(created_date)[11:19]
-            else:
-                date_str = 'N/A'
-                time_str = 'N/A'
-            
-            # إضافة الصف
-            ws.append([
-                date_str,
-                time_str,
-                log[4] or 'N/A',                           # Product Code
-                log[5] or 'N/A',                           # Brand
-                log[6] or 'N/A',                           # Type
-                log[7] or 'N/A',                           # Color
-                log[9] if log[9] is not None else '-',    # Old Stock
-                log[10] if log[10] is not None else '-',  # New Stock
-                log[11] if log[11] is not None else '-',  # Change
-                log[1] or 'N/A',                           # Operation
-                log[14] or 'N/A',                          # Source Page
-                log[12] or 'Admin',                        # User
-                log[8] or ''                               # Image URL
-            ])
+        write_only_header(ws, headers)
+        
+        # ✅ كتابة البيانات chunk chunk
+        for logs in db.iter_logs(**filters):
+            for log in logs:
+                # Parse created_date
+                created_date = log[16] if log[16] else ''
+                if created_date:
+                    try:
+                        dt = datetime.fromisoformat(str(created_date))
+                        date_str = dt.strftime('%Y-%m-%d')
+                        time_str = dt.strftime('%H:%M:%S')
+                    except:
+                        date_str = str(created_date)[:10]
+                        time_str = str(created_date)[11:19]
+                else:
+                    date_str = 'N/A'
+                    time_str = 'N/A'
+                
+                # إضافة الصف
+                ws.append([
+                    date_str,
+                    time_str,
+                    log[4] or 'N/A',                           # Product Code
+                    log[5] or 'N/A',                           # Brand
+                    log[6] or 'N/A',                           # Type
+                    log[7] or 'N/A',                           # Color
+                    log[9] if log[9] is not None else '-',    # Old Stock
+                    log[10] if log[10] is not None else '-',  # New Stock
+                    log[11] if log[11] is not None else '-',  # Change
+                    log[1] or 'N/A',                           # Operation
+                    log[14] or 'N/A',                          # Source Page
+                    log[12] or 'Admin',                        # User
+                    log[8] or ''                               # Image URL
+                ])
         
-        # ✅ حفظ في BytesIO
-        output = BytesIO()
+        # ✅ حفظ في ملف مؤقت (في الذاكرة لحد EXPORT_SPOOL_MAX_SIZE وبعدها على الـ disk)
+        output = SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE)
         wb.save(output)
         output.seek(0)
         
@@ -2060,6 +2126,99 @@ def export_logs():
         return redirect(url_for('logs'))
 
 
+# === Point-in-time inventory (replayed from stock_logs) ===
+
+def current_user_is_admin():
+    """Stock values are only shown to the super admin and user managers"""
+    user_id = session.get('user_id')
+    return user_id == 0 or (bool(user_id) and 'user_management' in current_user_permissions())
+
+@app.route('/api/inventory-as-of')
+@action_permission_required('bulk_inventory')
+def inventory_as_of_api():
+    """Stock per variant / brand / total at the end of ?date=YYYY-MM-DD (&group=total|brand|variant)"""
+    as_of = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
+    group = request.args.get('group', 'brand')
+    
+    try:
+        inventory = db.get_inventory_as_of(as_of)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid date - use YYYY-MM-DD'}), 400
+    if inventory is None:
+        return jsonify({'success': False, 'error': 'Could not reconstruct inventory'}), 500
+    
+    show_value = current_user_is_admin()
+    result = {
+        'success': True,
+        'date': inventory['date'],
+        'total_stock': inventory['total_stock'],
+        'total_value': inventory['total_value'] if show_value else None
+    }
+    if group in ('brand', 'variant'):
+        result['brands'] = [
+            {'brand': name, 'stock': stock, 'value': value if show_value else None}
+            for name, stock, value in inventory['brands']
+        ]
+    if group == 'variant':
+        result['variants'] = [
+            {'variant_id': v[0], 'product_code': v[1], 'brand': v[2], 'type': v[3], 'color': v[4],
+             'stock': v[6], 'value': v[7] if show_value else None}
+            for v in inventory['variants']
+        ]
+    return jsonify(result)
+
+@app.route('/export_inventory_as_of')
+@action_permission_required('bulk_inventory')
+def export_inventory_as_of():
+    """Excel of the reconstructed inventory at ?date=YYYY-MM-DD"""
+    as_of = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
+    try:
+        inventory = db.get_inventory_as_of(as_of)
+    except ValueError:
+        flash('Invalid date - use YYYY-MM-DD', 'error')
+        return redirect(request.referrer or url_for('inventory_management'))
+    if inventory is None:
+        flash('Error reconstructing inventory', 'error')
+        return redirect(request.referrer or url_for('inventory_management'))
+    
+    show_value = current_user_is_admin()
+    wb = Workbook()
+    
+    ws = wb.active
+    ws.title = "Variants"
+    headers = ['Product Code', 'Brand', 'Type', 'Color', 'Stock']
+    if show_value:
+        headers += ['Wholesale Price', 'Value']
+    ws.append(headers)
+    for cell in ws[1]:
+        cell.font = Font(bold=True)
+    for variant in inventory['variants']:
+        row = [variant[1], variant[2] or 'N/A', variant[3] or 'N/A', variant[4] or 'N/A', variant[6]]
+        if show_value:
+            row += [variant[5], variant[7]]
+        ws.append(row)
+    
+    ws = wb.create_sheet("Brands")
+    ws.append(['Brand', 'Stock'] + (['Value'] if show_value else []))
+    for cell in ws[1]:
+        cell.font = Font(bold=True)
+    for name, stock, value in inventory['brands']:
+        ws.append([name or 'N/A', stock] + ([value] if show_value else []))
+    ws.append([])
+    ws.append(['Total', inventory['total_stock']] + ([inventory['total_value']] if show_value else []))
+    
+    output = BytesIO()
+    wb.save(output)
+    output.seek(0)
+    
+    return send_file(
+        output,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=f'inventory_as_of_{inventory["date"]}.xlsx'
+    )
+
+
 # ====================================================================
 # BARCODE SYSTEM ROUTES
 # ====================================================================
@@ -2260,6 +2419,7 @@ def generate_all_barcodes():
         success_count = 0
         failed_count = 0
         failed_variants = []
+        log_entries = []
         user_id = session.get('user_id', 0)
         
         for variant in variants:
@@ -2284,7 +2444,7 @@ def generate_all_barcodes():
                         success_count += 1
                         
                         # Log the operation
-                        db.add_stock_log(
+                        log_entries.append(dict(
                             operation_type='Barcode Generated',
                             product_id=None,
                             variant_id=variant_id,
@@ -2299,7 +2459,7 @@ def generate_all_barcodes():
                             notes=f'Bulk generation: {result["barcode"]}',
                             source_page='Barcode Management',
                             source_url=request.url
-                        )
+                        ))
                     else:
                         failed_count += 1
                         failed_variants.append(f"{product_code}-{color_name}")
@@ -2312,6 +2472,8 @@ def generate_all_barcodes():
                 failed_count += 1
                 failed_variants.append(f"{product_code}-{color_name}")
         
+        db.add_stock_logs_bulk(log_entries)
+        
         return jsonify({
             'success': True,
             'success_count': success_count,
@@ -2347,6 +2509,7 @@ def generate_selected_barcodes():
         success_count = 0
         failed_count = 0
         failed_items = []
+        log_entries = []
         user_id = session.get('user_id', 0)
         
         for variant_id in variant_ids:
@@ -2389,7 +2552,7 @@ def generate_selected_barcodes():
                     success_count += 1
                     
                     # Log the operation
-                    db.add_stock_log(
+                    log_entries.append(dict(
                         operation_type="Barcode Generated (Selected)",
                         product_id=None,
                         variant_id=variant_id,
@@ -2404,7 +2567,7 @@ def generate_selected_barcodes():
                         notes=f"Selected generation",
                         source_page="Barcode Management",
                         source_url=request.url
-                    )
+                    ))
                 else:
                     failed_count += 1
                     failed_items.append(f"{product_code} - {color_name}: Failed to save")
@@ -2414,6 +2577,8 @@ def generate_selected_barcodes():
                 failed_items.append(f"Variant {variant_id}: {str(e)}")
                 print(f"❌ Error generating barcode for variant {variant_id}: {e}")
         
+        db.add_stock_logs_bulk(log_entries)
+        
         return jsonify({
             'success': True,
             'success_count': success_count,
@@ -2826,6 +2991,7 @@ def clear_session():
 
 @app.route('/barcode/session/confirm', methods=['POST'])
 @action_permission_required('barcode_system')
+@refreshes_dashboard
 def confirm_session():
     """Confirm session and update stock"""
     try:
@@ -2917,11 +3083,11 @@ def confirm_session():
             conn.commit()
             conn.close()
             
-            # Step 3: Log successful updates (after commit)
-            logged_count = 0
+            # Step 3: Log successful updates (after commit, one batch)
+            log_entries = []
             for update in stock_updates:
                 if not update.get('skip_log', False) and 'old_stock' in update:
-                    db.add_stock_log(
+                    log_entries.append(dict(
                         operation_type=f'Barcode Scan - {session_mode.title()}',
                         product_id=update['product_id'],
                         variant_id=update['variant_id'],
@@ -2936,8 +3102,9 @@ def confirm_session():
                         notes=f"Stock {'increased' if session_mode == 'add' else 'decreased'} by {update['quantity']} units via barcode scanner",
                         source_page='Barcode Scanner',
                         source_url=request.url
-                    )
-                    logged_count += 1
+                    ))
+            db.add_stock_logs_bulk(log_entries)
+            logged_count = len(log_entries)
             
             # Close session
             db.close_session(session_id, 'confirmed')
@@ -3125,8 +3292,9 @@ def print_barcodes():
                 'error': 'Failed to generate PDF'
             }), 500
         
-        # Log each product separately with full details
+        # Log each product separately with full details (written as one batch)
         logged_count = 0
+        log_entries = []
         conn = db.get_connection()
         cursor = conn.cursor()
         
@@ -3151,7 +3319,7 @@ def print_barcodes():
                     result = cursor.fetchone()
                     
                     if result:
-                        db.add_stock_log(
+                        log_entries.append(dict(
                             operation_type='Barcode Labels Printed',
                             product_id=result[0],
                             variant_id=variant_id,
@@ -3166,7 +3334,7 @@ def print_barcodes():
                             notes=f'Printed {quantity} barcode label{"s" if quantity > 1 else ""}',
                             source_page='Barcode Printing',
                             source_url=request.url
-                        )
+                        ))
                         logged_count += 1
                 
                 except Exception as e:
@@ -3174,6 +3342,7 @@ def print_barcodes():
                     continue
             
             conn.close()
+            db.add_stock_logs_bulk(log_entries)
             print(f"Logged {logged_count} barcode print operations")
             
         except Exception as e:
@@ -3276,6 +3445,41 @@ def cleanup_sessions():
     return redirect(url_for('barcode_scanner'))
 
 
+@app.route('/admin/rebuild_inventory_summary', methods=['POST'])
+@action_permission_required('backup_system')
+def rebuild_inventory_summary():
+    """Recompute the dashboard summary tables (repair)"""
+    if db.rebuild_inventory_summary():
+        flash('Inventory summary rebuilt', 'success')
+    else:
+        flash('Error rebuilding inventory summary', 'error')
+    return redirect(request.referrer or url_for('dashboard'))
+
+
+@app.route('/admin/rebuild_log_stats', methods=['POST'])
+@action_permission_required('backup_system')
+def rebuild_log_stats():
+    """Recompute the /logs header counters from stock_logs (repair)"""
+    if db.rebuild_log_stats():
+        flash('Log stats rebuilt', 'success')
+    else:
+        flash('Error rebuilding log stats', 'error')
+    return redirect(request.referrer or url_for('logs'))
+
+
+@app.route('/admin/archive_logs', methods=['POST'])
+@action_permission_required('backup_system')
+def archive_logs():
+    """Move logs older than LOG_ARCHIVE_DAYS to the monthly archive segments now"""
+    if not db.log_archive.persistent and not backup_system.dbx:
+        flash('Log archiving needs LOG_ARCHIVE_DIR on a persistent disk or a Dropbox connection', 'error')
+        return redirect(request.referrer or url_for('logs'))
+    archived_files = db.archive_old_logs(upload=log_archive_upload())
+    segments = [name for name in archived_files if not name.endswith('manifest.json')]
+    flash(f'Archived logs into {len(segments)} segment(s)', 'success')
+    return redirect(request.referrer or url_for('logs'))
+
+
 # ========================================
 # BARCODE IMAGE REGENERATION
 # ========================================
@@ -3363,6 +3567,7 @@ def regenerate_bulk_barcode_images():
         success_count = 0
         failed_count = 0
         failed_items = []
+        log_entries = []
         
         for variant_id in variant_ids:
             try:
@@ -3386,7 +3591,7 @@ def regenerate_bulk_barcode_images():
                     success_count += 1
                     
                     # Log
-                    db.add_stock_log(
+                    log_entries.append(dict(
                         operation_type="Barcode Image Regenerated (Bulk)",
                         product_id=None,
                         variant_id=variant_id,
@@ -3401,7 +3606,7 @@ def regenerate_bulk_barcode_images():
                         notes=f"Bulk regeneration",
                         source_page="Barcode Management",
                         source_url=request.url
-                    )
+                    ))
                 else:
                     failed_count += 1
                     failed_items.append(f"{product_code} - {color_name}")
@@ -3410,6 +3615,8 @@ def regenerate_bulk_barcode_images():
                 failed_count += 1
                 failed_items.append(f"Variant {variant_id}: {str(e)}")
         
+        db.add_stock_logs_bulk(log_entries)
+        
         return jsonify({
             'success': True,
             'success_count': success_count,
@@ -3435,9 +3642,29 @@ def internal_error(error):
     return render_template('500.html'), 500
 
 # إضافة health check endpoint
+def health_status():
+    db_ok = db.check_pool_health()
+    # stock logs the writer could not save are waiting in STOCK_LOG_FAILED_FILE
+    logs_ok = not db.log_writer or not db.log_writer.stats()['failed']
+    return 'healthy' if db_ok and logs_ok else 'degraded'
+
 @app.route('/health')
 def health_check():
-    return {'status': 'healthy', 'timestamp': datetime.now().isoformat()}
+    return {'status': health_status(), 'timestamp': datetime.now().isoformat()}
+
+@app.route('/admin/health')
+@action_permission_required('backup_system')
+def health_details():
+    """Pool, cache, log writer and archive internals - admins only, /health stays public"""
+    return jsonify({
+        'status': health_status(),
+        'timestamp': datetime.now().isoformat(),
+        'db_pool': db.get_pool_stats(),
+        'catalog_cache': db.catalog.stats(),
+        'dashboard_cache': dashboard_cache.stats(),
+        'stock_log_writer': db.log_writer.stats() if db.log_writer else None,
+        'log_archive': db.log_archive.stats()
+    })
 
 
 
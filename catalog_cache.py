@@ -0,0 +1,113 @@
+"""
+Catalog Cache Module
+In-process cache of the catalog dimensions (brands, colors, types, categories, tags)
+
+These tables change rarely but are read on almost every product / barcode
+page. Each dimension is loaded once and kept together with name -> id and
+id -> name maps. Every add_/update_/delete_ bumps a monotonically increasing
+catalog version; entries loaded under an older version are reloaded on the
+next read. A TTL bounds staleness for writes made by other worker processes.
+
+Writes made elsewhere (another worker, a backup restore through its own
+StockDatabase) can also add names the cached entry does not know yet, so a
+name or id lookup that misses reloads the dimension once before answering -
+at most once every CATALOG_MISS_RELOAD_SECONDS per dimension, so unknown
+names in requests cannot turn every lookup into a query.
+"""
+
+import os
+import threading
+import time
+
+
+CATALOG_CACHE_TTL = int(os.environ.get('CATALOG_CACHE_TTL', 300))
+CATALOG_MISS_RELOAD_SECONDS = float(os.environ.get('CATALOG_MISS_RELOAD_SECONDS', 1))
+
+
+class CatalogEntry:
+    """Rows of one dimension plus its lookup maps"""
+
+    def __init__(self, rows, name_column, version):
+        self.rows = tuple(rows)
+        self.by_name = {row[name_column]: row[0] for row in self.rows}
+        self.by_id = {row[0]: row[name_column] for row in self.rows}
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+
+class CatalogCache:
+    """
+    Memoized dimension tables keyed by name ('brands', 'colors', ...)
+
+    loaders maps each dimension to (load(), name_column): load() returns the
+    rows exactly as get_all_*() used to, name_column is the row index of the
+    display name used for the name/id maps.
+    """
+
+    def __init__(self, loaders, ttl=CATALOG_CACHE_TTL, miss_reload=CATALOG_MISS_RELOAD_SECONDS):
+        self._loaders = loaders
+        self.ttl = ttl
+        self.miss_reload = miss_reload
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._version = 0
+        self._hits = 0
+        self._misses = 0
+        self._miss_reloads = 0
+
+    @property
+    def version(self):
+        return self._version
+
+    def entry(self, dimension, reload=False):
+        """Current CatalogEntry of a dimension - reloaded when stale (or reload=True)"""
+        entry = self._entries.get(dimension)
+        if not reload and entry is not None and entry.version == self._version \
+                and time.monotonic() - entry.loaded_at < self.ttl:
+            self._hits += 1
+            return entry
+
+        # read the version before loading: a write during the load leaves
+        # the entry stale instead of caching old rows under the new version
+        version = self._version
+        load, name_column = self._loaders[dimension]
+        entry = CatalogEntry(load(), name_column, version)
+        with self._lock:
+            self._misses += 1
+            if version == self._version:
+                self._entries[dimension] = entry
+        return entry
+
+    def rows(self, dimension):
+        return list(self.entry(dimension).rows)
+
+    def _lookup(self, dimension, mapping, key):
+        entry = self.entry(dimension)
+        value = getattr(entry, mapping).get(key)
+        if value is None and time.monotonic() - entry.loaded_at >= self.miss_reload:
+            # maybe added by another process since the entry was loaded
+            self._miss_reloads += 1
+            value = getattr(self.entry(dimension, reload=True), mapping).get(key)
+        return value
+
+    def id_for(self, dimension, name):
+        return self._lookup(dimension, 'by_name', name)
+
+    def name_for(self, dimension, dimension_id):
+        return self._lookup(dimension, 'by_id', dimension_id)
+
+    def invalidate(self):
+        """Bump the catalog version - called after every dimension write"""
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'version': self._version,
+            'cached': sorted(self._entries),
+            'hits': self._hits,
+            'misses': self._misses,
+            'miss_reloads': self._miss_reloads,
+            'ttl': self.ttl,
+        }
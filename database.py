@@ -1,22 +1,144 @@
 import sqlite3
 import os
 from urllib.parse import urlparse
-from datetime import datetime
+from datetime import datetime, timedelta
 import requests
 import re
 import json
+import base64
+import time
+import itertools
+import math
+import uuid
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from db_pool import SQLiteConnectionPool, PostgresConnectionPool
+from sql_dialect import get_dialect
+from db_migrations import apply_migrations
+from catalog_cache import CatalogCache
+import inventory_summary
+import log_stats
+from stock_history import StockHistory, inventory_as_of, daily_totals, end_of_day
+import snapshot_trends
+from snapshot_trends import TREND_MAX_POINTS
+from log_writer import StockLogWriter, STOCK_LOG_ASYNC
+import log_archive
+from log_archive import LogArchive, LOG_ARCHIVE_DAYS, archive_cutoff, month_range
+import excel_import
+from excel_import import ImportRunConflict
 try:
     import psycopg  # psycopg3
-    from psycopg.rows import dict_row
     PSYCOPG_VERSION = 3
 except ImportError:
     try:
         import psycopg2  # psycopg2
-        from psycopg2.extras import RealDictCursor
         PSYCOPG_VERSION = 2
     except ImportError:
         PSYCOPG_VERSION = None
 
+# أقصى عدد IDs في استعلام IN واحد (SQLite قبل 3.32 بيسمح بـ 999 parameter بس)
+IN_BATCH_SIZE = 30000 if sqlite3.sqlite_version_info >= (3, 32, 0) else 900
+
+# استعلامات القراءة المتوازية (الداشبورد): عدد الـ threads وأقصى وقت لكل استعلام
+QUERY_WORKERS = int(os.environ.get('DB_QUERY_WORKERS', 4))
+QUERY_TIMEOUT = float(os.environ.get('DB_QUERY_TIMEOUT', 10))
+
+# صلاحيات كل مستخدم بتتخزن في الذاكرة - الـ TTL بيحدد أقصى تأخير لتعديل من worker تاني
+PERMISSION_CACHE_TTL = int(os.environ.get('PERMISSION_CACHE_TTL', 60))
+
+STOCK_LOG_INSERT = '''
+    INSERT INTO stock_logs
+    (operation_type, product_id, variant_id, product_code, brand_name,
+    product_type, color_name, image_url, old_value, new_value,
+    change_amount, username, notes, source_page, source_url)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# أقصى عدد أيام بيرجعلها الـ backfill بتاع stock_snapshots عند التشغيل
+SNAPSHOT_BACKFILL_DAYS = int(os.environ.get('SNAPSHOT_BACKFILL_DAYS', 365))
+
+# عدد الصفوف اللي بتتقري مرة واحدة في الـ exports اللي بتعمل streaming
+LOG_EXPORT_CHUNK_SIZE = int(os.environ.get('LOG_EXPORT_CHUNK_SIZE', 2000))
+PRODUCT_EXPORT_CHUNK_SIZE = int(os.environ.get('PRODUCT_EXPORT_CHUNK_SIZE', 500))  # منتجات
+
+# كود اللون الافتراضي للألوان الجديدة اللي بتتضاف من رفع الـ Excel
+IMPORT_COLOR_CODES = {
+    'black': '#000000', 'white': '#FFFFFF', 'red': '#FF0000',
+    'blue': '#0000FF', 'green': '#008000', 'yellow': '#FFFF00',
+    'brown': '#8B4513', 'pink': '#FFC0CB', 'purple': '#800080',
+    'orange': '#FFA500', 'gray': '#808080', 'grey': '#808080',
+    'gold': '#FFD700', 'silver': '#C0C0C0', 'navy': '#000080',
+    'beige': '#F5F5DC', 'maroon': '#800000'
+}
+
+# أكبر قيم بتتقبل من الـ Excel: current_stock INTEGER و الأسعار DECIMAL(10,2)
+IMPORT_MAX_STOCK = 2 ** 31 - 1
+IMPORT_MAX_PRICE = 10 ** 8
+
+
+# مستند البحث لكل منتج: الكود والبراند والنوع والفئة والمقاس والألوان والـ Tags
+SEARCH_DOCUMENT_SQL = '''
+    SELECT bp.id,
+           COALESCE(bp.product_code, '') || ' ' || COALESCE(b.brand_name, '') || ' ' ||
+           COALESCE(pt.type_name, '') || ' ' || COALESCE(bp.trader_category, '') || ' ' ||
+           COALESCE(bp.product_size, '') || ' ' ||
+           COALESCE((SELECT GROUP_CONCAT(dc.color_name, ' ') FROM product_variants dpv
+                     JOIN colors dc ON dpv.color_id = dc.id
+                     WHERE dpv.base_product_id = bp.id), '') || ' ' ||
+           COALESCE((SELECT GROUP_CONCAT(dt.tag_name, ' ') FROM product_tags dptg
+                     JOIN tags dt ON dptg.tag_id = dt.id
+                     WHERE dptg.product_id = bp.id), '') AS document
+    FROM base_products bp
+    LEFT JOIN brands b ON bp.brand_id = b.id
+    LEFT JOIN product_types pt ON bp.product_type_id = pt.id
+'''
+
+# (trigger name, event, table, SELECT of the product ids whose document changes)
+SEARCH_INDEX_TRIGGERS = [
+    ('trg_search_products_ins', 'INSERT', 'base_products', 'SELECT NEW.id'),
+    ('trg_search_products_upd',
+     'UPDATE OF product_code, brand_id, product_type_id, trader_category, product_size',
+     'base_products', 'SELECT NEW.id'),
+    ('trg_search_products_del', 'DELETE', 'base_products', 'SELECT OLD.id'),
+    ('trg_search_variants_ins', 'INSERT', 'product_variants', 'SELECT NEW.base_product_id'),
+    ('trg_search_variants_upd', 'UPDATE OF color_id, base_product_id', 'product_variants',
+     'SELECT OLD.base_product_id UNION SELECT NEW.base_product_id'),
+    ('trg_search_variants_del', 'DELETE', 'product_variants', 'SELECT OLD.base_product_id'),
+    ('trg_search_tags_link_ins', 'INSERT', 'product_tags', 'SELECT NEW.product_id'),
+    ('trg_search_tags_link_del', 'DELETE', 'product_tags', 'SELECT OLD.product_id'),
+    ('trg_search_brands_upd', 'UPDATE OF brand_name', 'brands',
+     'SELECT id FROM base_products WHERE brand_id = NEW.id'),
+    ('trg_search_types_upd', 'UPDATE OF type_name', 'product_types',
+     'SELECT id FROM base_products WHERE product_type_id = NEW.id'),
+    ('trg_search_colors_upd', 'UPDATE OF color_name', 'colors',
+     'SELECT base_product_id FROM product_variants WHERE color_id = NEW.id'),
+    ('trg_search_tags_upd', 'UPDATE OF tag_name', 'tags',
+     'SELECT product_id FROM product_tags WHERE tag_id = NEW.id'),
+]
+
+
+def encode_cursor(*values):
+    """Opaque keyset cursor (مثلاً created_date, id) للـ pagination"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, size=2):
+    """فك الـ cursor - None لو فاضي أو مش صالح (يبدأ من أول صفحة)"""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+
+def _is_code_search(search_term):
+    """بحث بكود منتج (فيه رقم) - بيتطابق كـ substring في أي مكان في الكود مش أول الكلمة بس"""
+    return any(char.isdigit() for char in search_term)
+
 
 class StockDatabase:
 
@@ -28,17 +150,86 @@ class StockDatabase:
             self.db_type = 'sqlite'
             self.db_name = db_name
         
+        self.dialect = get_dialect(self.db_type)
+        self._permission_cache = {}
+        self._permission_generation = 0
+        self.log_archive = LogArchive()
+        self.stock_history = StockHistory(self.log_archive)
+        self.catalog = CatalogCache({
+            'brands': (lambda: self._fetch_dimension('SELECT * FROM brands ORDER BY brand_name'), 1),
+            'colors': (lambda: self._fetch_dimension('SELECT * FROM colors ORDER BY color_name'), 1),
+            'product_types': (lambda: self._fetch_dimension('SELECT * FROM product_types ORDER BY type_name'), 1),
+            'trader_categories': (lambda: self._fetch_dimension('SELECT * FROM trader_categories ORDER BY category_code'), 1),
+            'tags': (lambda: self._fetch_dimension('SELECT * FROM tags ORDER BY tag_category, tag_name'), 1),
+        })
+        self.setup_pool()
+        self.log_writer = StockLogWriter(self._insert_stock_logs) if STOCK_LOG_ASYNC else None
         self.init_database()
+        self.search_backend = self._detect_search_backend()
     
-    def get_connection(self):
-        """الحصول على اتصال قاعدة البيانات"""
+    def setup_pool(self):
+        """إعداد الـ connection pool (SQLite thread-local / PostgreSQL bounded)"""
         if self.db_type == 'postgresql':
-            if PSYCOPG_VERSION == 3:
-                return psycopg.connect(**self.pg_config, row_factory=dict_row)
-            else:
-                return psycopg2.connect(**self.pg_config, cursor_factory=RealDictCursor)
+            self.pool = PostgresConnectionPool(
+                self._connect_postgresql,
+                min_size=int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+                max_size=int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+                checkout_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+                dialect=self.dialect
+            )
+        else:
+            self.pool = SQLiteConnectionPool(self.db_name, timeout=30.0)
+        
+        # كل استعلام متوازي بياخد connection - سيب connection واحد على الأقل للـ request نفسه
+        workers = QUERY_WORKERS
+        if self.db_type == 'postgresql':
+            workers = max(1, min(workers, self.pool.max_size - 1))
+        self.query_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db-query')
+    
+    def _connect_postgresql(self):
+        """فتح اتصال PostgreSQL جديد (يستخدمه الـ pool فقط)
+        الصفوف tuples زي sqlite3 - الكود كله بيقرأ row[0], row[1], ..."""
+        if PSYCOPG_VERSION == 3:
+            return psycopg.connect(**self.pg_config)
         else:
-            return sqlite3.connect(self.db_name, timeout=30.0)
+            return psycopg2.connect(**self.pg_config)
+    
+    def get_connection(self):
+        """الحصول على اتصال قاعدة البيانات من الـ pool - conn.close() يرجعه للـ pool"""
+        return self.pool.connection()
+    
+    def get_pool_stats(self):
+        """إحصائيات الـ connection pool"""
+        return self.pool.stats()
+    
+    def check_pool_health(self):
+        """فحص صحة اتصالات الـ pool"""
+        return self.pool.health_check()
+    
+    def run_parallel(self, queries, defaults=None, timeout=QUERY_TIMEOUT):
+        """
+        تشغيل استعلامات قراءة مستقلة بالتوازي على الـ query_executor
+        
+        queries: {name: callable بدون arguments} - كل واحد بياخد connection خاص بيه من الـ pool
+        الاستعلام اللي يفشل أو يعدّي الـ timeout بيرجع defaults[name] (أو None) من غير ما يوقف الباقي
+        """
+        defaults = defaults or {}
+        futures = {name: self.query_executor.submit(query) for name, query in queries.items()}
+        deadline = time.monotonic() + timeout
+        
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                # الـ thread بيكمل لوحده ويرجع الـ connection للـ pool لما يخلص
+                future.cancel()
+                print(f"⚠️ Query '{name}' timed out after {timeout}s")
+                results[name] = defaults.get(name)
+            except Exception as e:
+                print(f"❌ Query '{name}' failed: {e}")
+                results[name] = defaults.get(name)
+        return results
    
    
     def setup_postgresql(self):
@@ -52,7 +243,7 @@ class StockDatabase:
         self.pg_config = {
             'host': parsed.hostname,
             'port': parsed.port or 5432,
-            'database': parsed.path[1:],
+            'dbname': parsed.path[1:],
             'user': parsed.username,
             'password': parsed.password,
         }
@@ -80,10 +271,23 @@ class StockDatabase:
             print("✅ Default data added to PostgreSQL")
 
     def init_database(self):
-        """إنشاء الجداول - متوافق مع SQLite و PostgreSQL"""
+        """إنشاء / ترقية الجداول عن طريق الـ migrations - متوافق مع SQLite و PostgreSQL"""
+        version = apply_migrations(self)
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # Initialize default pages
+        self._initialize_default_pages(cursor)
+        
+        conn.commit()
+        conn.close()
+
+        print("✅ Users system initialized!")
+        print(f"✅ Database initialized using {self.db_type} (schema version {version})")
+    
+    def create_base_tables(self, cursor):
+        """Migration 1: الجداول الأساسية - IF NOT EXISTS فآمنة على قواعد البيانات القديمة"""
         # تحديد نوع البيانات حسب قاعدة البيانات
         if self.db_type == 'postgresql':
             id_type = 'SERIAL PRIMARY KEY'
@@ -395,17 +599,11 @@ class StockDatabase:
         
         print("✅ Stock snapshots table created!")
 
-
-
-        # Initialize default pages
-        self._initialize_default_pages(cursor)
-        
-
-        conn.commit()
-        conn.close()
-
-        print("✅ Users system initialized!")
-        print(f"✅ Database initialized using {self.db_type}")
+        # Super Admin بيدخل بـ user_id = 0 ومالوش صف في users - SQLite مش بيطبق
+        # الـ foreign keys، فبنشيلهم في PostgreSQL عشان الباركود والـ sessions تشتغل
+        if self.db_type == 'postgresql':
+            cursor.execute('ALTER TABLE barcodes DROP CONSTRAINT IF EXISTS barcodes_generated_by_fkey')
+            cursor.execute('ALTER TABLE barcode_sessions DROP CONSTRAINT IF EXISTS barcode_sessions_user_id_fkey')
     
     def _initialize_default_pages(self, cursor):
         """Initialize the pages table with all available pages"""
@@ -570,6 +768,7 @@ class StockDatabase:
                 cursor.execute('UPDATE users SET active = ? WHERE id = ?', (active, user_id))
             
             conn.commit()
+            self.invalidate_user_permissions(user_id)
             conn.close()
             return True
         except Exception as e:
@@ -585,6 +784,7 @@ class StockDatabase:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
             conn.commit()
+            self.invalidate_user_permissions(user_id)
             conn.close()
             return True
         except Exception as e:
@@ -672,6 +872,7 @@ class StockDatabase:
                 VALUES (?, ?, ?)
             ''', (user_id, page_key, granted_by))
             conn.commit()
+            self.invalidate_user_permissions(user_id)
             conn.close()
             return True
         except Exception as e:
@@ -690,6 +891,7 @@ class StockDatabase:
                 WHERE user_id = ? AND page_key = ?
             ''', (user_id, page_key))
             conn.commit()
+            self.invalidate_user_permissions(user_id)
             conn.close()
             return True
         except Exception as e:
@@ -715,6 +917,7 @@ class StockDatabase:
                 ''', (user_id, page_key, granted_by))
             
             conn.commit()
+            self.invalidate_user_permissions(user_id)
             conn.close()
             return True
         except Exception as e:
@@ -724,39 +927,49 @@ class StockDatabase:
             return False
 
     def get_user_permissions(self, user_id):
-        """Get all page_keys a user has access to"""
+        """Get all page_keys a user has access to (cached per user)"""
+        return list(self._cached_permissions(user_id))
+
+    def _cached_permissions(self, user_id):
+        cached = self._permission_cache.get(user_id)
+        if cached is not None and time.monotonic() - cached[1] < PERMISSION_CACHE_TTL:
+            return cached[0]
+        
+        # a write during the load must not be overwritten by the old permissions
+        generation = self._permission_generation
+        permissions = self._load_user_permissions(user_id)
+        if permissions is not None and generation == self._permission_generation:
+            self._permission_cache[user_id] = (permissions, time.monotonic())
+        return permissions or ()
+
+    def invalidate_user_permissions(self, user_id=None):
+        """Drop cached permissions of one user (or everyone)"""
+        self._permission_generation += 1
+        if user_id is None:
+            self._permission_cache.clear()
+        else:
+            self._permission_cache.pop(user_id, None)
+
+    def _load_user_permissions(self, user_id):
+        """Read a user's page_keys from the database - None on error (not cached)"""
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT page_key FROM user_permissions WHERE user_id = ?
             ''', (user_id,))
-            permissions = [row[0] for row in cursor.fetchall()]
+            permissions = tuple(row[0] for row in cursor.fetchall())
             conn.close()
             return permissions
         except Exception as e:
             print(f"❌ Error getting user permissions: {e}")
             if 'conn' in locals():
                 conn.close()
-            return []
+            return None
 
     def user_has_permission(self, user_id, page_key):
         """Check if a user has permission to access a page"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT COUNT(*) FROM user_permissions 
-                WHERE user_id = ? AND page_key = ?
-            ''', (user_id, page_key))
-            count = cursor.fetchone()[0]
-            conn.close()
-            return count > 0
-        except Exception as e:
-            print(f"❌ Error checking permission: {e}")
-            if 'conn' in locals():
-                conn.close()
-            return False
+        return page_key in self._cached_permissions(user_id)
 
     def get_users_with_permissions(self):
         """Get all users with their permission counts"""
@@ -787,117 +1000,314 @@ class StockDatabase:
             return []
 
 
+    @staticmethod
+    def _stock_log_row(operation_type, product_id=None, variant_id=None,
+                       product_code='', brand_name='', product_type='', color_name='',
+                       image_url='', old_value=None, new_value=None,
+                       username='Admin', notes='', source_page='', source_url=''):
+        """صف stock_logs بنفس ترتيب STOCK_LOG_INSERT"""
+        change_amount = None
+        if old_value is not None and new_value is not None:
+            change_amount = new_value - old_value
+        return (operation_type, product_id, variant_id, product_code, brand_name,
+                product_type, color_name, image_url, old_value, new_value,
+                change_amount, username, notes, source_page, source_url)
+
+    def _insert_stock_logs(self, rows):
+        """كتابة صفوف stock_logs في transaction واحدة (executemany) - بيرمي الـ exception للـ caller"""
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany(STOCK_LOG_INSERT, rows)
+            conn.commit()
+        finally:
+            conn.close()
+
     def add_stock_log(self, operation_type, product_id=None, variant_id=None, 
                   product_code='', brand_name='', product_type='', color_name='',
                   image_url='', old_value=None, new_value=None, 
                   username='Admin', notes='', source_page='', source_url=''):
         """تسجيل عملية في الـ Stock Logs"""
+        row = self._stock_log_row(operation_type, product_id, variant_id, product_code,
+                                  brand_name, product_type, color_name, image_url,
+                                  old_value, new_value, username, notes, source_page, source_url)
+        return self._write_stock_logs([row]) == 1
+
+    def add_stock_logs_bulk(self, entries):
+        """
+        تسجيل كذا عملية مرة واحدة - entries: list of dicts بنفس arguments بتاعة add_stock_log
+        
+        Returns عدد الـ logs اللي اتسجلت (أو اتحطت في الـ queue بتاع الـ log writer)
+        """
         try:
-            change_amount = None
-            if old_value is not None and new_value is not None:
-                change_amount = new_value - old_value
-            
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO stock_logs 
-                (operation_type, product_id, variant_id, product_code, brand_name, 
-                product_type, color_name, image_url, old_value, new_value, 
-                change_amount, username, notes, source_page, source_url)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (operation_type, product_id, variant_id, product_code, brand_name,
-                product_type, color_name, image_url, old_value, new_value,
-                change_amount, username, notes, source_page, source_url))
-            
-            conn.commit()
-            conn.close()
-            return True
+            rows = [self._stock_log_row(**entry) for entry in entries]
+        except TypeError as e:
+            print(f"❌ Error adding logs: {e}")
+            return 0
+        return self._write_stock_logs(rows)
+
+    def _write_stock_logs(self, rows):
+        """الـ log writer لو شغال، وإلا (أو لو الـ queue مليانة) كتابة مباشرة"""
+        if not rows:
+            return 0
+        queued = self.log_writer.submit(rows) if self.log_writer else 0
+        try:
+            if queued < len(rows):
+                self._insert_stock_logs(rows[queued:])
+            return len(rows)
         except Exception as e:
             print(f"❌ Error adding log: {e}")
-            if 'conn' in locals():
+            return queued
+
+    def flush_stock_logs(self):
+        """استنى لحد ما الـ logs اللي في الـ queue تتكتب"""
+        if self.log_writer:
+            self.log_writer.flush()
+
+    def close_log_writer(self):
+        """كتابة الباقي في الـ queue وإيقاف الـ log writer (عند الإغلاق)"""
+        if self.log_writer:
+            self.log_writer.close()
+
+    def _logs_range(self, date_from=None, date_to=None):
+        """(start, end) - 'YYYY-MM-DD HH:MM:SS' حدود created_date (end مش داخل)، None لو مش محدد أو مش صالح"""
+        try:
+            start = end_of_day(date_from) - timedelta(days=1) if date_from else None
+        except ValueError:
+            start = None
+        try:
+            end = end_of_day(date_to) if date_to else None
+        except ValueError:
+            end = None
+        return (start.strftime('%Y-%m-%d %H:%M:%S') if start else None,
+                end.strftime('%Y-%m-%d %H:%M:%S') if end else None)
+
+    def _logs_filter(self, operation_filter=None, date_from=None, date_to=None, search_term=None):
+        """
+        شرط الـ WHERE بتاع الـ logs - التواريخ half-open على created_date نفسه
+        (created_date >= from AND created_date < to + 1 يوم) عشان الـ index يتستخدم
+        
+        Returns (where, params) - تاريخ مش صالح بيتجاهل
+        """
+        where = 'WHERE 1=1'
+        params = []
+        
+        if operation_filter:
+            where += ' AND operation_type = ?'
+            params.append(operation_filter)
+        
+        start, end = self._logs_range(date_from, date_to)
+        if start:
+            where += ' AND created_date >= ?'
+            params.append(start)
+        
+        if end:
+            where += ' AND created_date < ?'
+            params.append(end)
+        
+        if search_term:
+            search_term_param = f'%{search_term}%'
+            where += ''' AND (product_code LIKE ? OR brand_name LIKE ? 
+                        OR color_name LIKE ? OR product_type LIKE ?)'''
+            params.extend([search_term_param] * 4)
+        
+        return where, params
+
+    def _with_archived_logs(self, logs, limit, operation_filter=None, date_from=None,
+                            date_to=None, search_term=None, after=None):
+        """
+        يكمّل logs (من stock_logs) من الأرشيف لو أقل من limit والفترة بتوصل لقبل archived_before
+        
+        Returns أول limit صف من الاتنين مترتبين created_date DESC, id DESC
+        """
+        archived_before = self.log_archive.archived_before
+        if len(logs) >= limit or not archived_before:
+            return logs
+        start, end = self._logs_range(date_from, date_to)
+        if start and start >= archived_before:
+            return logs
+        
+        archived = self._archived_logs_not_in_table(
+            self.log_archive.iter_matching(start, end, operation_filter, search_term, after),
+            limit - len(logs))
+        archived = list(itertools.islice(archived, limit - len(logs)))
+        if not archived:
+            return logs
+        merged = list(logs) + archived
+        merged.sort(key=lambda log: (str(log[16]), log[0]), reverse=True)
+        return merged[:limit]
+
+    def _archived_logs_not_in_table(self, archived, chunk_size=LOG_EXPORT_CHUNK_SIZE):
+        """
+        صفوف الأرشيف (iterator) اللي مش لسه موجودة في stock_logs
+        
+        لو archive_old_logs وقفت بعد write_month وقبل ما الـ DELETE يتعمله commit الصفوف
+        بتبقى في الاتنين لحد الأرشفة الجاية - نسخة stock_logs بس هي اللي بتتعرض.
+        """
+        chunk_size = max(1, min(chunk_size, IN_BATCH_SIZE))
+        while True:
+            chunk = list(itertools.islice(archived, chunk_size))
+            if not chunk:
+                return
+            conn = self.get_connection()
+            try:
+                cursor = conn.cursor()
+                placeholders = ', '.join('?' for _ in chunk)
+                cursor.execute(f'SELECT id FROM stock_logs WHERE id IN ({placeholders})',
+                               [row[0] for row in chunk])
+                live = {row[0] for row in cursor.fetchall()}
+            finally:
                 conn.close()
-            return False
+            yield from (row for row in chunk if row[0] not in live)
 
     def get_all_logs(self, limit=100, operation_filter=None, date_from=None, 
                     date_to=None, search_term=None):
-        """جلب الـ Logs مع الفلاتر"""
+        """جلب الـ Logs مع الفلاتر - الـ logs المتأرشفة بتيجي من الأرشيف لو الفترة محتاجاها"""
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            query = 'SELECT * FROM stock_logs WHERE 1=1'
-            params = []
-            
-            if operation_filter:
-                query += ' AND operation_type = ?'
-                params.append(operation_filter)
-            
-            if date_from:
-                query += ' AND DATE(created_date) >= DATE(?)'
-                params.append(date_from)
-            
-            if date_to:
-                query += ' AND DATE(created_date) <= DATE(?)'
-                params.append(date_to)
-            
-            if search_term:
-                search_term_param = f'%{search_term}%'
-                query += ''' AND (product_code LIKE ? OR brand_name LIKE ? 
-                            OR color_name LIKE ? OR product_type LIKE ?)'''
-                params.extend([search_term_param] * 4)
-            
-            query += ' ORDER BY created_date DESC LIMIT ?'
-            params.append(limit)
-            
-            cursor.execute(query, params)
+            where, params = self._logs_filter(operation_filter, date_from, date_to, search_term)
+            cursor.execute(f'SELECT * FROM stock_logs {where} ORDER BY created_date DESC, id DESC LIMIT ?',
+                           params + [limit])
             logs = cursor.fetchall()
             conn.close()
             
-            return logs
+            return self._with_archived_logs(logs, limit, operation_filter, date_from,
+                                            date_to, search_term)
         except Exception as e:
             print(f"❌ Error getting logs: {e}")
             if 'conn' in locals():
                 conn.close()
             return []
 
-    def get_logs_stats(self):
-        """إحصائيات الـ Logs"""
+    def get_logs_page(self, cursor=None, limit=100, operation_filter=None, date_from=None,
+                      date_to=None, search_term=None):
+        """
+        صفحة logs بالـ keyset pagination على (created_date, id) - الأحدث الأول
+        
+        كل صفحة بتبدأ من آخر صف في اللي قبلها عن طريق الـ index، فالصفحة
+        الألف بنفس سرعة الأولى. لما stock_logs تخلص الصفحات بتكمّل في الأرشيف.
+        Returns (logs, next_cursor) - next_cursor = None لو مفيش logs أقدم
+        """
         try:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Total logs
-            cursor.execute('SELECT COUNT(*) FROM stock_logs')
-            total_logs = cursor.fetchone()[0]
+            db_cursor = conn.cursor()
             
-            # Logs today
-            cursor.execute('''
-                SELECT COUNT(*) FROM stock_logs 
-                WHERE DATE(created_date) = DATE('now')
-            ''')
-            logs_today = cursor.fetchone()[0]
+            where, params = self._logs_filter(operation_filter, date_from, date_to, search_term)
+            after = decode_cursor(cursor)
+            if after:
+                where += ' AND (created_date, id) < (?, ?)'
+                params += after
             
-            # Total stock added (positive changes)
-            cursor.execute('''
-                SELECT COALESCE(SUM(change_amount), 0) FROM stock_logs 
-                WHERE change_amount > 0
-            ''')
-            total_added = cursor.fetchone()[0]
+            db_cursor.execute(f'''
+                SELECT * FROM stock_logs {where}
+                ORDER BY created_date DESC, id DESC
+                LIMIT ?
+            ''', params + [limit + 1])
+            logs = db_cursor.fetchall()
+            conn.close()
+            logs = self._with_archived_logs(logs, limit + 1, operation_filter, date_from,
+                                            date_to, search_term, after)
+            
+            next_cursor = None
+            if len(logs) > limit:
+                logs = logs[:limit]
+                next_cursor = encode_cursor(str(logs[-1][16]), logs[-1][0])
+            return logs, next_cursor
+        except Exception as e:
+            print(f"❌ Error getting logs page: {e}")
+            if 'conn' in locals():
+                conn.close()
+            return [], None
+
+    def iter_logs(self, operation_filter=None, date_from=None, date_to=None, search_term=None,
+                  chunk_size=LOG_EXPORT_CHUNK_SIZE):
+        """
+        كل الـ logs اللي بتطابق فلاتر /logs، الأحدث الأول، في chunks (lists) من chunk_size صف
+        
+        stock_logs بتتقري بالـ keyset على (created_date, id) والأرشيف بعدها segment
+        segment، فالذاكرة ثابتة مهما كان عدد الـ logs (للـ export). بيرفع الخطأ
+        بدل ما يرجع نتيجة ناقصة.
+        """
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            where, params = self._logs_filter(operation_filter, date_from, date_to, search_term)
+            after = None
+            while True:
+                page_where, page_params = where, list(params)
+                if after:
+                    page_where += ' AND (created_date, id) < (?, ?)'
+                    page_params += after
+                cursor.execute(f'''
+                    SELECT * FROM stock_logs {page_where}
+                    ORDER BY created_date DESC, id DESC
+                    LIMIT ?
+                ''', page_params + [chunk_size])
+                logs = cursor.fetchall()
+                if logs:
+                    yield logs
+                if len(logs) < chunk_size:
+                    break
+                after = [str(logs[-1][16]), logs[-1][0]]
+        finally:
+            conn.close()
+        
+        # الـ logs الأقدم من archived_before من ملفات الأرشيف
+        start, end = self._logs_range(date_from, date_to)
+        archived_before = self.log_archive.archived_before
+        if archived_before and not (start and start >= archived_before):
+            archived = self._archived_logs_not_in_table(
+                self.log_archive.iter_matching(start, end, operation_filter, search_term), chunk_size)
+            while True:
+                chunk = list(itertools.islice(archived, chunk_size))
+                if not chunk:
+                    break
+                yield chunk
+
+    def get_inventory_as_of(self, as_of):
+        """
+        المخزون زي ما كان في آخر يوم as_of (date أو YYYY-MM-DD) - replay لـ stock_logs بالـ NumPy
+        
+        Returns {'date', 'variants', 'brands', 'total_stock', 'total_value'} أو None لو حصل خطأ
+        """
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            result = inventory_as_of(self.stock_history, cursor, as_of)
+            conn.close()
+            return result
+        except ValueError:
+            if 'conn' in locals():
+                conn.close()
+            raise
+        except Exception as e:
+            print(f"❌ Error reconstructing inventory as of {as_of}: {e}")
+            if 'conn' in locals():
+                conn.close()
+            return None
+
+    def get_logs_stats(self):
+        """إحصائيات الـ Logs - من جداول log_stats اللي الـ triggers بتحدّثها (مش scan لـ stock_logs)"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
             
-            # Total stock removed (negative changes)
+            # Total logs / added / removed + logs today
             cursor.execute('''
-                SELECT COALESCE(SUM(ABS(change_amount)), 0) FROM stock_logs 
-                WHERE change_amount < 0
+                SELECT scope, log_count, added, removed FROM log_stats
+                WHERE (scope = 'total' AND stat_key = '')
+                   OR (scope = 'day' AND stat_key = CAST(DATE('now') AS TEXT))
             ''')
-            total_removed = cursor.fetchone()[0]
+            counters = {row[0]: row for row in cursor.fetchall()}
+            total = counters.get('total', ('total', 0, 0, 0))
             
             # Most active products (top 5)
             cursor.execute('''
-                SELECT product_code, brand_name, COUNT(*) as count
-                FROM stock_logs
-                WHERE product_code IS NOT NULL
-                GROUP BY product_code, brand_name
-                ORDER BY count DESC
+                SELECT product_code, brand_name, log_count
+                FROM log_product_activity
+                ORDER BY log_count DESC
                 LIMIT 5
             ''')
             most_active = cursor.fetchall()
@@ -905,10 +1315,10 @@ class StockDatabase:
             conn.close()
             
             return {
-                'total_logs': total_logs,
-                'logs_today': logs_today,
-                'total_added': total_added,
-                'total_removed': total_removed,
+                'total_logs': total[1],
+                'logs_today': counters['day'][1] if 'day' in counters else 0,
+                'total_added': total[2],
+                'total_removed': total[3],
                 'most_active': most_active
             }
         except Exception as e:
@@ -1058,16 +1468,43 @@ class StockDatabase:
         
         conn.commit()
         conn.close()
+        self.catalog.invalidate()
         print("✅ Default data with enhanced tags added!")
     
-    # وظائف إدارة البراندات
-    def get_all_brands(self):
+    # === CATALOG DIMENSIONS CACHE ===
+    
+    def _fetch_dimension(self, query):
+        """تحميل جدول أبعاد كامل للـ catalog cache"""
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM brands ORDER BY brand_name')
-        brands = cursor.fetchall()
+        cursor.execute(query)
+        rows = cursor.fetchall()
         conn.close()
-        return brands
+        return rows
+    
+    def _dimension_filter(self, brand_filter='', type_filter='', color_filter=''):
+        """
+        فلاتر البراند / النوع / اللون بالـ id بدل مقارنة النصوص
+        
+        الأسماء بتتحول لـ id من الـ catalog cache (اللي بيعمل reload لو الاسم مش عنده)،
+        واسم مش موجود حتى بعد الـ reload = مفيش نتايج
+        """
+        clauses, params = [], []
+        for name, dimension, column in ((brand_filter, 'brands', 'bp.brand_id'),
+                                        (type_filter, 'product_types', 'bp.product_type_id'),
+                                        (color_filter, 'colors', 'pv.color_id')):
+            if not name:
+                continue
+            dimension_id = self.catalog.id_for(dimension, name)
+            if dimension_id is None:
+                return ' AND 1=0', []
+            clauses.append(f' AND {column} = ?')
+            params.append(dimension_id)
+        return ''.join(clauses), params
+    
+    # وظائف إدارة البراندات
+    def get_all_brands(self):
+        return self.catalog.rows('brands')
     
     def add_brand(self, brand_name):
         conn = None
@@ -1076,6 +1513,7 @@ class StockDatabase:
             cursor = conn.cursor()
             cursor.execute('INSERT INTO brands (brand_name) VALUES (?)', (brand_name,))
             conn.commit()
+            self.catalog.invalidate()
             return True
         except Exception as e:
             print(f"Error adding brand: {e}")
@@ -1091,6 +1529,7 @@ class StockDatabase:
             cursor = conn.cursor()
             cursor.execute('UPDATE brands SET brand_name = ? WHERE id = ?', (new_name, brand_id))
             conn.commit()
+            self.catalog.invalidate()
             return True
         except Exception as e:
             print(f"Error updating brand: {e}")
@@ -1112,6 +1551,7 @@ class StockDatabase:
             
             cursor.execute('DELETE FROM brands WHERE id = ?', (brand_id,))
             conn.commit()
+            self.catalog.invalidate()
             conn.close()
             return True, "Brand deleted successfully"
         except Exception as e:
@@ -1128,12 +1568,7 @@ class StockDatabase:
     
     # وظائف إدارة الألوان
     def get_all_colors(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM colors ORDER BY color_name')
-        colors = cursor.fetchall()
-        conn.close()
-        return colors
+        return self.catalog.rows('colors')
     
     def add_color(self, color_name, color_code='#FFFFFF'):
         conn = None
@@ -1142,6 +1577,7 @@ class StockDatabase:
             cursor = conn.cursor()
             cursor.execute('INSERT INTO colors (color_name, color_code) VALUES (?, ?)', (color_name, color_code))
             conn.commit()
+            self.catalog.invalidate()
             return True
         except Exception as e:
             print(f"Error adding color: {e}")
@@ -1157,6 +1593,7 @@ class StockDatabase:
             cursor.execute('UPDATE colors SET color_name = ?, color_code = ? WHERE id = ?', 
                           (new_name, new_code, color_id))
             conn.commit()
+            self.catalog.invalidate()
             conn.close()
             return True
         except:
@@ -1176,6 +1613,7 @@ class StockDatabase:
             
             cursor.execute('DELETE FROM colors WHERE id = ?', (color_id,))
             conn.commit()
+            self.catalog.invalidate()
             conn.close()
             return True, "Color deleted successfully"
         except Exception as e:
@@ -1201,12 +1639,7 @@ class StockDatabase:
     
     # وظائف إدارة أنواع المنتجات
     def get_all_product_types(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM product_types ORDER BY type_name')
-        types = cursor.fetchall()
-        conn.close()
-        return types
+        return self.catalog.rows('product_types')
     
     def add_product_type(self, type_name):
         conn = None
@@ -1215,6 +1648,7 @@ class StockDatabase:
             cursor = conn.cursor()
             cursor.execute('INSERT INTO product_types (type_name) VALUES (?)', (type_name,))
             conn.commit()
+            self.catalog.invalidate()
             return True
         except Exception as e:
             print(f"Error adding product type: {e}")
@@ -1230,6 +1664,7 @@ class StockDatabase:
             cursor = conn.cursor()
             cursor.execute('UPDATE product_types SET type_name = ? WHERE id = ?', (new_name, type_id))
             conn.commit()
+            self.catalog.invalidate()
             return True
         except Exception as e:
             print(f"Error updating product type: {e}")
@@ -1251,6 +1686,7 @@ class StockDatabase:
             
             cursor.execute('DELETE FROM product_types WHERE id = ?', (type_id,))
             conn.commit()
+            self.catalog.invalidate()
             conn.close()
             return True, "Product type deleted successfully"
         except Exception as e:
@@ -1267,12 +1703,7 @@ class StockDatabase:
     
     # وظائف إدارة فئات التجار
     def get_all_trader_categories(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM trader_categories ORDER BY category_code')
-        categories = cursor.fetchall()
-        conn.close()
-        return categories
+        return self.catalog.rows('trader_categories')
 
     def add_trader_category(self, category_code, category_name, description=''):
         conn = None
@@ -1282,6 +1713,7 @@ class StockDatabase:
             cursor.execute('INSERT INTO trader_categories (category_code, category_name, description) VALUES (?, ?, ?)',
                            (category_code, category_name, description))
             conn.commit()
+            self.catalog.invalidate()
             return True
         except Exception as e:
             print(f"Error adding trader category: {e}")
@@ -1297,6 +1729,7 @@ class StockDatabase:
             cursor.execute('UPDATE trader_categories SET category_code = ?, category_name = ?, description = ? WHERE id = ?',
                            (new_code, new_name, new_description, category_id))
             conn.commit()
+            self.catalog.invalidate()
             conn.close()
             return True
         except:
@@ -1316,6 +1749,7 @@ class StockDatabase:
             
             cursor.execute('DELETE FROM trader_categories WHERE id = ?', (category_id,))
             conn.commit()
+            self.catalog.invalidate()
             conn.close()
             return True, "Category deleted successfully"
         except Exception as e:
@@ -1332,12 +1766,7 @@ class StockDatabase:
 
     # وظائف إدارة Tags
     def get_all_tags(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM tags ORDER BY tag_category, tag_name')
-        tags = cursor.fetchall()
-        conn.close()
-        return tags
+        return self.catalog.rows('tags')
     
     def get_tags_by_category(self, category=None):
         conn = self.get_connection()
@@ -1358,6 +1787,7 @@ class StockDatabase:
             cursor.execute('INSERT INTO tags (tag_name, tag_category, tag_color, description) VALUES (?, ?, ?, ?)',
                            (tag_name, tag_category, tag_color, description))
             conn.commit()
+            self.catalog.invalidate()
             return True
         except Exception as e:
             print(f"Error adding tag: {e}")
@@ -1373,6 +1803,7 @@ class StockDatabase:
             cursor.execute('UPDATE tags SET tag_name = ?, tag_category = ?, tag_color = ?, description = ? WHERE id = ?',
                            (new_name, new_category, new_color, new_description, tag_id))
             conn.commit()
+            self.catalog.invalidate()
             conn.close()
             return True
         except:
@@ -1392,6 +1823,7 @@ class StockDatabase:
             
             cursor.execute('DELETE FROM tags WHERE id = ?', (tag_id,))
             conn.commit()
+            self.catalog.invalidate()
             conn.close()
             return True, "Tag deleted successfully"
         except Exception as e:
@@ -1454,7 +1886,8 @@ class StockDatabase:
             
             base_product_id = cursor.lastrowid
             
-            for color_id in color_ids:
+            # لون واحد لكل variant (unique index على base_product_id, color_id)
+            for color_id in dict.fromkeys(color_ids):
                 cursor.execute('''
                     INSERT INTO product_variants (base_product_id, color_id, current_stock)
                     VALUES (?, ?, ?)
@@ -1501,7 +1934,7 @@ class StockDatabase:
             LEFT JOIN colors c ON pv.color_id = c.id
             LEFT JOIN product_tags ptags ON bp.id = ptags.product_id
             LEFT JOIN tags t ON ptags.tag_id = t.id
-            GROUP BY bp.id
+            GROUP BY bp.id, b.brand_name, pt.type_name, s.supplier_name
             ORDER BY bp.created_date DESC
         ''')
         
@@ -1526,7 +1959,41 @@ class StockDatabase:
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        if search_term:
+        join, _, match_params, ranked = self._product_search_clause(cursor, search_term)
+        if ranked:
+            # bm25() مينفعش جوه GROUP BY - الترتيب بالـ score بيتعمل بعد التجميع
+            cursor.execute(f'SELECT ps.product_id, ps.score FROM ({self._search_source_sql()}) ps', match_params)
+            scores = dict(cursor.fetchall())
+            cursor.execute(f'''
+                SELECT 
+                    bp.id,
+                    bp.product_code,
+                    b.brand_name,
+                    pt.type_name,
+                    bp.trader_category,
+                    bp.product_size,
+                    bp.wholesale_price,
+                    bp.retail_price,
+                    s.supplier_name,
+                    GROUP_CONCAT(DISTINCT c.color_name) as colors,
+                    SUM(pv.current_stock) as total_stock,
+                    bp.created_date,
+                    GROUP_CONCAT(DISTINCT t.tag_name) as tags
+                FROM base_products bp
+                {join}
+                LEFT JOIN brands b ON bp.brand_id = b.id
+                LEFT JOIN product_types pt ON bp.product_type_id = pt.id
+                LEFT JOIN suppliers s ON bp.supplier_id = s.id
+                LEFT JOIN product_variants pv ON bp.id = pv.base_product_id
+                LEFT JOIN colors c ON pv.color_id = c.id
+                LEFT JOIN product_tags ptags ON bp.id = ptags.product_id
+                LEFT JOIN tags t ON ptags.tag_id = t.id
+                GROUP BY bp.id, b.brand_name, pt.type_name, s.supplier_name
+            ''', match_params)
+            products = sorted(cursor.fetchall(), key=lambda row: (scores[row[0]], row[0]))
+            conn.close()
+            return products
+        elif search_term:
             search_term = f'%{search_term}%'
             cursor.execute('''
                 SELECT DISTINCT
@@ -1558,7 +2025,7 @@ class StockDatabase:
                    OR pt.type_name LIKE ?
                    OR bp.product_size LIKE ?
                    OR t.tag_name LIKE ?
-                GROUP BY bp.id
+                GROUP BY bp.id, b.brand_name, pt.type_name, s.supplier_name
                 ORDER BY bp.created_date DESC
             ''', (search_term, search_term, search_term, search_term, search_term, search_term, search_term))
         else:
@@ -1585,7 +2052,7 @@ class StockDatabase:
                 LEFT JOIN colors c ON pv.color_id = c.id
                 LEFT JOIN product_tags ptags ON bp.id = ptags.product_id
                 LEFT JOIN tags t ON ptags.tag_id = t.id
-                GROUP BY bp.id
+                GROUP BY bp.id, b.brand_name, pt.type_name, s.supplier_name
                 ORDER BY bp.created_date DESC
             ''')
         
@@ -1726,24 +2193,21 @@ class StockDatabase:
         cursor = conn.cursor()
         
         if search_term:
-            search_term = f'%{search_term}%'
-            cursor.execute('''
-                SELECT DISTINCT
+            join, where, params, ranked = self._product_search_clause(cursor, search_term)
+            order = 'ps.score, bp.id' if ranked else 'bp.created_date DESC'
+            cursor.execute(f'''
+                SELECT 
                     bp.id, bp.product_code, b.brand_name, pt.type_name,
                     bp.trader_category, bp.product_size, bp.wholesale_price, bp.retail_price,
                     s.supplier_name, bp.created_date
                 FROM base_products bp
+                {join}
                 LEFT JOIN brands b ON bp.brand_id = b.id
                 LEFT JOIN product_types pt ON bp.product_type_id = pt.id
                 LEFT JOIN suppliers s ON bp.supplier_id = s.id
-                LEFT JOIN product_variants pv ON bp.id = pv.base_product_id
-                LEFT JOIN colors c ON pv.color_id = c.id
-                LEFT JOIN product_tags ptags ON bp.id = ptags.product_id
-                LEFT JOIN tags t ON ptags.tag_id = t.id
-                WHERE bp.product_code LIKE ? OR b.brand_name LIKE ? OR c.color_name LIKE ? 
-                   OR bp.product_size LIKE ? OR t.tag_name LIKE ?
-                ORDER BY bp.created_date DESC
-            ''', (search_term, search_term, search_term, search_term, search_term))
+                WHERE {where}
+                ORDER BY {order}
+            ''', params)
         else:
             cursor.execute('''
                 SELECT 
@@ -1758,27 +2222,139 @@ class StockDatabase:
             ''')
         
         products = cursor.fetchall()
+        products_with_images = self._attach_color_images(cursor, products)
         
-        products_with_images = []
-        for product in products:
-            cursor.execute('''
-                SELECT 
-                    pv.id as variant_id,
-                    c.color_name,
-                    c.color_code,
-                    pv.current_stock,
-                    ci.image_url
-                FROM product_variants pv
-                JOIN colors c ON pv.color_id = c.id
-                LEFT JOIN color_images ci ON pv.id = ci.variant_id
-                WHERE pv.base_product_id = ?
-                ORDER BY pv.current_stock DESC
-            ''', (product[0],))
-            
-            color_data = cursor.fetchall()
+        conn.close()
+        return products_with_images
+
+    def _product_search_clause(self, cursor, search_term):
+        """
+        شرط البحث في المنتجات - الـ full-text index للكلمات ولو ملقاش حاجة LIKE
+        
+        البحث اللي فيه أرقام (كود منتج كامل أو جزء منه) بيروح لـ LIKE على طول:
+        الـ index بيطابق أول الكلمة بس، فـ '123' كانت هتلاقي 123X وتفوّت AB123.
+        Returns (join, where, params, ranked): join بيتحط بعد FROM base_products bp
+        و ranked = True لما النتايج جاية من الـ index وفيها ps.score (الأقل = الأنسب)
+        """
+        if not search_term:
+            return '', '1=1', [], False
+        
+        match = self._search_match_query(search_term)
+        if match:
+            source = self._search_source_sql()
+            cursor.execute(f'SELECT 1 FROM ({source}) ps LIMIT 1', (match,))
+            if cursor.fetchone():
+                return f'JOIN ({source}) ps ON ps.product_id = bp.id', '1=1', [match], True
+        
+        where, params = self._product_like_clause(search_term)
+        return '', where, params, False
+
+    def _product_like_clause(self, search_term):
+        """شرط LIKE في الكود / البراند / المقاس / اللون / الـ Tag بدون JOIN يكرر المنتج"""
+        term = f'%{search_term}%'
+        clause = '''(
+            bp.product_code LIKE ? OR b.brand_name LIKE ? OR bp.product_size LIKE ?
+            OR EXISTS (SELECT 1 FROM product_variants spv JOIN colors sc ON spv.color_id = sc.id
+                       WHERE spv.base_product_id = bp.id AND sc.color_name LIKE ?)
+            OR EXISTS (SELECT 1 FROM product_tags sptags JOIN tags st ON sptags.tag_id = st.id
+                       WHERE sptags.product_id = bp.id AND st.tag_name LIKE ?)
+        )'''
+        return clause, [term] * 5
+
+    def get_products_page(self, search_term='', cursor=None, limit=30):
+        """
+        صفحة منتجات بالـ keyset pagination على (created_date, id) - الأحدث الأول
+        
+        Returns (products, next_cursor) - products بنفس شكل get_products_with_color_images
+        و next_cursor = None لو مفيش صفحات تانية
+        """
+        conn = self.get_connection()
+        db_cursor = conn.cursor()
+        
+        join, where, params, ranked = self._product_search_clause(db_cursor, search_term)
+        after = decode_cursor(cursor)
+        if ranked:
+            # نتايج الـ full-text بالأنسب: keyset على (score, id)
+            key_columns, order = '(ps.score, bp.id) > (?, ?)', 'ps.score, bp.id'
+        else:
+            key_columns, order = '(bp.created_date, bp.id) < (?, ?)', 'bp.created_date DESC, bp.id DESC'
+        if after:
+            where += f' AND {key_columns}'
+            params += after
+        
+        db_cursor.execute(f'''
+            SELECT 
+                bp.id, bp.product_code, b.brand_name, pt.type_name,
+                bp.trader_category, bp.product_size, bp.wholesale_price, bp.retail_price,
+                s.supplier_name, bp.created_date{', ps.score' if ranked else ''}
+            FROM base_products bp
+            {join}
+            LEFT JOIN brands b ON bp.brand_id = b.id
+            LEFT JOIN product_types pt ON bp.product_type_id = pt.id
+            LEFT JOIN suppliers s ON bp.supplier_id = s.id
+            WHERE {where}
+            ORDER BY {order}
+            LIMIT ?
+        ''', params + [limit + 1])
+        
+        products = db_cursor.fetchall()
+        next_cursor = None
+        if len(products) > limit:
+            products = products[:limit]
+            last = products[-1]
+            next_cursor = encode_cursor(last[10] if ranked else last[9], last[0])
+        products = [product[:10] for product in products]
+        
+        products_with_images = self._attach_color_images(db_cursor, products)
+        conn.close()
+        return products_with_images, next_cursor
+
+    def get_products_stats(self, search_term=''):
+        """إحصائيات قائمة المنتجات (العدد / إجمالي المخزون / متوفر / نفد) لنفس شرط البحث"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        join, where, params, _ = self._product_search_clause(cursor, search_term)
+        cursor.execute(f'''
+            SELECT 
+                COUNT(*),
+                COALESCE(SUM(stock), 0),
+                COALESCE(SUM(CASE WHEN stock > 0 THEN 1 ELSE 0 END), 0),
+                COALESCE(SUM(CASE WHEN stock = 0 THEN 1 ELSE 0 END), 0)
+            FROM (
+                SELECT bp.id, COALESCE(SUM(pv.current_stock), 0) as stock
+                FROM base_products bp
+                {join}
+                LEFT JOIN brands b ON bp.brand_id = b.id
+                LEFT JOIN product_variants pv ON bp.id = pv.base_product_id
+                WHERE {where}
+                GROUP BY bp.id
+            ) product_stock
+        ''', params)
+        
+        row = cursor.fetchone()
+        conn.close()
+        return {
+            'total_products': row[0],
+            'total_stock': row[1],
+            'in_stock': row[2],
+            'out_of_stock': row[3]
+        }
+
+    def _attach_color_images(self, cursor, products):
+        """تحويل صفوف المنتجات لـ list فيها الألوان بالصور والمخزون الكلي والـ Tags"""
+        variants_by_product, tags_by_product = self._load_product_graph(
+            cursor, [product[0] for product in products],
+            variant_columns='pv.id, c.color_name, c.color_code, pv.current_stock, ci.image_url',
+            variant_order='pv.current_stock DESC'
+        )
+        
+        products_with_images = []
+        for product in products:
+            color_data = variants_by_product[product[0]]
             total_stock = sum([cd[3] for cd in color_data])
             
-            product_tags = self.get_product_tags(product[0])
+            product_tags = tags_by_product[product[0]]
             
             colors_with_images = []
             for cd in color_data:
@@ -1793,9 +2369,241 @@ class StockDatabase:
             product_data = list(product) + [colors_with_images, total_stock, product_tags]
             products_with_images.append(product_data)
         
-        conn.close()
         return products_with_images
 
+    def _load_product_graph(self, cursor, product_ids, variant_columns, variant_order):
+        """
+        جلب ألوان وصور و Tags مجموعة منتجات مرة واحدة بدل استعلامين لكل منتج
+        
+        Returns (variants_by_product, tags_by_product) - كل واحد dict من product_id لـ list
+        بنفس صفوف وترتيب الاستعلام القديم لكل منتج (color_id بيثبت ترتيب القيم المتساوية
+        زي الـ unique index على base_product_id, color_id)
+        """
+        variants_by_product = {product_id: [] for product_id in product_ids}
+        tags_by_product = {product_id: [] for product_id in product_ids}
+        
+        for start in range(0, len(product_ids), IN_BATCH_SIZE):
+            chunk = product_ids[start:start + IN_BATCH_SIZE]
+            placeholders = ', '.join(['?'] * len(chunk))
+            
+            cursor.execute(f'''
+                SELECT pv.base_product_id, {variant_columns}
+                FROM product_variants pv
+                JOIN colors c ON pv.color_id = c.id
+                LEFT JOIN color_images ci ON pv.id = ci.variant_id
+                WHERE pv.base_product_id IN ({placeholders})
+                ORDER BY pv.base_product_id, {variant_order}, pv.color_id
+            ''', chunk)
+            for row in cursor.fetchall():
+                variants_by_product[row[0]].append(row[1:])
+            
+            cursor.execute(f'''
+                SELECT pt.product_id, t.*
+                FROM tags t
+                JOIN product_tags pt ON t.id = pt.tag_id
+                WHERE pt.product_id IN ({placeholders})
+                ORDER BY t.tag_category, t.tag_name
+            ''', chunk)
+            for row in cursor.fetchall():
+                tags_by_product[row[0]].append(row[1:])
+        
+        return variants_by_product, tags_by_product
+
+    # === DEFERRED TRIGGERS ===
+    
+    def defer_triggers(self, cursor):
+        """
+        إيقاف triggers الـ summary والبحث لباقي الـ transaction دي بس
+        
+        الصف في bulk_write_deferred مش بيبان لأي اتصال تاني لأنه بيتمسح قبل
+        الـ commit بـ resume_triggers(). اللي بيكتب لازم يحدّث inventory_summary
+        (apply_products) ومستندات البحث للمنتجات اللي لمسها بنفسه.
+        """
+        cursor.execute(f'INSERT OR IGNORE INTO {inventory_summary.DEFERRED_TABLE} (marker) VALUES (1)')
+    
+    def resume_triggers(self, cursor):
+        cursor.execute(f'DELETE FROM {inventory_summary.DEFERRED_TABLE}')
+    
+    def _apply_summary(self, cursor, product_ids, sign):
+        """
+        inventory_summary.apply_products على دفعات IN_BATCH_SIZE
+        
+        على PostgreSQL الـ -1 بيقفل المنتجات والـ variants بتاعتها لحد الـ commit
+        (lock_products) عشان تغيير مخزون من transaction تانية ما يتحسبش مرتين.
+        """
+        product_ids = sorted(set(product_ids))
+        chunks = [product_ids[start:start + IN_BATCH_SIZE] for start in range(0, len(product_ids), IN_BATCH_SIZE)]
+        if sign < 0 and self.db_type == 'postgresql':
+            # كل الأقفال قبل أول تعديل في الـ summary
+            for chunk in chunks:
+                inventory_summary.lock_products(cursor, chunk)
+        for chunk in chunks:
+            inventory_summary.apply_products(cursor, chunk, sign)
+            if sign > 0:
+                inventory_summary.refresh_product_stock(cursor, chunk)
+    
+    # === FULL-TEXT SEARCH ===
+    
+    def create_search_index(self, cursor):
+        """Migration 4: جدول البحث (FTS5 / tsvector + GIN) والـ triggers اللي بتحدّثه"""
+        if self.db_type == 'postgresql':
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS product_search (
+                    product_id INTEGER PRIMARY KEY,
+                    document TSVECTOR NOT NULL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_search_document ON product_search USING GIN (document)')
+            cursor.execute(f'''
+                CREATE OR REPLACE FUNCTION product_search_refresh(ids INTEGER[]) RETURNS void AS $$
+                BEGIN
+                    DELETE FROM product_search WHERE product_id = ANY(ids);
+                    INSERT INTO product_search (product_id, document)
+                    SELECT doc.id, to_tsvector('simple', doc.document)
+                    FROM ({SEARCH_DOCUMENT_SQL} WHERE bp.id = ANY(ids)) doc;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+        else:
+            try:
+                cursor.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS product_search
+                    USING fts5(document, tokenize = 'unicode61', prefix = '2 3')
+                ''')
+            except sqlite3.OperationalError as e:
+                # SQLite من غير FTS5 - البحث بيفضل على LIKE
+                print(f"⚠️ FTS5 not available, product search will use LIKE: {e}")
+                return
+        
+        self.create_search_triggers(cursor)
+        self._fill_search_index(cursor)
+    
+    def create_search_triggers(self, cursor):
+        """Triggers جدول البحث (Migration 4، ومن جديد في Migration 10) - بتقف جوه defer_triggers()"""
+        inventory_summary.create_deferred_table(cursor)
+        for name, event, table, ids in SEARCH_INDEX_TRIGGERS:
+            if self.db_type == 'postgresql':
+                cursor.execute(f'''
+                    CREATE OR REPLACE FUNCTION {name}_fn() RETURNS trigger AS $$
+                    BEGIN
+                        IF {inventory_summary.TRIGGERS_ENABLED} THEN
+                            PERFORM product_search_refresh(ARRAY({ids}));
+                        END IF;
+                        RETURN NULL;
+                    END;
+                    $$ LANGUAGE plpgsql
+                ''')
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name} ON {table}')
+                cursor.execute(f'''
+                    CREATE TRIGGER {name} AFTER {event} ON {table}
+                    FOR EACH ROW EXECUTE PROCEDURE {name}_fn()
+                ''')
+            else:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+                cursor.execute(f'''
+                    CREATE TRIGGER {name} AFTER {event} ON {table}
+                    WHEN {inventory_summary.TRIGGERS_ENABLED}
+                    BEGIN
+                        DELETE FROM product_search WHERE rowid IN ({ids});
+                        INSERT INTO product_search (rowid, document)
+                        {SEARCH_DOCUMENT_SQL} WHERE bp.id IN ({ids});
+                    END
+                ''')
+    
+    def has_search_table(self, cursor):
+        """جدول البحث موجود؟ (بنفس الـ cursor - جوه الـ migration)"""
+        if self.db_type == 'postgresql':
+            cursor.execute("SELECT to_regclass('product_search') IS NOT NULL")
+            return bool(cursor.fetchone()[0])
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'product_search'")
+        return cursor.fetchone() is not None
+    
+    def refresh_search_documents(self, cursor, product_ids):
+        """إعادة بناء مستندات بحث المنتجات دي مرة واحدة (بعد كتابة كبيرة والـ triggers متأجلة)"""
+        if not self.search_backend:
+            return
+        product_ids = sorted(set(product_ids))
+        for start in range(0, len(product_ids), IN_BATCH_SIZE):
+            chunk = product_ids[start:start + IN_BATCH_SIZE]
+            if self.db_type == 'postgresql':
+                cursor.execute('SELECT product_search_refresh(CAST(? AS INTEGER[]))', (chunk,))
+            else:
+                placeholders = ', '.join('?' for _ in chunk)
+                cursor.execute(f'DELETE FROM product_search WHERE rowid IN ({placeholders})', chunk)
+                cursor.execute(f'''
+                    INSERT INTO product_search (rowid, document)
+                    {SEARCH_DOCUMENT_SQL} WHERE bp.id IN ({placeholders})
+                ''', chunk)
+    
+    def _fill_search_index(self, cursor):
+        """إعادة بناء مستندات البحث لكل المنتجات"""
+        cursor.execute('DELETE FROM product_search')
+        if self.db_type == 'postgresql':
+            cursor.execute(f'''
+                INSERT INTO product_search (product_id, document)
+                SELECT doc.id, to_tsvector('simple', doc.document) FROM ({SEARCH_DOCUMENT_SQL}) doc
+            ''')
+        else:
+            cursor.execute(f'INSERT INTO product_search (rowid, document) {SEARCH_DOCUMENT_SQL}')
+    
+    def rebuild_search_index(self):
+        """إعادة بناء الـ full-text index بالكامل (صيانة)"""
+        if not self.search_backend:
+            print("⚠️ Full-text search index is not available")
+            return False
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            self._fill_search_index(cursor)
+            conn.commit()
+            conn.close()
+            print("✅ Product search index rebuilt")
+            return True
+        except Exception as e:
+            print(f"❌ Error rebuilding search index: {e}")
+            if 'conn' in locals():
+                conn.close()
+            return False
+    
+    def _detect_search_backend(self):
+        """'fts5' / 'tsvector' لو جدول البحث موجود، None = LIKE بس"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        if self.db_type == 'postgresql':
+            cursor.execute("SELECT to_regclass('product_search') IS NOT NULL")
+            backend = 'tsvector' if cursor.fetchone()[0] else None
+        else:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'product_search'")
+            backend = 'fts5' if cursor.fetchone() else None
+        conn.close()
+        return backend
+    
+    def _search_match_query(self, search_term):
+        """كل كلمة في البحث prefix والكلمات كلها لازم تتطابق (AND) - None لو مفيش index أو كلمات"""
+        if not self.search_backend or _is_code_search(search_term):
+            return None
+        words = re.findall(r'[^\W_]+', search_term.lower())
+        if not words:
+            return None
+        if self.search_backend == 'tsvector':
+            return ' & '.join(f'{word}:*' for word in words)
+        return ' '.join(f'"{word}"*' for word in words)
+    
+    def _search_source_sql(self):
+        """استعلام (product_id, score) للمنتجات المطابقة - score الأقل هو الأنسب"""
+        if self.search_backend == 'tsvector':
+            # float8 - the real ts_rank() loses precision as text and breaks the keyset cursor
+            return '''
+                SELECT product_id, -CAST(ts_rank(document, q) AS DOUBLE PRECISION) AS score
+                FROM product_search, to_tsquery('simple', ?) q
+                WHERE document @@ q
+            '''
+        return '''
+            SELECT rowid AS product_id, bm25(product_search) AS score
+            FROM product_search
+            WHERE product_search MATCH ?
+        '''
+
     # وظائف إضافة منتجات متعددة دفعة واحدة
     def add_multiple_products_batch(self, products_data):
         conn = self.get_connection()
@@ -1835,7 +2643,7 @@ class StockDatabase:
                     
                     base_product_id = cursor.lastrowid
                     
-                    for color_id in product_data['color_ids']:
+                    for color_id in dict.fromkeys(product_data['color_ids']):
                         cursor.execute('''
                             INSERT INTO product_variants (base_product_id, color_id, current_stock)
                             VALUES (?, ?, ?)
@@ -1902,8 +2710,9 @@ class StockDatabase:
             params.extend([search_param, search_param, search_param])
         
         if brand_filter:
-            base_query += ' AND b.brand_name = ?'
-            params.append(brand_filter)
+            brand_sql, brand_params = self._dimension_filter(brand_filter=brand_filter)
+            base_query += brand_sql
+            params.extend(brand_params)
         
         if category_filter:
             base_query += ' AND bp.trader_category = ?'
@@ -1914,20 +2723,17 @@ class StockDatabase:
         cursor.execute(base_query, params)
         products = cursor.fetchall()
         
+        variants_by_product, tags_by_product = self._load_product_graph(
+            cursor, [product[0] for product in products],
+            variant_columns='pv.id, c.id, c.color_name, c.color_code, pv.current_stock, ci.image_url',
+            variant_order='c.color_name'
+        )
+        
         inventory_data = []
         for product in products:
-            cursor.execute('''
-                SELECT pv.id, c.id, c.color_name, c.color_code, pv.current_stock, ci.image_url
-                FROM product_variants pv
-                JOIN colors c ON pv.color_id = c.id
-                LEFT JOIN color_images ci ON pv.id = ci.variant_id
-                WHERE pv.base_product_id = ?
-                ORDER BY c.color_name
-            ''', (product[0],))
-            
-            color_variants = cursor.fetchall()
+            color_variants = variants_by_product[product[0]]
             total_stock = sum([cv[4] for cv in color_variants])
-            product_tags = self.get_product_tags(product[0])
+            product_tags = tags_by_product[product[0]]
             
             inventory_data.append({
                 'product': product,
@@ -1966,23 +2772,116 @@ class StockDatabase:
             'low_stock_variants': summary[4] or 0
         }
 
-    def get_brands_for_filter(self):
-        """جلب البراندات للفلترة"""
+    def get_product_codes(self):
+        """أكواد المنتجات (distinct ومترتبة) لصفحة فلاتر التصدير"""
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT DISTINCT brand_name FROM brands ORDER BY brand_name')
-        brands = [row[0] for row in cursor.fetchall()]
+        cursor.execute('''
+            SELECT DISTINCT product_code FROM base_products
+            WHERE product_code IS NOT NULL
+            ORDER BY product_code
+        ''')
+        product_codes = [row[0] for row in cursor.fetchall()]
         conn.close()
-        return brands
+        return product_codes
+
+    def iter_export_variants(self, brands=None, categories=None, product_types=None, colors=None,
+                             product_codes=None, stock_filter='all', chunk_size=PRODUCT_EXPORT_CHUNK_SIZE):
+        """
+        صفوف تصدير المنتجات (صف لكل لون) بالفلاتر جوه الـ SQL، في chunks (lists)
+        
+        المنتجات اللي فيها لون واحد على الأقل بيطابق بتتقري بالـ keyset على
+        (created_date, id) الأحدث الأول، chunk_size منتج في المرة، وبعدين ألوانهم
+        (المخزون الأعلى الأول) والـ Tags بتوعهم - نفس ترتيب التصدير القديم.
+        كل صف: (product_code, brand_name, type_name, trader_category, product_size,
+        wholesale_price, retail_price, color_name, current_stock, image_url, tags)
+        """
+        product_where, product_params = ['1=1'], []
+        for column, values in (('b.brand_name', brands), ('bp.trader_category', categories),
+                               ('pt.type_name', product_types), ('bp.product_code', product_codes)):
+            if values:
+                product_where.append(f"{column} IN ({', '.join('?' for _ in values)})")
+                product_params += list(values)
+        
+        variant_where, variant_params = ['1=1'], []
+        if colors:
+            variant_where.append(f"c.color_name IN ({', '.join('?' for _ in colors)})")
+            variant_params += list(colors)
+        if stock_filter == 'in_stock':
+            variant_where.append('pv.current_stock > 0')
+        elif stock_filter == 'out_of_stock':
+            variant_where.append('pv.current_stock <= 0')
+        elif stock_filter == 'low_stock':
+            variant_where.append('pv.current_stock > 0 AND pv.current_stock <= 5')
+        product_where = ' AND '.join(product_where)
+        variant_where = ' AND '.join(variant_where)
+        
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            after = None
+            while True:
+                key_where, key_params = '', []
+                if after:
+                    key_where, key_params = ' AND (bp.created_date, bp.id) < (?, ?)', after
+                cursor.execute(f'''
+                    SELECT bp.id, bp.created_date
+                    FROM base_products bp
+                    LEFT JOIN brands b ON bp.brand_id = b.id
+                    LEFT JOIN product_types pt ON bp.product_type_id = pt.id
+                    WHERE {product_where}{key_where}
+                      AND EXISTS (SELECT 1 FROM product_variants pv
+                                  JOIN colors c ON pv.color_id = c.id
+                                  WHERE pv.base_product_id = bp.id AND {variant_where})
+                    ORDER BY bp.created_date DESC, bp.id DESC
+                    LIMIT ?
+                ''', product_params + key_params + variant_params + [chunk_size])
+                products = cursor.fetchall()
+                if not products:
+                    break
+                
+                product_ids = [product[0] for product in products]
+                placeholders = ', '.join('?' for _ in product_ids)
+                cursor.execute(f'''
+                    SELECT pt.product_id, t.tag_name
+                    FROM tags t
+                    JOIN product_tags pt ON t.id = pt.tag_id
+                    WHERE pt.product_id IN ({placeholders})
+                    ORDER BY t.tag_category, t.tag_name
+                ''', product_ids)
+                tags_by_product = {}
+                for product_id, tag_name in cursor.fetchall():
+                    tags_by_product.setdefault(product_id, []).append(tag_name)
+                
+                cursor.execute(f'''
+                    SELECT bp.id, bp.product_code, b.brand_name, pt.type_name,
+                           bp.trader_category, bp.product_size, bp.wholesale_price, bp.retail_price,
+                           c.color_name, pv.current_stock, ci.image_url
+                    FROM product_variants pv
+                    JOIN base_products bp ON pv.base_product_id = bp.id
+                    JOIN colors c ON pv.color_id = c.id
+                    LEFT JOIN color_images ci ON pv.id = ci.variant_id
+                    LEFT JOIN brands b ON bp.brand_id = b.id
+                    LEFT JOIN product_types pt ON bp.product_type_id = pt.id
+                    WHERE bp.id IN ({placeholders}) AND {variant_where}
+                    ORDER BY bp.created_date DESC, bp.id DESC, pv.current_stock DESC, pv.color_id
+                ''', product_ids + variant_params)
+                yield [tuple(row[1:]) + (','.join(tags_by_product.get(row[0], [])),)
+                       for row in cursor.fetchall()]
+                
+                if len(products) < chunk_size:
+                    break
+                after = [products[-1][1], products[-1][0]]
+        finally:
+            conn.close()
+
+    def get_brands_for_filter(self):
+        """جلب البراندات للفلترة"""
+        return [brand[1] for brand in self.catalog.rows('brands')]
 
     def get_categories_for_filter(self):
         """جلب فئات التجار للفلترة"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT DISTINCT category_code FROM trader_categories ORDER BY category_code')
-        categories = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return categories
+        return [category[1] for category in self.catalog.rows('trader_categories')]
 
     def bulk_update_inventory(self, stock_updates):
         """تحديث المخزون بشكل جماعي"""
@@ -2028,219 +2927,136 @@ class StockDatabase:
             }
 
 
-    def bulk_add_products_from_excel_enhanced(self, excel_data):
-        """إضافة منتجات من Excel مع تحسين الأداء ومعالجة أخطاء البيانات المختلطة"""
+    def bulk_add_products_from_excel_enhanced(self, row_chunks, run_id=None, username='Admin'):
+        """
+        إضافة منتجات من Excel - set-based: كل chunk بعدد ثابت من الاستعلامات مش لكل صف
         
-        # تحسين أداء SQLite
-        if self.db_type == 'sqlite':
-            import sqlite3
-            conn = sqlite3.connect(self.db_name, timeout=60.0, isolation_level='DEFERRED')
-            conn.execute('PRAGMA journal_mode=WAL')
-            conn.execute('PRAGMA synchronous=NORMAL')
-            conn.execute('PRAGMA temp_store=MEMORY')
-            conn.execute('PRAGMA cache_size=-64000')  # 64MB cache
-            cursor = conn.cursor()
-        else:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+        row_chunks: iterable (generator) من lists فيها (رقم الصف، dict الصف) - زي
+        ExcelSheet.chunks(). IDs البراندات والأنواع والألوان والـ Tags والمنتجات بتتحمل
+        في dicts مرة واحدة، والناقص منها بيتعمل للـ chunk كله مرة واحدة، وبعدين
+        المنتجات والألوان والصور والـ Tags بـ executemany (upserts). كل chunk بيتعمله
+        commit لوحده - لو فشل بيترجع rollback ويتعاد متقسم (_import_chunk_isolated) فالصفوف
+        اللي فيها المشكلة بس هي اللي بتتسجل كأخطاء.
+        
+        run_id (import_runs): الـ checkpoint والعدادات وأخطاء الصفوف بيتكتبوا في نفس
+        الـ transaction بتاعة كل chunk، والـ chunks اللي اتعملها commit قبل كده
+        بتتقري بس (عشان أول صف لكل منتج يفضل هو اللي بيحدد بياناته) ومش بتتكتب
+        تاني - فالـ resume بعد ما الـ worker يقع بيكمل من آخر checkpoint.
         
+        Delta import: الصفوف اللي الـ hash بتاعها زي المتخزن للـ variant مش بتتكتب -
+        النتيجة فيها inserted_count / updated_count / unchanged_count.
+        
+        تغييرات المخزون بتتسجل في stock_logs باسم username (أو اللي بدأ الـ run).
+        """
+        
+        # الـ pool بيطبق WAL و synchronous=NORMAL و cache_size على كل اتصال SQLite
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        started = time.time()
         success_count = 0
+        delta_counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
         failed_products = []
         processed_products = {}
         created_brands = []
         created_colors = []
         created_types = []
-        
-        # معالجة البيانات في دفعات أكبر
-        BATCH_SIZE = 100
+        total_rows = 0
+        resumed_rows = 0
         
         try:
-            for batch_start in range(0, len(excel_data), BATCH_SIZE):
-                batch_end = min(batch_start + BATCH_SIZE, len(excel_data))
-                batch_data = excel_data[batch_start:batch_end]
+            maps = self._load_import_maps(cursor)
+            last_chunk = 0
+            if run_id is not None:
+                cursor.execute('SELECT last_chunk, username FROM import_runs WHERE id = ?', (run_id,))
+                last_chunk, run_username = cursor.fetchone()
+                username = run_username or username
+            
+            for chunk_number, batch_data in enumerate(row_chunks, 1):
+                batch_start = total_rows + 1
+                total_rows += len(batch_data)
                 
-                print(f"🔄 معالجة الدفعة {batch_start + 1}-{batch_end} من إجمالي {len(excel_data)}")
+                if chunk_number <= last_chunk:
+                    # اتعملها commit في محاولة سابقة - بيانات منتجاتها بس
+                    records, _ = self._parse_import_rows(batch_data)
+                    processed_products.update(self._import_product_fields(maps, processed_products, records))
+                    resumed_rows = total_rows
+                    continue
                 
-                for index, row in enumerate(batch_data, batch_start + 1):
-                    try:
-                        # تحويل جميع القيم إلى نصوص مع حماية من النوع float
-                        product_code = str(row.get('Product Code', '')).strip()
-                        brand_name = str(row.get('Brand Name', '')).strip()
-                        product_type_name = str(row.get('Product Type', '')).strip()
-                        color_name = str(row.get('Color Name', '')).strip()
-                        category = str(row.get('Category', '')).strip()
-                        size = str(row.get('Size', '')).strip()
-                        
-                        # معالجة الأسعار والأرقام بحذر
-                        try:
-                            wholesale_price = float(row.get('Wholesale Price', 0))
-                            retail_price = float(row.get('Retail Price', 0))
-                            initial_stock = int(row.get('Stock', 0))
-                        except (ValueError, TypeError):
-                            wholesale_price = 0.0
-                            retail_price = 0.0
-                            initial_stock = 0
-                        
-                        tags = str(row.get('Tags', '')).strip()
-                        image_url = str(row.get('Image URL', '')).strip()
-                        
-                        # التحقق من البيانات الأساسية المطلوبة
-                        if not product_code or not brand_name or not color_name:
-                            failed_products.append({
-                                'row': index,
-                                'product_code': product_code,
-                                'error': 'Missing required data (Product Code, Brand Name, or Color Name)'
-                            })
-                            continue
-                        
-                        # البحث عن أو إنشاء Brand
-                        cursor.execute('SELECT id FROM brands WHERE brand_name = ?', (brand_name,))
-                        brand_result = cursor.fetchone()
-                        if not brand_result:
-                            cursor.execute('INSERT INTO brands (brand_name) VALUES (?)', (brand_name,))
-                            brand_id = cursor.lastrowid
-                            if brand_name not in created_brands:
-                                created_brands.append(brand_name)
-                        else:
-                            brand_id = brand_result[0]
-                        
-                        # البحث عن أو إنشاء Product Type
-                        cursor.execute('SELECT id FROM product_types WHERE type_name = ?', (product_type_name,))
-                        type_result = cursor.fetchone()
-                        if not type_result:
-                            cursor.execute('INSERT INTO product_types (type_name) VALUES (?)', (product_type_name,))
-                            product_type_id = cursor.lastrowid
-                            if product_type_name not in created_types:
-                                created_types.append(product_type_name)
-                        else:
-                            product_type_id = type_result[0]
-                        
-                        # البحث عن أو إنشاء Color
-                        cursor.execute('SELECT id FROM colors WHERE color_name = ?', (color_name,))
-                        color_result = cursor.fetchone()
-                        if not color_result:
-                            default_color_codes = {
-                                'black': '#000000', 'white': '#FFFFFF', 'red': '#FF0000',
-                                'blue': '#0000FF', 'green': '#008000', 'yellow': '#FFFF00',
-                                'brown': '#8B4513', 'pink': '#FFC0CB', 'purple': '#800080',
-                                'orange': '#FFA500', 'gray': '#808080', 'grey': '#808080',
-                                'gold': '#FFD700', 'silver': '#C0C0C0', 'navy': '#000080',
-                                'beige': '#F5F5DC', 'maroon': '#800000'
-                            }
-                            color_code = default_color_codes.get(color_name.lower(), '#FFFFFF')
-                            cursor.execute('INSERT INTO colors (color_name, color_code) VALUES (?, ?)',
-                                        (color_name, color_code))
-                            color_id = cursor.lastrowid
-                            if color_name not in created_colors:
-                                created_colors.append(color_name)
-                        else:
-                            color_id = color_result[0]
-                        
-                        # إنشاء أو تحديث المنتج الأساسي
-                        product_key = f"{product_code}_{brand_id}_{category}"
-                        
-                        if product_key not in processed_products:
-                            cursor.execute('''
-                                SELECT id FROM base_products
-                                WHERE product_code = ? AND brand_id = ? AND trader_category = ?
-                            ''', (product_code, brand_id, category))
-                            
-                            existing = cursor.fetchone()
-                            
-                            if existing:
-                                base_product_id = existing[0]
-                                cursor.execute('''
-                                    UPDATE base_products
-                                    SET product_type_id = ?, product_size = ?,
-                                        wholesale_price = ?, retail_price = ?
-                                    WHERE id = ?
-                                ''', (product_type_id, size, wholesale_price, retail_price, base_product_id))
-                            else:
-                                cursor.execute('''
-                                    INSERT INTO base_products
-                                    (product_code, brand_id, product_type_id, trader_category,
-                                    product_size, wholesale_price, retail_price, supplier_id)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?, 1)
-                                ''', (product_code, brand_id, product_type_id, category,
-                                    size, wholesale_price, retail_price))
-                                base_product_id = cursor.lastrowid
-                            
-                            processed_products[product_key] = base_product_id
-                        else:
-                            base_product_id = processed_products[product_key]
-                        
-                        # إضافة أو تحديث variant اللون
-                        cursor.execute('''
-                            SELECT id, current_stock FROM product_variants
-                            WHERE base_product_id = ? AND color_id = ?
-                        ''', (base_product_id, color_id))
-                        
-                        variant_result = cursor.fetchone()
-                        
-                        if variant_result:
-                            variant_id = variant_result[0]
-                            cursor.execute('''
-                                UPDATE product_variants
-                                SET current_stock = ?
-                                WHERE id = ?
-                            ''', (initial_stock, variant_id))
-                        else:
-                            cursor.execute('''
-                                INSERT INTO product_variants (base_product_id, color_id, current_stock)
-                                VALUES (?, ?, ?)
-                            ''', (base_product_id, color_id, initial_stock))
-                            variant_id = cursor.lastrowid
-                        
-                        # حفظ لينك الصورة مباشرة (داخل نفس الـ transaction)
-                        if image_url and image_url.lower() not in ['nan', 'none', '']:
-                            try:
-                                cursor.execute('''
-                                    INSERT OR REPLACE INTO color_images (variant_id, image_url)
-                                    VALUES (?, ?)
-                                ''', (variant_id, image_url))
-                            except Exception as img_error:
-                                print(f"⚠️ فشل حفظ صورة {color_name}: {img_error}")
-                        
-                        # معالجة Tags
-                        if tags and tags.lower() not in ['nan', 'none', '']:
-                            tag_list = [t.strip() for t in tags.split(',') if t.strip()]
-                            for tag_name in tag_list:
-                                cursor.execute('SELECT id FROM tags WHERE tag_name = ?', (tag_name,))
-                                tag_result = cursor.fetchone()
-                                if tag_result:
-                                    tag_id = tag_result[0]
-                                    try:
-                                        cursor.execute('''
-                                            INSERT OR IGNORE INTO product_tags (product_id, tag_id)
-                                            VALUES (?, ?)
-                                        ''', (base_product_id, tag_id))
-                                    except:
-                                        pass
-                        
-                        success_count += 1
-                        
-                    except Exception as e:
-                        failed_products.append({
-                            'row': index,
-                            'product_code': product_code if 'product_code' in locals() else 'Unknown',
-                            'error': str(e)
-                        })
-                        continue
+                print(f"🔄 معالجة الدفعة {batch_start}-{total_rows}")
                 
-                # Commit بعد كل دفعة
+                try:
+                    if not self._checkpoint_import_run(cursor, run_id, chunk_number, len(batch_data)):
+                        raise ImportRunConflict(run_id)
+                    counts, failed, created, product_fields = self._import_chunk(
+                        cursor, maps, processed_products, batch_data, username)
+                    self._record_import_chunk(cursor, run_id, counts, failed)
+                    # Commit بعد كل دفعة
+                    conn.commit()
+                except ImportRunConflict:
+                    raise
+                except Exception as e:
+                    conn.rollback()
+                    print(f"⚠️ فشل حفظ الدفعة {batch_start}-{total_rows} مرة واحدة: {e} - بنقسمها")
+                    # الـ IDs اللي اتعملت في الدفعة اترجعت - نحمّل الـ maps من جديد
+                    maps = self._load_import_maps(cursor)
+                    if not self._checkpoint_import_run(cursor, run_id, chunk_number, len(batch_data)):
+                        raise ImportRunConflict(run_id)
+                    counts, failed, created, product_fields = self._import_chunk_isolated(
+                        cursor, maps, processed_products, batch_data, username)
+                    self._record_import_chunk(cursor, run_id, counts, failed)
+                    conn.commit()
+                
+                success_count += counts['imported']
+                for name in delta_counts:
+                    delta_counts[name] += counts[name]
+                failed_products.extend(failed)
+                processed_products.update(product_fields)
+                created_brands.extend(created['brands'])
+                created_types.extend(created['types'])
+                created_colors.extend(created['colors'])
+                print(f"✅ تم حفظ الدفعة {batch_start}-{total_rows}")
+            
+            if run_id is not None:
+                cursor.execute('''
+                    UPDATE import_runs
+                    SET status = 'completed', total_rows = ?, updated_date = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (total_rows, run_id))
                 conn.commit()
-                print(f"✅ تم حفظ الدفعة {batch_start + 1}-{batch_end}")
+                # العدادات والأخطاء للـ run كلها مش للمحاولة دي بس
+                cursor.execute('''
+                    SELECT success_count, inserted_count, updated_count, unchanged_count
+                    FROM import_runs WHERE id = ?
+                ''', (run_id,))
+                success_count, *run_counts = cursor.fetchone()
+                delta_counts = dict(zip(('inserted', 'updated', 'unchanged'), run_counts))
+                failed_products = self._get_import_run_errors(cursor, run_id)
             
             conn.close()
             
+            elapsed = time.time() - started
+            processed_rows = total_rows - resumed_rows
+            rows_per_second = round(processed_rows / elapsed, 1) if elapsed > 0 else 0
+            print(f"⚡ Imported {processed_rows} rows in {elapsed:.2f}s ({rows_per_second} rows/sec) - "
+                  f"{delta_counts['inserted']} inserted, {delta_counts['updated']} updated, "
+                  f"{delta_counts['unchanged']} unchanged")
+            
             return {
                 'success': True,
+                'total_rows': total_rows,
+                'resumed_rows': resumed_rows,
                 'success_count': success_count,
+                'inserted_count': delta_counts['inserted'],
+                'updated_count': delta_counts['updated'],
+                'unchanged_count': delta_counts['unchanged'],
                 'failed_count': len(failed_products),
                 'failed_products': failed_products,
                 'created_brands': created_brands,
                 'created_colors': created_colors,
-                'created_types': created_types
+                'created_types': created_types,
+                'elapsed': round(elapsed, 2),
+                'rows_per_second': rows_per_second
             }
             
         except Exception as e:
@@ -2249,29 +3065,636 @@ class StockDatabase:
             return {
                 'success': False,
                 'error': str(e),
+                'total_rows': total_rows,
                 'success_count': 0,
-                'failed_count': len(excel_data)
+                'failed_count': total_rows
             }
+        finally:
+            # براندات / ألوان / أنواع جديدة اتضافت أثناء الرفع
+            if created_brands or created_colors or created_types:
+                self.catalog.invalidate()
+    
+    # === IMPORT RUNS ===
+    
+    def create_import_run(self, file_name, file_hash, chunk_size, total_rows=None, username=None):
+        """import run جديدة لملف مرفوع - Returns id"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO import_runs (file_name, file_hash, chunk_size, total_rows, username)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (file_name, file_hash, chunk_size, total_rows, username))
+        run_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return run_id
+    
+    def _import_runs(self, where, params):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT id, file_name, file_hash, chunk_size, total_rows, last_chunk, processed_rows,
+                   success_count, failed_count, inserted_count, updated_count, unchanged_count,
+                   status, username, created_date, updated_date
+            FROM import_runs
+            WHERE {where}
+            ORDER BY id DESC
+        ''', params)
+        columns = [column[0] for column in cursor.description]
+        runs = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        conn.close()
+        return runs
+    
+    def get_import_run(self, run_id):
+        runs = self._import_runs('id = ?', (run_id,))
+        return runs[0] if runs else None
+    
+    def get_unfinished_import_run(self, file_hash):
+        """آخر run لسه ما خلصتش لنفس الملف (بالـ sha256) - None لو مفيش"""
+        runs = self._import_runs("file_hash = ? AND status = 'running'", (file_hash,))
+        return runs[0] if runs else None
+    
+    def get_unfinished_import_runs(self):
+        return self._import_runs("status = 'running'", ())
+    
+    def cancel_import_run(self, run_id):
+        """الـ run مش هتتعملها resume - اللي اتحفظ منها بيفضل زي ما هو"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE import_runs SET status = 'cancelled', updated_date = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'running'
+        ''', (run_id,))
+        cancelled = cursor.rowcount > 0
+        conn.commit()
+        conn.close()
+        return cancelled
+    
+    def _checkpoint_import_run(self, cursor, run_id, chunk_number, rows):
+        """
+        نقل الـ checkpoint للـ chunk دي جوه الـ transaction بتاعتها (compare-and-set)
+        
+        False لو الـ chunk اتعملت في مكان تاني (worker تاني بيكمل نفس الـ run) أو
+        الـ run اتلغت - ساعتها الدفعة لازم تترجع rollback.
+        """
+        if run_id is None:
+            return True
+        cursor.execute('''
+            UPDATE import_runs
+            SET last_chunk = ?, processed_rows = processed_rows + ?, updated_date = CURRENT_TIMESTAMP
+            WHERE id = ? AND last_chunk = ? AND status = 'running'
+        ''', (chunk_number, rows, run_id, chunk_number - 1))
+        return cursor.rowcount > 0
+    
+    def _record_import_chunk(self, cursor, run_id, counts, failed):
+        """عدادات الـ chunk (_import_chunk) وأخطاء صفوفها في نفس الـ transaction"""
+        if run_id is None:
+            return
+        cursor.execute('''
+            UPDATE import_runs
+            SET success_count = success_count + ?, failed_count = failed_count + ?,
+                inserted_count = inserted_count + ?, updated_count = updated_count + ?,
+                unchanged_count = unchanged_count + ?
+            WHERE id = ?
+        ''', (counts['imported'], len(failed), counts.get('inserted', 0), counts.get('updated', 0),
+              counts.get('unchanged', 0), run_id))
+        if failed:
+            cursor.executemany('''
+                INSERT INTO import_run_errors (run_id, row_number, product_code, error)
+                VALUES (?, ?, ?, ?)
+            ''', [(run_id, item['row'], item['product_code'], item['error']) for item in failed])
+    
+    def _get_import_run_errors(self, cursor, run_id):
+        cursor.execute('''
+            SELECT row_number, product_code, error FROM import_run_errors
+            WHERE run_id = ?
+            ORDER BY row_number, id
+        ''', (run_id,))
+        return [{'row': row_number, 'product_code': product_code, 'error': error}
+                for row_number, product_code, error in cursor.fetchall()]
+    
+    def _load_import_maps(self, cursor):
+        """dicts الأسماء -> IDs (brands / product_types / colors / tags) والمنتجات (code, brand_id, category) -> id"""
+        maps = {}
+        for table, column in (('brands', 'brand_name'), ('product_types', 'type_name'),
+                              ('colors', 'color_name'), ('tags', 'tag_name')):
+            cursor.execute(f'SELECT id, {column} FROM {table}')
+            maps[table] = {name: row_id for row_id, name in cursor.fetchall()}
+        
+        # لو في منتجين بنفس المفتاح الأقدم هو اللي بيتحدث
+        cursor.execute('SELECT id, product_code, brand_id, trader_category FROM base_products ORDER BY id')
+        maps['products'] = {}
+        for row_id, product_code, brand_id, category in cursor.fetchall():
+            maps['products'].setdefault((product_code, brand_id, category), row_id)
+        return maps
+    
+    def _create_import_names(self, cursor, names_map, table, column, names, extra_column=None, extra_value=None):
+        """إضافة الأسماء الناقصة من names لجدول dimension مرة واحدة وتحديث names_map - Returns الأسماء الجديدة"""
+        missing = sorted(name for name in set(names) if name not in names_map)
+        if not missing:
+            return []
+        
+        if extra_column:
+            cursor.executemany(f'INSERT INTO {table} ({column}, {extra_column}) VALUES (?, ?)',
+                               [(name, extra_value(name)) for name in missing])
+        else:
+            cursor.executemany(f'INSERT INTO {table} ({column}) VALUES (?)', [(name,) for name in missing])
+        
+        for start in range(0, len(missing), IN_BATCH_SIZE):
+            chunk = missing[start:start + IN_BATCH_SIZE]
+            placeholders = ', '.join('?' for _ in chunk)
+            cursor.execute(f'SELECT id, {column} FROM {table} WHERE {column} IN ({placeholders})', chunk)
+            names_map.update((name, row_id) for row_id, name in cursor.fetchall())
+        return missing
+    
+    def _parse_import_rows(self, batch_data):
+        """صفوف الـ Excel -> (records صالحة، أخطاء الصفوف الناقصة)"""
+        records = []
+        failed_products = []
+        for index, row in batch_data:
+            # تحويل جميع القيم إلى نصوص مع حماية من النوع float
+            product_code = str(row.get('Product Code', '')).strip()
+            brand_name = str(row.get('Brand Name', '')).strip()
+            product_type_name = str(row.get('Product Type', '')).strip()
+            color_name = str(row.get('Color Name', '')).strip()
+            category = str(row.get('Category', '')).strip()
+            size = str(row.get('Size', '')).strip()
+            
+            # معالجة الأسعار والأرقام بحذر
+            try:
+                wholesale_price = float(row.get('Wholesale Price', 0))
+                retail_price = float(row.get('Retail Price', 0))
+                initial_stock = int(row.get('Stock', 0))
+            except (ValueError, TypeError):
+                wholesale_price = 0.0
+                retail_price = 0.0
+                initial_stock = 0
+            
+            # قيمة برا حدود الأعمدة كانت بتوقع الدفعة كلها - خطأ للصف ده بس
+            if (abs(initial_stock) > IMPORT_MAX_STOCK
+                    or not all(math.isfinite(price) and abs(price) < IMPORT_MAX_PRICE
+                               for price in (wholesale_price, retail_price))):
+                failed_products.append({
+                    'row': index,
+                    'product_code': product_code,
+                    'error': 'Stock or price out of range'
+                })
+                continue
+            
+            tags = str(row.get('Tags', '')).strip()
+            image_url = str(row.get('Image URL', '')).strip()
+            
+            # التحقق من البيانات الأساسية المطلوبة
+            if not product_code or not brand_name or not color_name:
+                failed_products.append({
+                    'row': index,
+                    'product_code': product_code,
+                    'error': 'Missing required data (Product Code, Brand Name, or Color Name)'
+                })
+                continue
+            
+            tag_list = []
+            if tags and tags.lower() not in ['nan', 'none', '']:
+                tag_list = [t.strip() for t in tags.split(',') if t.strip()]
+            if image_url.lower() in ['nan', 'none', '']:
+                image_url = ''
+            
+            records.append((product_code, brand_name, product_type_name, color_name, category, size,
+                            wholesale_price, retail_price, initial_stock, tag_list, image_url))
+        
+        return records, failed_products
+    
+    def _import_product_fields(self, maps, processed_products, records):
+        """{(code, brand_id, category): (type_id, size, wholesale, retail)} لأول صف لكل منتج ما اتشافش قبل كده في الملف"""
+        product_fields = {}
+        for record in records:
+            key = (record[0], maps['brands'].get(record[1]), record[4])
+            if key not in processed_products and key not in product_fields:
+                product_fields[key] = (maps['product_types'].get(record[2]), record[5], record[6], record[7])
+        return product_fields
+    
+    def _import_chunk_isolated(self, cursor, maps, processed_products, batch_data, username='Admin'):
+        """
+        _import_chunk لدفعة فشلت مرة واحدة: بتتقسم نصين لحد ما الصفوف اللي بتوقعها تبان
+        
+        كل جزء بيتكتب جوه SAVEPOINT - الجزء اللي بيفشل بيترجع لوحده ويتقسم تاني، والصف
+        اللي بيفشل لوحده بيتسجل خطأ. الكل بيتعمله commit مع الـ checkpoint بتاع الدفعة.
+        نفس الـ Returns بتاعة _import_chunk.
+        """
+        counts = {'imported': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0}
+        failed_products = []
+        created = {'brands': [], 'types': [], 'colors': []}
+        product_fields = {}
+        pending = [batch_data]
+        while pending:
+            part = pending.pop(0)
+            cursor.execute('SAVEPOINT import_part')
+            try:
+                part_counts, part_failed, part_created, part_fields = self._import_chunk(
+                    cursor, maps, ChainMap(product_fields, processed_products), part, username)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO SAVEPOINT import_part')
+                cursor.execute('RELEASE SAVEPOINT import_part')
+                maps.update(self._load_import_maps(cursor))
+                if len(part) > 1:
+                    middle = len(part) // 2
+                    pending[:0] = [part[:middle], part[middle:]]
+                else:
+                    index, row = part[0]
+                    failed_products.append({
+                        'row': index,
+                        'product_code': str(row.get('Product Code', '')).strip() or 'Unknown',
+                        'error': str(e)
+                    })
+                continue
+            cursor.execute('RELEASE SAVEPOINT import_part')
+            for name in counts:
+                counts[name] += part_counts[name]
+            failed_products.extend(part_failed)
+            for name in created:
+                created[name].extend(part_created[name])
+            product_fields.update(part_fields)
+        
+        failed_products.sort(key=lambda item: item['row'])
+        return counts, failed_products, created, product_fields
+    
+    def _import_chunk(self, cursor, maps, processed_products, batch_data, username='Admin'):
+        """
+        صفوف دفعة واحدة من الـ Excel في الداتابيز بعدد ثابت من الاستعلامات
+        
+        processed_products: {مفتاح المنتج: بياناته} للمنتجات اللي اتشافت في الملف قبل
+        الدفعة دي - أول صف لكل منتج في الملف هو اللي بيحدد بياناته زي قبل كده.
+        
+        Delta: hash كل صف (excel_import.content_hash) بيتقارن بالـ hash المتخزن
+        للـ variant، والصفوف اللي ما اتغيرتش مش بتتكتب خالص. المنتج نفسه بيتحدث بس
+        لو الـ hash بتاعه (excel_import.product_hash) اتغير - مهما كانت ألوانه في
+        أنهي دفعة.
+        
+        كل variant المخزون بتاعه اتغير بيتسجله صف في stock_logs في نفس الـ transaction
+        (باسم username) - عشان المخزون في تاريخ قديم (stock_history) يفضل صح بعد الرفع.
+        
+        Returns (الأعداد {'imported', 'inserted', 'updated', 'unchanged'}، الأخطاء،
+        الأسماء الجديدة، بيانات المنتجات اللي اتشافت لأول مرة)
+        """
+        # الـ triggers بتتأجل - الـ summary ومستندات البحث بيتحدثوا مرة واحدة للدفعة
+        self.defer_triggers(cursor)
+        
+        records, failed_products = self._parse_import_rows(batch_data)
+        
+        # البراندات والأنواع والألوان الناقصة - مرة واحدة للدفعة
+        created = {
+            'brands': self._create_import_names(cursor, maps['brands'], 'brands', 'brand_name',
+                                                [record[1] for record in records]),
+            'types': self._create_import_names(cursor, maps['product_types'], 'product_types', 'type_name',
+                                               [record[2] for record in records]),
+            'colors': self._create_import_names(cursor, maps['colors'], 'colors', 'color_name',
+                                                [record[3] for record in records], 'color_code',
+                                                lambda name: IMPORT_COLOR_CODES.get(name.lower(), '#FFFFFF')),
+        }
+        
+        # المنتجات الأساسية: أول صف لكل (code, brand, category) في الملف بيحدّث أو يضيف
+        products = maps['products']
+        product_fields = self._import_product_fields(maps, processed_products, records)
+        
+        # hash كل صف ببيانات المنتج الفعلية (من أول صف ليه في الملف)
+        rows = []
+        for record in records:
+            key = (record[0], maps['brands'][record[1]], record[4])
+            tag_ids = [maps['tags'][tag_name] for tag_name in record[9] if tag_name in maps['tags']]
+            fields = product_fields.get(key) or processed_products[key]
+            rows.append((key, maps['colors'][record[3]], record, tag_ids,
+                         excel_import.content_hash(fields, record[8], record[10], tag_ids)))
+        
+        # الـ variants الموجودة والـ hash المتخزن ليها - استعلام واحد لكل IN_BATCH_SIZE منتج
+        variant_ids = {}
+        stored_hashes = {}
+        existing_products = sorted({products[row[0]] for row in rows if row[0] in products})
+        for start in range(0, len(existing_products), IN_BATCH_SIZE):
+            chunk = existing_products[start:start + IN_BATCH_SIZE]
+            placeholders = ', '.join('?' for _ in chunk)
+            cursor.execute(f'''
+                SELECT pv.id, pv.base_product_id, pv.color_id, h.content_hash
+                FROM product_variants pv
+                LEFT JOIN variant_import_hashes h ON h.variant_id = pv.id
+                WHERE pv.base_product_id IN ({placeholders})
+            ''', chunk)
+            for row_id, product_id, color_id, stored_hash in cursor.fetchall():
+                variant_ids[(product_id, color_id)] = row_id
+                stored_hashes[row_id] = stored_hash
+        
+        counts = {'imported': len(records), 'inserted': 0, 'updated': 0, 'unchanged': 0}
+        changed_variants = set()
+        for key, color_id, record, tag_ids, row_hash in rows:
+            variant_id = variant_ids.get((products[key], color_id)) if key in products else None
+            if variant_id is None:
+                counts['inserted'] += 1
+                changed_variants.add((key, color_id))
+            elif stored_hashes[variant_id] == row_hash:
+                counts['unchanged'] += 1
+            else:
+                counts['updated'] += 1
+                changed_variants.add((key, color_id))
+        
+        # المنتج بيتحدث بس لو الـ hash المتخزن لبياناته مختلف - مش بيعتمد على ألوانه
+        product_hashes = {key: excel_import.product_hash(fields) for key, fields in product_fields.items()}
+        stored_product_hashes = {}
+        known_products = sorted({products[key] for key in product_fields if key in products})
+        for start in range(0, len(known_products), IN_BATCH_SIZE):
+            chunk = known_products[start:start + IN_BATCH_SIZE]
+            placeholders = ', '.join('?' for _ in chunk)
+            cursor.execute(f'SELECT product_id, content_hash FROM product_import_hashes WHERE product_id IN ({placeholders})',
+                           chunk)
+            stored_product_hashes.update(cursor.fetchall())
+        updated_products = {products[key] for key in product_fields
+                            if key in products and stored_product_hashes.get(products[key]) != product_hashes[key]}
+        written_keys = {key for key, _ in changed_variants}
+        
+        # المنتجات الموجودة اللي الدفعة هتكتبها بتطلع من الـ summary قبل الكتابة وترجع بعدها
+        self._apply_summary(cursor, updated_products | {products[key] for key in written_keys if key in products}, -1)
+        
+        updates = [(*fields, products[key]) for key, fields in product_fields.items()
+                   if key in products and products[key] in updated_products]
+        inserts_keys = {key for key in product_fields if key not in products}
+        inserts = [(key[0], key[1], fields[0], key[2], *fields[1:])
+                   for key, fields in product_fields.items() if key in inserts_keys]
+        if updates:
+            cursor.executemany('''
+                UPDATE base_products
+                SET product_type_id = ?, product_size = ?,
+                    wholesale_price = ?, retail_price = ?
+                WHERE id = ?
+            ''', updates)
+        if inserts:
+            cursor.executemany('''
+                INSERT INTO base_products
+                (product_code, brand_id, product_type_id, trader_category,
+                product_size, wholesale_price, retail_price, supplier_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+            ''', inserts)
+            new_codes = sorted({row[0] for row in inserts})
+            for start in range(0, len(new_codes), IN_BATCH_SIZE):
+                chunk = new_codes[start:start + IN_BATCH_SIZE]
+                placeholders = ', '.join('?' for _ in chunk)
+                cursor.execute(f'''
+                    SELECT id, product_code, brand_id, trader_category FROM base_products
+                    WHERE product_code IN ({placeholders}) ORDER BY id
+                ''', chunk)
+                for row_id, product_code, brand_id, category in cursor.fetchall():
+                    products.setdefault((product_code, brand_id, category), row_id)
+        
+        # hash المنتجات اللي اتكتبت - الـ trigger بيمسحه مع أي تعديل تاني على المنتج
+        new_product_hashes = [(products[key], product_hashes[key]) for key in product_fields
+                              if key in inserts_keys or products[key] in updated_products]
+        if new_product_hashes:
+            cursor.executemany('''
+                INSERT INTO product_import_hashes (product_id, content_hash)
+                VALUES (?, ?)
+                ON CONFLICT (product_id) DO UPDATE SET content_hash = excluded.content_hash
+            ''', new_product_hashes)
+        
+        # ألوان المنتجات (variants) اللي اتغيرت بس: upsert على (base_product_id, color_id) - آخر صف بيكسب
+        variant_stock = {}
+        variant_records = {}
+        variant_hashes = {}
+        images = {}
+        product_tags = set()
+        for key, color_id, record, tag_ids, row_hash in rows:
+            if (key, color_id) not in changed_variants:
+                continue
+            variant_key = (products[key], color_id)
+            variant_stock[variant_key] = record[8]
+            variant_records[variant_key] = record
+            variant_hashes[variant_key] = row_hash
+            if record[10]:
+                images[variant_key] = record[10]
+            product_tags.update((products[key], tag_id) for tag_id in tag_ids)
+        touched_products = updated_products | {key[0] for key in variant_stock}
+        
+        if variant_stock:
+            # المخزون قبل الكتابة للـ stock logs (المنتجات اتقفلت في _apply_summary على PostgreSQL)
+            old_stock = {}
+            product_ids = sorted({key[0] for key in variant_stock})
+            for start in range(0, len(product_ids), IN_BATCH_SIZE):
+                chunk = product_ids[start:start + IN_BATCH_SIZE]
+                placeholders = ', '.join('?' for _ in chunk)
+                cursor.execute(f'''
+                    SELECT base_product_id, color_id, current_stock FROM product_variants
+                    WHERE base_product_id IN ({placeholders})
+                ''', chunk)
+                old_stock.update(((product_id, color_id), stock or 0)
+                                 for product_id, color_id, stock in cursor.fetchall())
+            
+            cursor.executemany('''
+                INSERT INTO product_variants (base_product_id, color_id, current_stock)
+                VALUES (?, ?, ?)
+                ON CONFLICT (base_product_id, color_id) DO UPDATE SET
+                    current_stock = excluded.current_stock
+            ''', [(*key, stock) for key, stock in variant_stock.items()])
+            
+            # IDs الـ variants الجديدة للصور والـ hashes والـ logs
+            for start in range(0, len(product_ids), IN_BATCH_SIZE):
+                chunk = product_ids[start:start + IN_BATCH_SIZE]
+                placeholders = ', '.join('?' for _ in chunk)
+                cursor.execute(f'''
+                    SELECT id, base_product_id, color_id FROM product_variants
+                    WHERE base_product_id IN ({placeholders})
+                ''', chunk)
+                variant_ids.update(((product_id, color_id), row_id)
+                                   for row_id, product_id, color_id in cursor.fetchall())
+            
+            cursor.executemany('''
+                INSERT INTO variant_import_hashes (variant_id, content_hash)
+                VALUES (?, ?)
+                ON CONFLICT (variant_id) DO UPDATE SET content_hash = excluded.content_hash
+            ''', [(variant_ids[key], row_hash) for key, row_hash in variant_hashes.items()])
+            
+            stock_logs = []
+            for key, stock in variant_stock.items():
+                if stock == old_stock.get(key, 0):
+                    continue
+                record = variant_records[key]
+                stock_logs.append(self._stock_log_row(
+                    'Excel Import', key[0], variant_ids[key], record[0], record[1], record[2],
+                    record[3], record[10], old_stock.get(key, 0), stock,
+                    username, 'Excel bulk upload', 'Bulk Upload Excel'))
+            if stock_logs:
+                cursor.executemany(STOCK_LOG_INSERT, stock_logs)
+        
+        # حفظ لينكات الصور (داخل نفس الـ transaction)
+        if images:
+            cursor.executemany('''
+                INSERT INTO color_images (variant_id, image_url)
+                VALUES (?, ?)
+                ON CONFLICT (variant_id) DO UPDATE SET image_url = excluded.image_url
+            ''', [(variant_ids[key], image_url) for key, image_url in images.items()])
+        
+        # معالجة Tags (الموجودة بس زي قبل كده)
+        if product_tags:
+            cursor.executemany('''
+                INSERT OR IGNORE INTO product_tags (product_id, tag_id)
+                VALUES (?, ?)
+            ''', sorted(product_tags))
+        
+        self._apply_summary(cursor, touched_products, 1)
+        self.refresh_search_documents(cursor, touched_products)
+        self.resume_triggers(cursor)
+        
+        return counts, failed_products, created, product_fields
     
     # ==========================================
     # DASHBOARD ANALYTICS
     # ==========================================
     
+    def get_total_products_count(self):
+        """Number of base products (from the inventory summary)"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT product_count FROM inventory_summary WHERE scope = 'total'")
+            row = cursor.fetchone()
+            conn.close()
+            return row[0] if row else 0
+        except Exception as e:
+            print(f"Error getting total products count: {e}")
+            if 'conn' in locals():
+                conn.close()
+            return 0
+    
+    def rebuild_inventory_summary(self):
+        """إعادة حساب جداول ملخص المخزون من الصفر (صيانة / إصلاح)"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            inventory_summary.rebuild(cursor)
+            conn.commit()
+            conn.close()
+            print("✅ Inventory summary rebuilt")
+            return True
+        except Exception as e:
+            print(f"❌ Error rebuilding inventory summary: {e}")
+            if 'conn' in locals():
+                conn.close()
+            return False
+    
+    def archive_old_logs(self, days=LOG_ARCHIVE_DAYS, upload=None):
+        """
+        نقل الـ logs الأقدم من days يوم (شهور كاملة) لملفات الأرشيف الشهرية (log_archive)
+        
+        كل شهر بيتكتب في الـ segment بتاعه الأول وبعدين يتمسح من stock_logs في
+        transaction لوحده - إحصائيات الـ logs بتفضل تعدّه.
+        الـ segment هو النسخة الوحيدة من الـ logs دي، فالمسح بيحصل بس لو مجلد الأرشيف
+        على disk دايم (LOG_ARCHIVE_DIR) أو upload(path) رفع الـ segment والـ manifest
+        ورجّع True - غير كده الـ logs بتفضل في stock_logs.
+        run واحدة بس في نفس الوقت (log_archive_lock) - لو فيه run شغالة بترجع على طول،
+        والإحصائيات بتعدّ بس الصفوف اللي اتمسحت فعلاً.
+        Returns list بالملفات اللي اتكتبت (segments + manifest)
+        """
+        written = []
+        if not self.log_archive.persistent and upload is None:
+            print("⚠️ Log archiving skipped: set LOG_ARCHIVE_DIR to a persistent disk or connect Dropbox")
+            return written
+        owner = uuid.uuid4().hex
+        try:
+            self.flush_stock_logs()
+            cutoff = archive_cutoff(days).strftime('%Y-%m-%d %H:%M:%S')
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            locked = log_archive.acquire_lock(cursor, owner)
+            conn.commit()
+            if not locked:
+                conn.close()
+                print("⏳ Log archiving skipped: another archive run is in progress")
+                return written
+            
+            try:
+                cursor.execute('SELECT MIN(created_date) FROM stock_logs WHERE created_date < ?', (cutoff,))
+                first = cursor.fetchone()[0]
+                month = str(first)[:7] if first else None
+                
+                while month and month_range(month)[0] < cutoff:
+                    month_start, month_end = month_range(month)
+                    cursor.execute('''
+                        SELECT * FROM stock_logs
+                        WHERE created_date >= ? AND created_date < ?
+                        ORDER BY created_date, id
+                    ''', (month_start, month_end))
+                    columns = [column[0] for column in cursor.description]
+                    rows = cursor.fetchall()
+                    conn.rollback()
+                    
+                    if rows:
+                        paths = self.log_archive.write_month(month, columns, rows, cutoff)
+                        written += paths
+                        if not self.log_archive.persistent and not all([upload(path) for path in paths]):
+                            print(f"⚠️ Log archive of {month} is not backed up - its logs stay in stock_logs")
+                            break
+                        
+                        # الـ lease أول statement في الـ transaction - بعدها الصفوف ما بتتغيرش
+                        if not log_archive.renew_lock(cursor, owner):
+                            conn.rollback()
+                            print("⚠️ Log archive lock was lost - stopping")
+                            break
+                        ids = [row[0] for row in rows]
+                        deleted = []
+                        for start in range(0, len(ids), IN_BATCH_SIZE):
+                            chunk = ids[start:start + IN_BATCH_SIZE]
+                            placeholders = ','.join('?' for _ in chunk)
+                            cursor.execute(f'SELECT * FROM stock_logs WHERE id IN ({placeholders})', chunk)
+                            deleted += cursor.fetchall()
+                        log_stats.count_rows(cursor, deleted)
+                        deleted_ids = [row[0] for row in deleted]
+                        for start in range(0, len(deleted_ids), IN_BATCH_SIZE):
+                            chunk = deleted_ids[start:start + IN_BATCH_SIZE]
+                            placeholders = ','.join('?' for _ in chunk)
+                            cursor.execute(f'DELETE FROM stock_logs WHERE id IN ({placeholders})', chunk)
+                        conn.commit()
+                        print(f"📦 Archived {len(deleted)} logs of {month}")
+                    month = month_end[:7]
+            finally:
+                conn.rollback()
+                log_archive.release_lock(cursor, owner)
+                conn.commit()
+            
+            conn.close()
+            return list(dict.fromkeys(written))
+        except Exception as e:
+            print(f"❌ Error archiving logs: {e}")
+            if 'conn' in locals():
+                conn.rollback()
+                conn.close()
+            return list(dict.fromkeys(written))
+    
+    def rebuild_log_stats(self):
+        """إعادة حساب إحصائيات الـ logs (log_stats / log_product_activity) من stock_logs والأرشيف"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            log_stats.rebuild(cursor)
+            for month in self.log_archive.months():
+                log_stats.count_rows(cursor, self.log_archive.read_segment(month))
+            conn.commit()
+            conn.close()
+            print("✅ Log stats rebuilt")
+            return True
+        except Exception as e:
+            print(f"❌ Error rebuilding log stats: {e}")
+            if 'conn' in locals():
+                conn.close()
+            return False
+    
     def get_total_stock_quantity(self):
         """Get total quantity of all products in stock"""
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT SUM(current_stock) 
-                FROM product_variants
-            ''')
+            cursor.execute("SELECT total_stock FROM inventory_summary WHERE scope = 'total'")
             
-            total = cursor.fetchone()[0]
+            row = cursor.fetchone()
             conn.close()
             
-            return total if total else 0
+            return row[0] if row and row[0] else 0
             
         except Exception as e:
             print(f"Error getting total stock quantity: {e}")
@@ -2433,16 +3856,13 @@ class StockDatabase:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            cursor.execute('''
-                SELECT SUM(bp.wholesale_price * pv.current_stock)
-                FROM product_variants pv
-                JOIN base_products bp ON pv.base_product_id = bp.id
-            ''')
+            cursor.execute("SELECT stock_value FROM inventory_summary WHERE scope = 'total'")
             
-            total = cursor.fetchone()[0]
+            row = cursor.fetchone()
             conn.close()
             
-            return float(total) if total else 0.0
+            # الـ deltas المتراكمة ممكن تسيب كسور صغيرة
+            return round(float(row[0]), 2) if row and row[0] else 0.0
             
         except Exception as e:
             print(f"Error getting total stock value: {e}")
@@ -2468,9 +3888,9 @@ class StockDatabase:
                 JOIN brands b ON bp.brand_id = b.id
                 WHERE DATE(al.timestamp) >= DATE('now', '-' || ? || ' days')
                 AND al.action IN ('Added', 'Removed', 'Stock Increased', 'Stock Decreased')
-                GROUP BY al.product_code, al.color_name
-                HAVING (additions + removals) > 0
-                ORDER BY (additions + removals) DESC, last_update DESC
+                GROUP BY al.product_code, b.brand_name, al.color_name
+                HAVING COUNT(*) > 0
+                ORDER BY COUNT(*) DESC, last_update DESC
                 LIMIT ?
             ''', (days, limit))
             
@@ -2493,11 +3913,11 @@ class StockDatabase:
             cursor.execute('''
                 SELECT 
                     b.brand_name,
-                    COUNT(DISTINCT bp.id) as product_count
-                FROM brands b
-                JOIN base_products bp ON b.id = bp.brand_id
-                GROUP BY b.id
-                ORDER BY product_count DESC
+                    s.product_count
+                FROM inventory_summary s
+                JOIN brands b ON s.summary_key = CAST(b.id AS TEXT)
+                WHERE s.scope = 'brand' AND s.product_count > 0
+                ORDER BY s.product_count DESC
                 LIMIT ?
             ''', (limit,))
             
@@ -2522,15 +3942,14 @@ class StockDatabase:
                     b.brand_name,
                     pt.type_name,
                     tc.category_name,
-                    SUM(pv.current_stock) as total_stock
-                FROM base_products bp
+                    pss.total_stock
+                FROM product_stock_summary pss
+                JOIN base_products bp ON pss.product_id = bp.id
                 JOIN brands b ON bp.brand_id = b.id
                 JOIN product_types pt ON bp.product_type_id = pt.id
                 JOIN trader_categories tc ON bp.trader_category = tc.category_code
-                JOIN product_variants pv ON bp.id = pv.base_product_id
-                GROUP BY bp.id
-                HAVING total_stock > 0
-                ORDER BY total_stock DESC
+                WHERE pss.total_stock > 0
+                ORDER BY pss.total_stock DESC
                 LIMIT ?
             ''', (limit,))
             
@@ -2553,11 +3972,11 @@ class StockDatabase:
             cursor.execute('''
                 SELECT 
                     tc.category_name,
-                    COUNT(bp.id) as product_count
-                FROM trader_categories tc
-                JOIN base_products bp ON tc.category_code = bp.trader_category
-                GROUP BY tc.category_code
-                ORDER BY product_count DESC
+                    s.product_count
+                FROM inventory_summary s
+                JOIN trader_categories tc ON s.summary_key = tc.category_code
+                WHERE s.scope = 'category' AND s.product_count > 0
+                ORDER BY s.product_count DESC
             ''')
             
             results = cursor.fetchall()
@@ -2576,41 +3995,23 @@ class StockDatabase:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            # Active brands
-            cursor.execute('''
-                SELECT COUNT(DISTINCT bp.brand_id)
-                FROM base_products bp
-            ''')
-            brands_count = cursor.fetchone()[0]
-            
-            # Active categories
+            # براندات / فئات / أنواع فيها منتجات وألوان فيها variants
             cursor.execute('''
-                SELECT COUNT(DISTINCT bp.trader_category)
-                FROM base_products bp
+                SELECT scope, COUNT(*)
+                FROM inventory_summary
+                WHERE scope IN ('brand', 'category', 'type', 'color')
+                  AND summary_key <> '' AND (product_count > 0 OR variant_count > 0)
+                GROUP BY scope
             ''')
-            categories_count = cursor.fetchone()[0]
-            
-            # Active product types
-            cursor.execute('''
-                SELECT COUNT(DISTINCT bp.product_type_id)
-                FROM base_products bp
-            ''')
-            types_count = cursor.fetchone()[0]
-            
-            # Active colors
-            cursor.execute('''
-                SELECT COUNT(DISTINCT pv.color_id)
-                FROM product_variants pv
-            ''')
-            colors_count = cursor.fetchone()[0]
+            counts = dict(cursor.fetchall())
             
             conn.close()
             
             return {
-                'brands': brands_count,
-                'categories': categories_count,
-                'types': types_count,
-                'colors': colors_count
+                'brands': counts.get('brand', 0),
+                'categories': counts.get('category', 0),
+                'types': counts.get('type', 0),
+                'colors': counts.get('color', 0)
             }
             
         except Exception as e:
@@ -2794,17 +4195,9 @@ class StockDatabase:
                 search_param = f'%{search}%'
                 params.extend([search_param, search_param, search_param])
             
-            if brand_filter:
-                query += " AND br.brand_name = ?"
-                params.append(brand_filter)
-            
-            if type_filter:
-                query += " AND pt.type_name = ?"
-                params.append(type_filter)
-            
-            if color_filter:
-                query += " AND c.color_name = ?"
-                params.append(color_filter)
+            dimension_sql, dimension_params = self._dimension_filter(brand_filter, type_filter, color_filter)
+            query += dimension_sql
+            params.extend(dimension_params)
             
             query += " ORDER BY br.brand_name, bp.product_code, c.color_name"
             query += " LIMIT ? OFFSET ?"
@@ -2849,17 +4242,9 @@ class StockDatabase:
                 search_param = f'%{search}%'
                 params.extend([search_param, search_param, search_param])
             
-            if brand_filter:
-                query += " AND br.brand_name = ?"
-                params.append(brand_filter)
-            
-            if type_filter:
-                query += " AND pt.type_name = ?"
-                params.append(type_filter)
-            
-            if color_filter:
-                query += " AND c.color_name = ?"
-                params.append(color_filter)
+            dimension_sql, dimension_params = self._dimension_filter(brand_filter, type_filter, color_filter)
+            query += dimension_sql
+            params.extend(dimension_params)
             
             cursor.execute(query, params)
             count = cursor.fetchone()[0]
@@ -2913,17 +4298,9 @@ class StockDatabase:
                 search_param = f'%{search}%'
                 params.extend([search_param, search_param, search_param, search_param])
             
-            if brand_filter:
-                query += ' AND br.brand_name = ?'
-                params.append(brand_filter)
-            
-            if type_filter:
-                query += ' AND pt.type_name = ?'
-                params.append(type_filter)
-            
-            if color_filter:
-                query += ' AND c.color_name = ?'
-                params.append(color_filter)
+            dimension_sql, dimension_params = self._dimension_filter(brand_filter, type_filter, color_filter)
+            query += dimension_sql
+            params.extend(dimension_params)
             
             query += ' ORDER BY br.brand_name, bp.product_code, c.color_name LIMIT ? OFFSET ?'
             params.extend([limit, offset])
@@ -2964,17 +4341,9 @@ class StockDatabase:
                 search_param = f'%{search}%'
                 params.extend([search_param, search_param, search_param, search_param])
             
-            if brand_filter:
-                query += ' AND br.brand_name = ?'
-                params.append(brand_filter)
-            
-            if type_filter:
-                query += ' AND pt.type_name = ?'
-                params.append(type_filter)
-            
-            if color_filter:
-                query += ' AND c.color_name = ?'
-                params.append(color_filter)
+            dimension_sql, dimension_params = self._dimension_filter(brand_filter, type_filter, color_filter)
+            query += dimension_sql
+            params.extend(dimension_params)
             
             cursor.execute(query, params)
             count = cursor.fetchone()[0]
@@ -3028,17 +4397,9 @@ class StockDatabase:
                 search_param = f'%{search}%'
                 params.extend([search_param, search_param, search_param, search_param])
             
-            if brand_filter:
-                query += " AND br.brand_name = ?"
-                params.append(brand_filter)
-            
-            if type_filter:
-                query += " AND pt.type_name = ?"
-                params.append(type_filter)
-            
-            if color_filter:
-                query += " AND c.color_name = ?"
-                params.append(color_filter)
+            dimension_sql, dimension_params = self._dimension_filter(brand_filter, type_filter, color_filter)
+            query += dimension_sql
+            params.extend(dimension_params)
             
             query += " ORDER BY br.brand_name, bp.product_code, c.color_name"
             query += " LIMIT ? OFFSET ?"
@@ -3432,20 +4793,12 @@ class StockDatabase:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            if self.db_type == 'postgresql':
-                cursor.execute('''
-                UPDATE barcode_sessions
-                SET status = 'cancelled'
-                WHERE status = 'active' 
-                AND created_at < NOW() - INTERVAL '%s hours'
-                ''', (hours,))
-            else:
-                cursor.execute('''
-                UPDATE barcode_sessions
-                SET status = 'cancelled'
-                WHERE status = 'active' 
-                AND created_at < datetime('now', '-' || ? || ' hours')
-                ''', (hours,))
+            cursor.execute('''
+            UPDATE barcode_sessions
+            SET status = 'cancelled'
+            WHERE status = 'active' 
+            AND created_at < datetime('now', '-' || ? || ' hours')
+            ''', (hours,))
             
             rows_affected = cursor.rowcount
             conn.commit()
@@ -3543,17 +4896,9 @@ class StockDatabase:
                 search_param = f'%{search}%'
                 params.extend([search_param, search_param, search_param, search_param])
             
-            if brand_filter:
-                query += " AND br.brand_name = ?"
-                params.append(brand_filter)
-            
-            if type_filter:
-                query += " AND pt.type_name = ?"
-                params.append(type_filter)
-            
-            if color_filter:
-                query += " AND c.color_name = ?"
-                params.append(color_filter)
+            dimension_sql, dimension_params = self._dimension_filter(brand_filter, type_filter, color_filter)
+            query += dimension_sql
+            params.extend(dimension_params)
             
             query += " ORDER BY br.brand_name, bp.product_code, c.color_name"
             query += " LIMIT ? OFFSET ?"
@@ -3691,6 +5036,8 @@ class StockDatabase:
                 (snapshot_date, total_quantity, total_value)
                 VALUES (?, ?, ?)
             ''', (today, total_qty, total_value))
+            snapshot_trends.refresh_rollups(cursor, since=today)
+            snapshot_trends.write_dimension_snapshot(cursor, today)
             
             conn.commit()
             conn.close()
@@ -3704,15 +5051,18 @@ class StockDatabase:
                 conn.close()
             return False
     
-    def get_stock_quantity_trend(self, days=30):
+    def backfill_snapshots(self, max_days=SNAPSHOT_BACKFILL_DAYS):
         """
-        Get stock quantity trend for specified period
+        تكملة الأيام الناقصة في stock_snapshots من stock_logs
         
-        Args:
-            days: Number of days (7/30/60/90/180/360) or 'lifetime'
+        snapshot اليوم D = المخزون الساعة 00:00 من D (زي ما الـ daily_snapshots thread بيسجله).
+        كل الأيام الناقصة من أول log (بحد أقصى max_days) بتتحسب مرة واحدة بالـ NumPy
+        وتتكتب في batch واحد - الأيام الموجودة ما بتتغيرش.
         
-        Returns:
-            dict with dates, quantities, missing_dates, has_data
+        رفع Excel قبل ما الـ imports تسجل stock logs غيّر المخزون من غير logs، فالأيام
+        اللي قبل آخر رفع زي ده مش بتتكمل (كانت هتتحسب بأرقام بعد الرفع وتفضل كده).
+        
+        Returns عدد الأيام اللي اتضافت
         """
         try:
             from datetime import timedelta
@@ -3720,150 +5070,136 @@ class StockDatabase:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            # Handle lifetime option
-            if days == 'lifetime':
-                cursor.execute('''
-                    SELECT snapshot_date, total_quantity
-                    FROM stock_snapshots
-                    ORDER BY snapshot_date ASC
-                ''')
-            else:
-                cursor.execute('''
-                    SELECT snapshot_date, total_quantity
-                    FROM stock_snapshots
-                    WHERE snapshot_date >= DATE('now', '-' || ? || ' days')
-                    ORDER BY snapshot_date ASC
-                ''', (days,))
-            
-            snapshots = {row[0]: row[1] for row in cursor.fetchall()}
-            conn.close()
+            cursor.execute('SELECT MIN(created_date) FROM stock_logs')
+            first_log = cursor.fetchone()[0]
+            if not first_log:
+                conn.close()
+                return 0
             
-            # Generate date range
             today = datetime.now().date()
+            first_log_date = datetime.strptime(str(first_log)[:10], '%Y-%m-%d').date()
+            start = max(first_log_date, today - timedelta(days=max_days - 1))
+            
+            cursor.execute("SELECT MIN(created_date) FROM stock_logs WHERE operation_type = 'Excel Import'")
+            first_import_log = cursor.fetchone()[0]
+            query = 'SELECT MAX(updated_date) FROM import_runs WHERE processed_rows > 0'
+            params = ()
+            if first_import_log:
+                query += ' AND updated_date < ?'
+                params = (first_import_log,)
+            cursor.execute(query, params)
+            unlogged_import = cursor.fetchone()[0]
+            if unlogged_import:
+                unlogged_date = datetime.strptime(str(unlogged_import)[:10], '%Y-%m-%d').date()
+                start = max(start, unlogged_date + timedelta(days=1))
+            
+            cursor.execute('SELECT snapshot_date FROM stock_snapshots WHERE snapshot_date >= ?',
+                           (start.strftime('%Y-%m-%d'),))
+            existing = {str(row[0])[:10] for row in cursor.fetchall()}
+            
+            missing = [start + timedelta(days=i) for i in range((today - start).days + 1)]
+            missing = [day for day in missing if day.strftime('%Y-%m-%d') not in existing]
+            if not missing:
+                conn.close()
+                return 0
             
-            if days == 'lifetime' and snapshots:
-                # Get first snapshot date
-                first_date = min(snapshots.keys())
-                first_date_obj = datetime.strptime(first_date, '%Y-%m-%d').date()
-                days_count = (today - first_date_obj).days + 1
-                all_dates = []
-                for i in range(days_count):
-                    date = (first_date_obj + timedelta(days=i)).strftime('%Y-%m-%d')
-                    all_dates.append(date)
-            else:
-                all_dates = []
-                for i in range(days-1, -1, -1):
-                    date = (today - timedelta(days=i)).strftime('%Y-%m-%d')
-                    all_dates.append(date)
+            cutoffs = [datetime.combine(day, datetime.min.time()) for day in missing]
+            quantities, values = daily_totals(self.stock_history, cursor, cutoffs)
             
-            # Build data arrays
-            dates = []
-            quantities = []
-            missing_dates = []
+            cursor.executemany('''
+                INSERT OR IGNORE INTO stock_snapshots
+                (snapshot_date, total_quantity, total_value)
+                VALUES (?, ?, ?)
+            ''', [(day.strftime('%Y-%m-%d'), int(qty), float(value))
+                  for day, qty, value in zip(missing, quantities, values)])
+            snapshot_trends.refresh_rollups(cursor, since=missing[0])
             
-            for date in all_dates:
-                dates.append(date)
-                if date in snapshots:
-                    quantities.append(snapshots[date])
-                else:
-                    quantities.append(None)
-                    missing_dates.append(date)
+            conn.commit()
+            conn.close()
+            
+            print(f"✅ Snapshots backfilled: {len(missing)} days ({missing[0]} → {missing[-1]})")
+            return len(missing)
+            
+        except Exception as e:
+            print(f"❌ Error backfilling snapshots: {e}")
+            if 'conn' in locals():
+                conn.close()
+            return 0
+    
+    def get_stock_quantity_trend(self, days=30, max_points=TREND_MAX_POINTS, dimension=None):
+        """
+        Get stock quantity trend for specified period
+        
+        Args:
+            days: Number of days (7/30/60/90/180/360) or 'lifetime'
+            max_points: أقصى عدد نقط - المدد الطويلة بتتقرا من الـ rollups وبتتقلل بالـ LTTB
+            dimension: ('brand', brand_id) / ('category', code) / ('type', type_id) - trend براند أو فئة بس
+        
+        Returns:
+            dict with dates, quantities, missing_dates, has_data, resolution
+        """
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            result = snapshot_trends.trend(cursor, 'total_quantity', days, max_points, dimension)
+            conn.close()
             
             return {
-                'dates': dates,
-                'quantities': quantities,
-                'missing_dates': missing_dates,
-                'has_data': len(snapshots) > 0
+                'dates': result['dates'],
+                'quantities': result['points'],
+                'missing_dates': result['missing_dates'],
+                'has_data': result['has_data'],
+                'resolution': result['resolution']
             }
             
         except Exception as e:
             print(f"Error getting stock quantity trend: {e}")
+            if 'conn' in locals():
+                conn.close()
             return {
                 'dates': [],
                 'quantities': [],
                 'missing_dates': [],
-                'has_data': False
+                'has_data': False,
+                'resolution': 'day'
             }
     
-    def get_stock_value_trend(self, days=30):
+    def get_stock_value_trend(self, days=30, max_points=TREND_MAX_POINTS, dimension=None):
         """
         Get stock value trend for specified period
         
         Args:
             days: Number of days (7/30/60/90/180/360) or 'lifetime'
+            max_points: أقصى عدد نقط - المدد الطويلة بتتقرا من الـ rollups وبتتقلل بالـ LTTB
+            dimension: ('brand', brand_id) / ('category', code) / ('type', type_id) - trend براند أو فئة بس
         
         Returns:
-            dict with dates, values, missing_dates, has_data
+            dict with dates, values, missing_dates, has_data, resolution
         """
         try:
-            from datetime import timedelta
-            
             conn = self.get_connection()
             cursor = conn.cursor()
-            
-            # Handle lifetime option
-            if days == 'lifetime':
-                cursor.execute('''
-                    SELECT snapshot_date, total_value
-                    FROM stock_snapshots
-                    ORDER BY snapshot_date ASC
-                ''')
-            else:
-                cursor.execute('''
-                    SELECT snapshot_date, total_value
-                    FROM stock_snapshots
-                    WHERE snapshot_date >= DATE('now', '-' || ? || ' days')
-                    ORDER BY snapshot_date ASC
-                ''', (days,))
-            
-            snapshots = {row[0]: row[1] for row in cursor.fetchall()}
+            result = snapshot_trends.trend(cursor, 'total_value', days, max_points, dimension)
             conn.close()
             
-            # Generate date range
-            today = datetime.now().date()
-            
-            if days == 'lifetime' and snapshots:
-                # Get first snapshot date
-                first_date = min(snapshots.keys())
-                first_date_obj = datetime.strptime(first_date, '%Y-%m-%d').date()
-                days_count = (today - first_date_obj).days + 1
-                all_dates = []
-                for i in range(days_count):
-                    date = (first_date_obj + timedelta(days=i)).strftime('%Y-%m-%d')
-                    all_dates.append(date)
-            else:
-                all_dates = []
-                for i in range(days-1, -1, -1):
-                    date = (today - timedelta(days=i)).strftime('%Y-%m-%d')
-                    all_dates.append(date)
-            
-            # Build data arrays
-            dates = []
-            values = []
-            missing_dates = []
-            
-            for date in all_dates:
-                dates.append(date)
-                if date in snapshots:
-                    values.append(round(float(snapshots[date]), 2))
-                else:
-                    values.append(None)
-                    missing_dates.append(date)
-            
             return {
-                'dates': dates,
-                'values': values,
-                'missing_dates': missing_dates,
-                'has_data': len(snapshots) > 0
+                'dates': result['dates'],
+                'values': [round(float(value), 2) if value is not None else None for value in result['points']],
+                'missing_dates': result['missing_dates'],
+                'has_data': result['has_data'],
+                'resolution': result['resolution']
             }
             
         except Exception as e:
             print(f"Error getting stock value trend: {e}")
+            if 'conn' in locals():
+                conn.close()
             return {
                 'dates': [],
                 'values': [],
                 'missing_dates': [],
-                'has_data': False
+                'has_data': False,
+                'resolution': 'day'
             }
 
 
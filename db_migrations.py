@@ -0,0 +1,206 @@
+"""
+Database Migrations Module
+Numbered, idempotent schema migrations tracked in the schema_version table
+"""
+
+import excel_import
+import inventory_summary
+import log_archive
+import log_stats
+import snapshot_trends
+
+
+class MigrationError(Exception):
+    """A migration failed - the app must not run on the older schema (see apply_migrations)"""
+
+
+def _create_base_tables(db, cursor):
+    db.create_base_tables(cursor)
+
+
+def _unique_variant_colors(db, cursor):
+    """A product can have each color only once - refuse to index duplicates silently"""
+    cursor.execute('''
+        SELECT base_product_id, color_id, COUNT(*)
+        FROM product_variants
+        GROUP BY base_product_id, color_id
+        HAVING COUNT(*) > 1
+    ''')
+    duplicates = cursor.fetchall()
+    if duplicates:
+        sample = ', '.join(f'product {row[0]}/color {row[1]}' for row in duplicates[:5])
+        raise ValueError(f'{len(duplicates)} duplicated product/color variants must be merged first ({sample})')
+
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_variants_product_color
+        ON product_variants(base_product_id, color_id)
+    ''')
+
+
+def _create_search_index(db, cursor):
+    db.create_search_index(cursor)
+
+
+def _deferrable_triggers(db, cursor):
+    """Summary and search triggers that a bulk write can defer - see inventory_summary"""
+    inventory_summary.create_triggers(db, cursor)
+    if db.has_search_table(cursor):
+        db.create_search_triggers(cursor)
+
+
+def _create_import_runs(db, cursor):
+    excel_import.create_run_tables(db, cursor)
+
+
+def _create_import_hashes(db, cursor):
+    excel_import.create_hash_table(db, cursor)
+
+
+def _create_product_import_hashes(db, cursor):
+    excel_import.create_product_hash_table(db, cursor)
+
+
+def _create_log_archive_lock(db, cursor):
+    log_archive.create_lock_table(db, cursor)
+
+
+def _create_inventory_summary(db, cursor):
+    inventory_summary.create_summary_tables(db, cursor)
+
+
+def _create_snapshot_rollups(db, cursor):
+    snapshot_trends.create_rollup_table(db, cursor)
+
+
+def _create_snapshot_dimensions(db, cursor):
+    snapshot_trends.create_dimension_table(db, cursor)
+
+
+def _create_log_stats(db, cursor):
+    log_stats.create_stats_tables(db, cursor)
+
+
+# (version, name, list of SQL statements or callable(db, cursor))
+# Every migration must be safe to re-run: a crash between the DDL and the
+# schema_version insert applies it again on the next start.
+MIGRATIONS = [
+    (1, 'base tables', _create_base_tables),
+    (2, 'hot path join indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_variants_base_product ON product_variants(base_product_id)',
+        'CREATE INDEX IF NOT EXISTS idx_variants_color ON product_variants(color_id)',
+        # color_images.variant_id and product_tags(product_id, tag_id) are already
+        # indexed by their UNIQUE constraints - cover the columns the joins read instead
+        'CREATE INDEX IF NOT EXISTS idx_color_images_variant_url ON color_images(variant_id, image_url)',
+        'CREATE INDEX IF NOT EXISTS idx_product_tags_tag ON product_tags(tag_id, product_id)',
+        'CREATE INDEX IF NOT EXISTS idx_products_identity ON base_products(product_code, brand_id, trader_category)',
+        'CREATE INDEX IF NOT EXISTS idx_products_created ON base_products(created_date, id)',
+    ]),
+    (3, 'unique variant per product color', _unique_variant_colors),
+    (4, 'product full-text search index', _create_search_index),
+    (5, 'inventory summary rollups', _create_inventory_summary),
+    (6, 'weekly / monthly stock snapshot rollups', _create_snapshot_rollups),
+    (7, 'per brand / category / type stock snapshots', _create_snapshot_dimensions),
+    (8, 'stock log keyset indexes', [
+        # /logs pages on (created_date, id) newest first, optionally for one operation type
+        'CREATE INDEX IF NOT EXISTS idx_logs_date_id ON stock_logs(created_date, id)',
+        'CREATE INDEX IF NOT EXISTS idx_logs_operation_date ON stock_logs(operation_type, created_date, id)',
+        # both are prefixes of the indexes above
+        'DROP INDEX IF EXISTS idx_logs_date',
+        'DROP INDEX IF EXISTS idx_logs_operation',
+    ]),
+    (9, 'incremental stock log stats', _create_log_stats),
+    (10, 'deferrable summary / search triggers for bulk imports', _deferrable_triggers),
+    (11, 'resumable excel import runs', _create_import_runs),
+    (12, 'per variant import content hashes (delta import)', _create_import_hashes),
+    (13, 'stock log archive run lock', _create_log_archive_lock),
+    (14, 'per product import content hashes (delta import)', _create_product_import_hashes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# pg_advisory_lock key - only one worker migrates a PostgreSQL database at a time
+MIGRATION_LOCK_KEY = 7305001
+
+
+def get_schema_version(conn):
+    """Current schema version (0 when the schema_version table does not exist yet)"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT MAX(version) FROM schema_version')
+        row = cursor.fetchone()
+        return row[0] or 0
+    except Exception:
+        # PostgreSQL aborts the transaction on a missing table
+        conn.rollback()
+        return 0
+
+
+def _apply_pending(db, conn, current):
+    cursor = conn.cursor()
+    id_type = 'SERIAL PRIMARY KEY' if db.db_type == 'postgresql' else 'INTEGER PRIMARY KEY'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            id {id_type},
+            version INTEGER UNIQUE NOT NULL,
+            name TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    for version, name, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            if callable(migration):
+                migration(db, cursor)
+            else:
+                for statement in migration:
+                    cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+            conn.commit()
+            current = version
+            print(f"✅ Migration {version} applied: {name}")
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ Migration {version} ({name}) failed: {e}")
+            raise MigrationError(
+                f'Migration {version} ({name}) failed, schema stays at version {current} '
+                f'of {LATEST_VERSION}: {e}'
+            ) from e
+
+    return current
+
+
+def apply_migrations(db):
+    """
+    Apply every pending migration in order; returns the resulting schema version
+
+    Raises MigrationError when one fails: the queries, triggers and imports
+    all assume LATEST_VERSION, so startup stops instead of serving on a
+    partial schema. Fix the cause (e.g. merge the duplicates migration 3
+    lists) and restart - the failed migration is retried.
+    """
+    conn = db.get_connection()
+    try:
+        current = get_schema_version(conn)
+        if current >= LATEST_VERSION:
+            print(f"✅ Schema is up to date (version {current}) - skipping DDL")
+            return current
+
+        cursor = conn.cursor()
+        if db.db_type == 'postgresql':
+            cursor.execute('SELECT pg_advisory_lock(?)', (MIGRATION_LOCK_KEY,))
+        try:
+            # another worker may have migrated while we waited for the lock
+            current = get_schema_version(conn)
+            current = _apply_pending(db, conn, current)
+        finally:
+            if db.db_type == 'postgresql':
+                conn.rollback()
+                cursor.execute('SELECT pg_advisory_unlock(?)', (MIGRATION_LOCK_KEY,))
+                conn.commit()
+
+        return current
+    finally:
+        conn.close()
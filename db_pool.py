@@ -0,0 +1,372 @@
+"""
+Database Connection Pool Module
+Keeps SQLite / PostgreSQL connections open between StockDatabase calls
+"""
+
+import sqlite3
+import threading
+import time
+import weakref
+from queue import LifoQueue, Empty
+
+from sql_dialect import SQLiteDialect, PostgresDialect
+
+
+class PoolExhaustedError(Exception):
+    """Raised when no connection could be checked out before the timeout"""
+
+
+class PooledConnection:
+    """
+    Proxy returned by StockDatabase.get_connection()
+
+    Behaves like the raw DB-API connection, but close() hands the
+    connection back to its pool instead of closing it. Uncommitted work
+    is rolled back on return, exactly as a real close() would discard it.
+    Cursors are wrapped by the pool's SQL dialect (a no-op for SQLite).
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            raise sqlite3.ProgrammingError('Connection was already returned to the pool')
+        return self._raw
+
+    def cursor(self, *args, **kwargs):
+        return self._pool.dialect.wrap_cursor(self.raw.cursor(*args, **kwargs))
+
+    def execute(self, *args, **kwargs):
+        cursor = self.cursor()
+        cursor.execute(*args, **kwargs)
+        return cursor
+
+    def commit(self):
+        return self.raw.commit()
+
+    def rollback(self):
+        return self.raw.rollback()
+
+    def close(self):
+        """Return the connection to the pool (safe to call more than once)"""
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool.release(raw)
+
+    @property
+    def closed(self):
+        return self._raw is None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._raw is not None:
+            if exc_type is None:
+                self._raw.commit()
+            else:
+                self._raw.rollback()
+        self.close()
+        return False
+
+    def __del__(self):
+        # Forgotten close() calls must not leak the checkout counter
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class _ThreadSlot:
+    """Per-thread holder of idle SQLite connections"""
+
+    def __init__(self):
+        self.idle = []
+
+
+class SQLiteConnectionPool:
+    """
+    Thread-local pool of persistent SQLite connections
+
+    Each thread keeps its own idle connections, so a connection is never
+    shared between threads. Nested checkouts in the same thread get a
+    different connection, keeping the old one-connection-per-call semantics.
+    """
+
+    PRAGMAS = (
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -64000),       # 64MB page cache per connection
+        ('mmap_size', 268435456),     # 256MB memory-mapped I/O
+        ('temp_store', 'MEMORY'),
+    )
+
+    def __init__(self, db_name, timeout=30.0, max_idle_per_thread=4):
+        self.db_name = db_name
+        self.dialect = SQLiteDialect()
+        self.timeout = timeout
+        self.max_idle_per_thread = max_idle_per_thread
+
+        self._local = threading.local()
+        self._slots = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._created = 0
+        self._checkouts = 0
+        self._discarded = 0
+
+        # journal_mode is persistent in the database file - set it once
+        conn = sqlite3.connect(self.db_name, timeout=self.timeout)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        finally:
+            conn.close()
+
+    def _slot(self):
+        slot = getattr(self._local, 'slot', None)
+        if slot is None:
+            slot = _ThreadSlot()
+            self._local.slot = slot
+            with self._lock:
+                self._slots.add(slot)
+        return slot
+
+    def _create(self):
+        raw = sqlite3.connect(self.db_name, timeout=self.timeout, check_same_thread=False)
+        for name, value in self.PRAGMAS:
+            raw.execute(f'PRAGMA {name}={value}')
+        with self._lock:
+            self._created += 1
+        return raw
+
+    def connection(self):
+        """Check out a connection for the current thread"""
+        slot = self._slot()
+        raw = slot.idle.pop() if slot.idle else self._create()
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+        return PooledConnection(self, raw)
+
+    def release(self, raw):
+        """Return a connection to the current thread's idle list"""
+        with self._lock:
+            self._in_use -= 1
+
+        try:
+            if raw.in_transaction:
+                raw.rollback()
+        except sqlite3.Error:
+            self._discard(raw)
+            return
+
+        slot = self._slot()
+        if len(slot.idle) < self.max_idle_per_thread:
+            slot.idle.append(raw)
+        else:
+            self._discard(raw)
+
+    def _discard(self, raw):
+        with self._lock:
+            self._discarded += 1
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def health_check(self):
+        """Run a trivial query on a pooled connection"""
+        conn = self.connection()
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error as e:
+            print(f"❌ SQLite pool health check failed: {e}")
+            return False
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(slot.idle) for slot in self._slots)
+            return {
+                'backend': 'sqlite',
+                'threads': len(self._slots),
+                'idle': idle,
+                'in_use': self._in_use,
+                'size': idle + self._in_use,
+                'max_idle_per_thread': self.max_idle_per_thread,
+                'created': self._created,
+                'checkouts': self._checkouts,
+                'discarded': self._discarded,
+            }
+
+    def close_all(self):
+        """Close idle connections of every thread"""
+        with self._lock:
+            slots = list(self._slots)
+        for slot in slots:
+            while slot.idle:
+                try:
+                    slot.idle.pop().close()
+                except Exception:
+                    pass
+
+
+class PostgresConnectionPool:
+    """
+    Bounded pool of PostgreSQL connections shared by all threads
+
+    At most max_size connections exist at once; checkout blocks up to
+    checkout_timeout seconds when all of them are in use. Connections idle
+    for longer than health_check_interval are pinged before being reused.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, checkout_timeout=30.0,
+                 health_check_interval=30.0, dialect=None):
+        self._connect = connect
+        self.dialect = dialect or PostgresDialect()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._size = 0
+        self._created = 0
+        self._checkouts = 0
+        self._discarded = 0
+        self._waits = 0
+
+        for _ in range(min_size):
+            try:
+                self._idle.put((self._create(), time.monotonic()))
+            except Exception as e:
+                print(f"⚠️ Could not pre-open PostgreSQL connection: {e}")
+                break
+
+    def _create(self):
+        raw = self._connect()
+        with self._lock:
+            self._size += 1
+            self._created += 1
+        return raw
+
+    def _is_alive(self, raw, idle_since):
+        if getattr(raw, 'closed', False):
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            cursor = raw.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            raw.rollback()
+            return True
+        except Exception:
+            return False
+
+    def connection(self):
+        """Check out a connection, blocking while the pool is exhausted"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._waits += 1
+            if not self._slots.acquire(timeout=self.checkout_timeout):
+                raise PoolExhaustedError(
+                    f'No PostgreSQL connection available after {self.checkout_timeout}s '
+                    f'(max_size={self.max_size})'
+                )
+
+        try:
+            raw = None
+            while raw is None:
+                try:
+                    candidate, idle_since = self._idle.get_nowait()
+                except Empty:
+                    raw = self._create()
+                    break
+                if self._is_alive(candidate, idle_since):
+                    raw = candidate
+                else:
+                    self._discard(candidate)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._checkouts += 1
+        return PooledConnection(self, raw)
+
+    def release(self, raw):
+        """Return a connection to the pool, dropping it if it is broken"""
+        try:
+            if getattr(raw, 'closed', False):
+                self._discard(raw)
+            else:
+                try:
+                    raw.rollback()
+                    self._idle.put((raw, time.monotonic()))
+                except Exception:
+                    self._discard(raw)
+        finally:
+            self._slots.release()
+
+    def _discard(self, raw):
+        with self._lock:
+            self._size -= 1
+            self._discarded += 1
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def health_check(self):
+        """Run a trivial query on a pooled connection"""
+        try:
+            conn = self.connection()
+        except Exception as e:
+            print(f"❌ PostgreSQL pool health check failed: {e}")
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            return True
+        except Exception as e:
+            print(f"❌ PostgreSQL pool health check failed: {e}")
+            return False
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            idle = self._idle.qsize()
+            return {
+                'backend': 'postgresql',
+                'idle': idle,
+                'in_use': self._size - idle,
+                'size': self._size,
+                'max_size': self.max_size,
+                'created': self._created,
+                'checkouts': self._checkouts,
+                'discarded': self._discarded,
+                'waits': self._waits,
+            }
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                raw, _ = self._idle.get_nowait()
+            except Empty:
+                break
+            self._discard(raw)
@@ -16,6 +16,8 @@ class DropboxOAuthBackup:
         
         # ✅ حدد المسار للـ Backups
         self.backup_folder = '/Stock_Backups'
+        # segments الأرشيف (log_archive) - النسخة الوحيدة من الـ logs المتأرشفة
+        self.log_archive_folder = f'{self.backup_folder}/log_archive'
         
         # فحص فوري للمتغيرات
         print(f"🔍 Environment Variables Check:")
@@ -374,6 +376,63 @@ class DropboxOAuthBackup:
             conn.close()
             return 0
     
+    def upload_log_archive_file(self, path):
+        """رفع ملف من الأرشيف (segment أو manifest) - True لو اترفع"""
+        if not self.ensure_valid_token():
+            return False
+        
+        try:
+            with open(path, 'rb') as f:
+                self.dbx.files_upload(
+                    f.read(),
+                    f'{self.log_archive_folder}/{os.path.basename(path)}',
+                    mode=dropbox.files.WriteMode.overwrite
+                )
+            print(f"✅ Log archive uploaded: {os.path.basename(path)}")
+            return True
+        except Exception as e:
+            print(f"❌ Error uploading log archive {os.path.basename(path)}: {e}")
+            return False
+    
+    def restore_log_archive(self, directory):
+        """
+        تنزيل ملفات الأرشيف اللي مش موجودة في directory (بعد deploy الـ disk بيتمسح)
+        
+        الـ manifest بيتنزل في الآخر عشان ما يشاورش على segment لسه ما اتنزلش.
+        Returns عدد الملفات اللي اتنزلت
+        """
+        if not self.ensure_valid_token():
+            return 0
+        
+        try:
+            result = self.dbx.files_list_folder(self.log_archive_folder)
+            entries = list(result.entries)
+            while result.has_more:
+                result = self.dbx.files_list_folder_continue(result.cursor)
+                entries.extend(result.entries)
+        except dropbox.exceptions.ApiError:
+            print("📁 No log archive in Dropbox")
+            return 0
+        
+        names = sorted((entry.name for entry in entries if isinstance(entry, dropbox.files.FileMetadata)),
+                       key=lambda name: name == 'manifest.json')
+        restored = 0
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for name in names:
+                path = os.path.join(directory, name)
+                if os.path.exists(path):
+                    continue
+                _, response = self.dbx.files_download(f'{self.log_archive_folder}/{name}')
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(response.content)
+                os.replace(path + '.tmp', path)
+                restored += 1
+            print(f"✅ Log archive restored: {restored} file(s)")
+        except Exception as e:
+            print(f"❌ Error restoring log archive: {e}")
+        return restored
+    
     def cleanup_old_backups(self):
         """حذف النسخ القديمة الزائدة"""
         try:
@@ -0,0 +1,270 @@
+"""
+Excel Import Module
+Streaming reader for the bulk upload workbook
+
+The upload is opened with openpyxl in read_only mode and its rows are read
+with iter_rows(values_only=True), so no cell objects are kept: rows are
+turned into dicts keyed by the header row and handed out in chunks of
+IMPORT_CHUNK_SIZE rows. Memory stays the size of one chunk whatever the
+number of rows in the file.
+
+Every upload is an import run: the file is kept under IMPORT_UPLOAD_DIR by
+its sha256 and import_runs records the last committed chunk together with
+the counters, in the same transaction as the chunk itself, plus one
+import_run_errors row per rejected row. A run interrupted by a worker
+restart or a request timeout is resumed from its checkpoint - uploading the
+same file again or the resume button - and the chunks already committed are
+never applied twice.
+
+Re-uploads of the full catalog are delta imports: variant_import_hashes
+keeps the content_hash() of what the last import wrote for every variant,
+and rows whose hash did not change are not written at all. The product row
+itself is rewritten only when its own product_hash() - kept in
+product_import_hashes - changed, whatever chunk its variants are in.
+Triggers drop the hashes whenever the stock, image, tags or product fields
+are changed by anything else than the import (they are deferred during the
+import itself), so a stored hash always describes the current row.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from openpyxl import load_workbook
+
+from inventory_summary import TRIGGERS_ENABLED
+
+
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 1000))
+# الملفات اللي رفعها لسه ما خلصتش بتتحفظ هنا عشان الـ resume
+IMPORT_UPLOAD_DIR = os.environ.get('IMPORT_UPLOAD_DIR', 'import_uploads')
+
+REQUIRED_COLUMNS = [
+    'Product Code', 'Brand Name', 'Product Type', 'Category',
+    'Wholesale Price', 'Retail Price', 'Color Name', 'Stock'
+]
+
+
+class ImportRunConflict(Exception):
+    """The run's checkpoint moved on elsewhere (another request resumed it) or it was cancelled"""
+
+    def __init__(self, run_id):
+        super().__init__(f'Import run {run_id} is being processed by another request or was cancelled')
+
+
+class ExcelSheet:
+    """Active sheet of an uploaded workbook opened read-only - use as a context manager"""
+
+    def __init__(self, file):
+        self._workbook = load_workbook(file, read_only=True, data_only=True)
+        self._sheet = self._workbook.active
+        header_row = next(self._sheet.iter_rows(max_row=1, values_only=True), ())
+        # (column index, header) of every non-empty header cell
+        self._columns = [(index, str(value).strip()) for index, value in enumerate(header_row)
+                         if value is not None and str(value).strip()]
+        self.headers = [header for _, header in self._columns]
+        # عدد الصفوف من أبعاد الشيت (تقريبي - الصفوف الفاضية محسوبة) أو None
+        self.row_estimate = max(self._sheet.max_row - 1, 0) if self._sheet.max_row else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._workbook.close()
+
+    def missing_columns(self, required=REQUIRED_COLUMNS):
+        return [column for column in required if column not in self.headers]
+
+    def rows(self):
+        """(sheet row number, {header: stripped string value}) of every non-empty data row"""
+        for row_number, row in enumerate(self._sheet.iter_rows(min_row=2, values_only=True), 2):
+            # Skip empty rows
+            if not any(value is not None and str(value).strip() for value in row):
+                continue
+            yield row_number, {
+                header: str(row[index]).strip() if index < len(row) and row[index] is not None else ''
+                for index, header in self._columns
+            }
+
+    def chunks(self, chunk_size=IMPORT_CHUNK_SIZE):
+        """rows() in lists of chunk_size"""
+        return chunked(self.rows(), chunk_size)
+
+
+def chunked(rows, chunk_size=IMPORT_CHUNK_SIZE):
+    """Lists of up to chunk_size items from any iterable of rows"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def upload_path(file_hash):
+    return os.path.join(IMPORT_UPLOAD_DIR, f'{file_hash}.xlsx')
+
+
+def save_upload(file):
+    """Store an uploaded file (werkzeug FileStorage) under its sha256 - returns (path, sha256)"""
+    os.makedirs(IMPORT_UPLOAD_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=IMPORT_UPLOAD_DIR)
+    digest = hashlib.sha256()
+    with os.fdopen(fd, 'wb') as f:
+        for block in iter(lambda: file.stream.read(1 << 20), b''):
+            digest.update(block)
+            f.write(block)
+    file_hash = digest.hexdigest()
+    os.replace(temp_path, upload_path(file_hash))
+    return upload_path(file_hash), file_hash
+
+
+def discard_upload(file_hash):
+    try:
+        os.remove(upload_path(file_hash))
+    except FileNotFoundError:
+        pass
+
+
+def create_run_tables(db, cursor):
+    """import_runs and import_run_errors (migration 11)"""
+    id_type = 'SERIAL PRIMARY KEY' if db.db_type == 'postgresql' else 'INTEGER PRIMARY KEY'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS import_runs (
+            id {id_type},
+            file_name TEXT,
+            file_hash TEXT NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            total_rows INTEGER,
+            last_chunk INTEGER NOT NULL DEFAULT 0,
+            processed_rows INTEGER NOT NULL DEFAULT 0,
+            success_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'running',
+            username TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_import_runs_hash_status ON import_runs(file_hash, status)')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS import_run_errors (
+            id {id_type},
+            run_id INTEGER NOT NULL,
+            row_number INTEGER,
+            product_code TEXT,
+            error TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_import_run_errors_run ON import_run_errors(run_id, row_number)')
+
+
+def content_hash(product_fields, stock, image_url, tag_ids):
+    """
+    Hash of what an import row writes for one variant
+
+    product_fields is (product_type_id, size, wholesale, retail) of the row
+    that sets the product in the file, tag_ids the ids of its existing tags.
+    Ids rather than names, so renaming a type or adding a tag changes it.
+    """
+    payload = json.dumps([list(product_fields), stock, image_url, sorted(tag_ids)])
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def product_hash(product_fields):
+    """Hash of the product fields an import writes - (product_type_id, size, wholesale, retail)"""
+    payload = json.dumps(list(product_fields))
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+# (trigger name, event, table, SELECT of the variant ids whose hash is stale)
+_HASH_TRIGGERS = [
+    ('trg_import_hash_variants_ins', 'INSERT', 'product_variants', 'SELECT NEW.id'),
+    ('trg_import_hash_variants_upd', 'UPDATE OF current_stock, base_product_id, color_id',
+     'product_variants', 'SELECT OLD.id'),
+    ('trg_import_hash_variants_del', 'DELETE', 'product_variants', 'SELECT OLD.id'),
+    ('trg_import_hash_products_ins', 'INSERT', 'base_products',
+     'SELECT id FROM product_variants WHERE base_product_id = NEW.id'),
+    ('trg_import_hash_products_upd',
+     'UPDATE OF product_code, brand_id, product_type_id, trader_category, product_size, wholesale_price, retail_price',
+     'base_products', 'SELECT id FROM product_variants WHERE base_product_id = NEW.id'),
+    ('trg_import_hash_products_del', 'DELETE', 'base_products',
+     'SELECT id FROM product_variants WHERE base_product_id = OLD.id'),
+    ('trg_import_hash_images_ins', 'INSERT', 'color_images', 'SELECT NEW.variant_id'),
+    ('trg_import_hash_images_upd', 'UPDATE', 'color_images', 'SELECT OLD.variant_id UNION SELECT NEW.variant_id'),
+    ('trg_import_hash_images_del', 'DELETE', 'color_images', 'SELECT OLD.variant_id'),
+    ('trg_import_hash_tags_del', 'DELETE', 'product_tags',
+     'SELECT id FROM product_variants WHERE base_product_id = OLD.product_id'),
+]
+
+
+# same for product_import_hashes: SELECT of the product ids whose hash is stale
+_PRODUCT_HASH_TRIGGERS = [
+    ('trg_import_product_hash_upd',
+     'UPDATE OF product_code, brand_id, product_type_id, trader_category, product_size, wholesale_price, retail_price',
+     'base_products', 'SELECT NEW.id'),
+    ('trg_import_product_hash_del', 'DELETE', 'base_products', 'SELECT OLD.id'),
+]
+
+
+def create_hash_table(db, cursor):
+    """variant_import_hashes, its triggers and the delta counters of import_runs (migration 12)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS variant_import_hashes (
+            variant_id INTEGER PRIMARY KEY,
+            content_hash TEXT NOT NULL
+        )
+    ''')
+    _create_hash_triggers(db, cursor, 'variant_import_hashes', 'variant_id', _HASH_TRIGGERS)
+
+    cursor.execute('SELECT * FROM import_runs WHERE 1 = 0')
+    existing = {column[0] for column in cursor.description}
+    for column in ('inserted_count', 'updated_count', 'unchanged_count'):
+        if column not in existing:
+            cursor.execute(f'ALTER TABLE import_runs ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+
+
+def create_product_hash_table(db, cursor):
+    """product_import_hashes and its triggers (migration 14)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_import_hashes (
+            product_id INTEGER PRIMARY KEY,
+            content_hash TEXT NOT NULL
+        )
+    ''')
+    _create_hash_triggers(db, cursor, 'product_import_hashes', 'product_id', _PRODUCT_HASH_TRIGGERS)
+
+
+def _create_hash_triggers(db, cursor, hash_table, key_column, triggers):
+    for name, event, table, ids in triggers:
+        body = f'DELETE FROM {hash_table} WHERE {key_column} IN ({ids})'
+        if db.db_type == 'postgresql':
+            cursor.execute(f'''
+                CREATE OR REPLACE FUNCTION {name}_fn() RETURNS trigger AS $$
+                BEGIN
+                    IF {TRIGGERS_ENABLED} THEN
+                        {body};
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name} ON {table}')
+            cursor.execute(f'''
+                CREATE TRIGGER {name} AFTER {event} ON {table}
+                FOR EACH ROW EXECUTE PROCEDURE {name}_fn()
+            ''')
+        else:
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table}
+                WHEN {TRIGGERS_ENABLED}
+                BEGIN
+                    {body};
+                END
+            ''')
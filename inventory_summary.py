@@ -0,0 +1,324 @@
+"""
+Inventory Summary Module
+Materialized dashboard totals kept up to date by database triggers
+
+inventory_summary holds one row per (scope, summary_key):
+    total     ''              - whole catalog
+    brand     brand_id        - per brand
+    type      product_type_id - per product type
+    category  trader_category - per trader category code
+    color     color_id        - per color (variants only, product_count stays 0)
+with product_count, variant_count, total_stock and stock_value
+(wholesale_price * current_stock). product_stock_summary keeps the total
+stock of every product for the "top products" widget.
+
+Triggers on product_variants and base_products apply the delta of every
+insert / update / delete, so every write path (routes, bulk upload, scan
+sessions, imports) keeps the summary exact. rebuild() recomputes both
+tables from scratch for repair.
+
+Bulk writers can switch the triggers (and the search index triggers, which
+share the guard) off for their own transaction by inserting a row into
+bulk_write_deferred: they take the products they touch out with
+apply_products(-1) before writing, put them back with apply_products(+1)
+and refresh_product_stock() afterwards, and delete the row before commit,
+so no other connection ever sees it.
+"""
+
+SCOPES = ('total', 'brand', 'type', 'category', 'color')
+
+# Triggers do nothing while this table has a row (only ever inside the writer's own transaction)
+DEFERRED_TABLE = 'bulk_write_deferred'
+TRIGGERS_ENABLED = f'NOT EXISTS (SELECT 1 FROM {DEFERRED_TABLE})'
+
+# Dimension column of base_products behind each product scope
+_PRODUCT_KEYS = {
+    'total': "''",
+    'brand': 'CAST({row}.brand_id AS TEXT)',
+    'type': 'CAST({row}.product_type_id AS TEXT)',
+    'category': '{row}.trader_category',
+}
+
+_UPSERT = '''
+    INSERT INTO inventory_summary (scope, summary_key, product_count, variant_count, total_stock, stock_value)
+    SELECT scope, summary_key, SUM(product_count), SUM(variant_count), SUM(total_stock), SUM(stock_value)
+    FROM ({deltas}) d
+    WHERE true
+    GROUP BY scope, summary_key
+    ON CONFLICT (scope, summary_key) DO UPDATE SET
+        product_count = inventory_summary.product_count + excluded.product_count,
+        variant_count = inventory_summary.variant_count + excluded.variant_count,
+        total_stock = inventory_summary.total_stock + excluded.total_stock,
+        stock_value = inventory_summary.stock_value + excluded.stock_value
+'''
+
+_PRODUCT_STOCK_UPSERT = '''
+    INSERT INTO product_stock_summary (product_id, total_stock)
+    SELECT bp.id, {sign} * {row}.current_stock
+    FROM base_products bp
+    WHERE bp.id = {row}.base_product_id
+    ON CONFLICT (product_id) DO UPDATE SET
+        total_stock = product_stock_summary.total_stock + excluded.total_stock
+'''
+
+
+def _key(expression):
+    return f"COALESCE({expression}, '')"
+
+
+def _variant_deltas(row, sign):
+    """Delta rows of one variant (NEW / OLD) - nothing when its product is gone"""
+    selects = []
+    for scope in SCOPES:
+        if scope == 'color':
+            key = f'CAST({row}.color_id AS TEXT)'
+        else:
+            key = _PRODUCT_KEYS[scope].format(row='bp')
+        selects.append(f'''
+            SELECT '{scope}' AS scope, {_key(key)} AS summary_key, 0 AS product_count,
+                   {sign} AS variant_count, {sign} * {row}.current_stock AS total_stock,
+                   {sign} * {row}.current_stock * COALESCE(bp.wholesale_price, 0) AS stock_value
+            FROM base_products bp WHERE bp.id = {row}.base_product_id
+        ''')
+    return ' UNION ALL '.join(selects)
+
+
+def _product_deltas(row, sign):
+    """Delta rows of one product (NEW / OLD) together with the variants it still has"""
+    price = f'COALESCE({row}.wholesale_price, 0)'
+    selects = []
+    for scope, key in _PRODUCT_KEYS.items():
+        selects.append(f'''
+            SELECT '{scope}' AS scope, {_key(key.format(row=row))} AS summary_key, {sign} AS product_count,
+                   {sign} * COUNT(pv.id) AS variant_count,
+                   {sign} * COALESCE(SUM(pv.current_stock), 0) AS total_stock,
+                   {sign} * COALESCE(SUM(pv.current_stock), 0) * {price} AS stock_value
+            FROM product_variants pv WHERE pv.base_product_id = {row}.id
+        ''')
+    selects.append(f'''
+        SELECT 'color' AS scope, {_key('CAST(pv.color_id AS TEXT)')} AS summary_key, 0 AS product_count,
+               {sign} * COUNT(*) AS variant_count, {sign} * SUM(pv.current_stock) AS total_stock,
+               {sign} * SUM(pv.current_stock) * {price} AS stock_value
+        FROM product_variants pv WHERE pv.base_product_id = {row}.id
+        GROUP BY pv.color_id
+    ''')
+    return ' UNION ALL '.join(selects)
+
+
+def _trigger_bodies():
+    """(name, event, table, [statements]) for every summary trigger"""
+    variant_insert = [_UPSERT.format(deltas=_variant_deltas('NEW', 1)),
+                      _PRODUCT_STOCK_UPSERT.format(row='NEW', sign=1)]
+    variant_delete = [_UPSERT.format(deltas=_variant_deltas('OLD', -1)),
+                      _PRODUCT_STOCK_UPSERT.format(row='OLD', sign=-1)]
+    product_insert = [
+        _UPSERT.format(deltas=_product_deltas('NEW', 1)),
+        '''INSERT INTO product_stock_summary (product_id, total_stock)
+           SELECT NEW.id, COALESCE(SUM(current_stock), 0) FROM product_variants WHERE base_product_id = NEW.id
+           ON CONFLICT (product_id) DO UPDATE SET total_stock = excluded.total_stock''',
+    ]
+    product_delete = [
+        _UPSERT.format(deltas=_product_deltas('OLD', -1)),
+        'DELETE FROM product_stock_summary WHERE product_id = OLD.id',
+    ]
+    return [
+        ('trg_summary_variants_ins', 'INSERT', 'product_variants', variant_insert),
+        ('trg_summary_variants_upd', 'UPDATE OF current_stock, base_product_id, color_id',
+         'product_variants', variant_delete + variant_insert),
+        ('trg_summary_variants_del', 'DELETE', 'product_variants', variant_delete),
+        ('trg_summary_products_ins', 'INSERT', 'base_products', product_insert),
+        ('trg_summary_products_upd', 'UPDATE OF brand_id, product_type_id, trader_category, wholesale_price',
+         'base_products', [_UPSERT.format(deltas=_product_deltas('OLD', -1)),
+                           _UPSERT.format(deltas=_product_deltas('NEW', 1))]),
+        ('trg_summary_products_del', 'DELETE', 'base_products', product_delete),
+    ]
+
+
+def create_deferred_table(cursor):
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {DEFERRED_TABLE} (
+            marker INTEGER PRIMARY KEY
+        )
+    ''')
+
+
+def create_triggers(db, cursor):
+    """(Re)create the summary triggers guarded by TRIGGERS_ENABLED (migrations 5 and 10)"""
+    create_deferred_table(cursor)
+    for name, event, table, statements in _trigger_bodies():
+        body = ';\n'.join(statements)
+        if db.db_type == 'postgresql':
+            cursor.execute(f'''
+                CREATE OR REPLACE FUNCTION {name}_fn() RETURNS trigger AS $$
+                BEGIN
+                    IF {TRIGGERS_ENABLED} THEN
+                        {body};
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name} ON {table}')
+            cursor.execute(f'''
+                CREATE TRIGGER {name} AFTER {event} ON {table}
+                FOR EACH ROW EXECUTE PROCEDURE {name}_fn()
+            ''')
+        else:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+            cursor.execute(f'''
+                CREATE TRIGGER {name} AFTER {event} ON {table}
+                WHEN {TRIGGERS_ENABLED}
+                BEGIN
+                    {body};
+                END
+            ''')
+
+
+def create_summary_tables(db, cursor):
+    """Tables, triggers and initial fill (migration 5)"""
+    value_type = 'DOUBLE PRECISION' if db.db_type == 'postgresql' else 'REAL'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS inventory_summary (
+            scope TEXT NOT NULL,
+            summary_key TEXT NOT NULL,
+            product_count INTEGER NOT NULL DEFAULT 0,
+            variant_count INTEGER NOT NULL DEFAULT 0,
+            total_stock INTEGER NOT NULL DEFAULT 0,
+            stock_value {value_type} NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, summary_key)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_stock_summary (
+            product_id INTEGER PRIMARY KEY,
+            total_stock INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_stock_summary_stock ON product_stock_summary(total_stock)')
+
+    create_triggers(db, cursor)
+    rebuild(cursor)
+
+
+# Per product totals behind the product scopes - {where} narrows base_products
+_PER_PRODUCT = '''
+    SELECT bp.id, bp.brand_id, bp.product_type_id, bp.trader_category,
+           COALESCE(bp.wholesale_price, 0) AS price,
+           COUNT(pv.id) AS variants, COALESCE(SUM(pv.current_stock), 0) AS stock
+    FROM base_products bp
+    LEFT JOIN product_variants pv ON pv.base_product_id = bp.id
+    {where}
+    GROUP BY bp.id, bp.brand_id, bp.product_type_id, bp.trader_category, bp.wholesale_price
+'''
+
+
+def rebuild(cursor):
+    """Recompute inventory_summary and product_stock_summary from the base tables"""
+    cursor.execute('DELETE FROM inventory_summary')
+    cursor.execute('DELETE FROM product_stock_summary')
+
+    per_product = _PER_PRODUCT.format(where='')
+    for scope, key in _PRODUCT_KEYS.items():
+        key = _key(key.format(row='p'))
+        cursor.execute(f'''
+            INSERT INTO inventory_summary (scope, summary_key, product_count, variant_count, total_stock, stock_value)
+            SELECT '{scope}', {key}, COUNT(*), SUM(p.variants), SUM(p.stock), SUM(p.stock * p.price)
+            FROM ({per_product}) p
+            GROUP BY {key}
+        ''')
+    cursor.execute(f'''
+        INSERT INTO inventory_summary (scope, summary_key, product_count, variant_count, total_stock, stock_value)
+        SELECT 'color', {_key('CAST(pv.color_id AS TEXT)')}, 0, COUNT(*), SUM(pv.current_stock),
+               SUM(pv.current_stock * COALESCE(bp.wholesale_price, 0))
+        FROM product_variants pv
+        JOIN base_products bp ON pv.base_product_id = bp.id
+        GROUP BY pv.color_id
+    ''')
+    cursor.execute('''
+        INSERT INTO product_stock_summary (product_id, total_stock)
+        SELECT bp.id, COALESCE(SUM(pv.current_stock), 0)
+        FROM base_products bp
+        LEFT JOIN product_variants pv ON pv.base_product_id = bp.id
+        GROUP BY bp.id
+    ''')
+
+
+def lock_products(cursor, product_ids):
+    """
+    Row-lock these products and their variants until the commit (PostgreSQL)
+
+    Taken before apply_products(-1): other transactions still run the
+    triggers, and a stock change committed between the -1 and the +1 would
+    be counted twice. The products' FOR UPDATE also holds back new variants
+    (their foreign key check). SQLite needs none of it - the deferred marker
+    INSERT already took the database write lock.
+    """
+    if not product_ids:
+        return
+    placeholders = ', '.join('?' for _ in product_ids)
+    cursor.execute(f'SELECT id FROM base_products WHERE id IN ({placeholders}) ORDER BY id FOR UPDATE',
+                   list(product_ids))
+    cursor.execute(f'''
+        SELECT id FROM product_variants WHERE base_product_id IN ({placeholders})
+        ORDER BY id FOR UPDATE
+    ''', list(product_ids))
+
+
+def apply_products(cursor, product_ids, sign):
+    """
+    Add (sign=1) or take out (sign=-1) the current totals of these products and their variants
+
+    Used around a bulk write with the triggers deferred: -1 before the
+    products are written, 1 after. Products that do not exist yet count nothing.
+    """
+    if not product_ids:
+        return
+    placeholders = ', '.join('?' for _ in product_ids)
+    per_product = _PER_PRODUCT.format(where=f'WHERE bp.id IN ({placeholders})')
+    selects = []
+    for scope, key in _PRODUCT_KEYS.items():
+        key = _key(key.format(row='p'))
+        selects.append(f'''
+            SELECT '{scope}' AS scope, {key} AS summary_key, COUNT(*) AS product_count,
+                   SUM(p.variants) AS variant_count, SUM(p.stock) AS total_stock,
+                   SUM(p.stock * p.price) AS stock_value
+            FROM ({per_product}) p
+            GROUP BY {key}
+        ''')
+    selects.append(f'''
+        SELECT 'color' AS scope, {_key('CAST(pv.color_id AS TEXT)')} AS summary_key, 0 AS product_count,
+               COUNT(*) AS variant_count, SUM(pv.current_stock) AS total_stock,
+               SUM(pv.current_stock * COALESCE(bp.wholesale_price, 0)) AS stock_value
+        FROM product_variants pv
+        JOIN base_products bp ON pv.base_product_id = bp.id
+        WHERE bp.id IN ({placeholders})
+        GROUP BY pv.color_id
+    ''')
+    cursor.execute(f'''
+        INSERT INTO inventory_summary (scope, summary_key, product_count, variant_count, total_stock, stock_value)
+        SELECT scope, summary_key, {sign} * product_count, {sign} * variant_count,
+               {sign} * total_stock, {sign} * stock_value
+        FROM ({' UNION ALL '.join(selects)}) d
+        WHERE true
+        ON CONFLICT (scope, summary_key) DO UPDATE SET
+            product_count = inventory_summary.product_count + excluded.product_count,
+            variant_count = inventory_summary.variant_count + excluded.variant_count,
+            total_stock = inventory_summary.total_stock + excluded.total_stock,
+            stock_value = inventory_summary.stock_value + excluded.stock_value
+    ''', list(product_ids) * (len(_PRODUCT_KEYS) + 1))
+
+
+def refresh_product_stock(cursor, product_ids):
+    """Recompute product_stock_summary of these products (after a deferred bulk write)"""
+    if not product_ids:
+        return
+    placeholders = ', '.join('?' for _ in product_ids)
+    cursor.execute(f'''
+        INSERT INTO product_stock_summary (product_id, total_stock)
+        SELECT bp.id, COALESCE(SUM(pv.current_stock), 0)
+        FROM base_products bp
+        LEFT JOIN product_variants pv ON pv.base_product_id = bp.id
+        WHERE bp.id IN ({placeholders})
+        GROUP BY bp.id
+        ON CONFLICT (product_id) DO UPDATE SET total_stock = excluded.total_stock
+    ''', list(product_ids))
@@ -0,0 +1,302 @@
+"""
+Log Archive Module
+Old stock_logs rows moved out of the database into monthly compressed segments
+
+Logs older than LOG_ARCHIVE_DAYS are written, one whole month at a time, to
+a gzip NDJSON segment (stock_logs_YYYY-MM.ndjson.gz under LOG_ARCHIVE_DIR,
+one JSON array per row in stock_logs column order) and deleted from
+stock_logs, so the hot table, its indexes and the JSON backups only hold
+the retention window.
+
+manifest.json lists the segments with their row count, id range, first /
+last created_date and sha256, plus archived_before - logs older than that
+live in the archive. Readers use the manifest to open only the segments
+overlapping the requested range.
+
+A segment is fully written to a temporary file and renamed into place
+before its rows are deleted from stock_logs. Archiving a month again (logs
+imported late) merges into its segment by id, so a run interrupted between
+the two steps is completed by the next one.
+
+The segments are the only copy of the archived rows, so they must survive a
+redeploy: rows are deleted only once their segment is durable - LOG_ARCHIVE_DIR
+is set explicitly (a persistent disk) or the segment and the manifest were
+uploaded to the backup. The default local directory is wiped on every deploy
+and is restored from the backup at startup.
+
+Only one archive run at a time: a run holds the log_archive_lock row (a
+lease that expires after LOG_ARCHIVE_LOCK_SECONDS if its worker died) and
+checks it again inside every delete transaction, so the daily thread and
+the admin route never archive - and count into log_stats - the same month
+twice. The manifest is always re-read from disk before a segment is merged
+into it.
+"""
+
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+
+LOG_ARCHIVE_DAYS = int(os.environ.get('LOG_ARCHIVE_DAYS', 365))
+LOG_ARCHIVE_DIR = os.environ.get('LOG_ARCHIVE_DIR', 'log_archive')
+# LOG_ARCHIVE_DIR set explicitly = a persistent disk; the default directory is not
+LOG_ARCHIVE_PERSISTENT = 'LOG_ARCHIVE_DIR' in os.environ
+LOG_ARCHIVE_LOCK_SECONDS = int(os.environ.get('LOG_ARCHIVE_LOCK_SECONDS', 3600))
+
+MANIFEST_NAME = 'manifest.json'
+
+# stock_logs column positions used by the filters
+_ID, _OPERATION, _CREATED = 0, 1, 16
+_SEARCH_COLUMNS = (4, 5, 7, 6)  # product_code, brand_name, color_name, product_type
+
+
+def archive_cutoff(days=LOG_ARCHIVE_DAYS, now=None):
+    """First day of the month containing now - days: logs before it are archived (whole months only)"""
+    now = now or datetime.now()
+    return (now - timedelta(days=days)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def month_range(month):
+    """('YYYY-MM-01 00:00:00', first day of the next month) for YYYY-MM"""
+    start = datetime.strptime(month, '%Y-%m')
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def segment_name(month):
+    return f'stock_logs_{month}.ndjson.gz'
+
+
+def create_lock_table(db, cursor):
+    """log_archive_lock - the lease held by the running archive run (migration 13)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS log_archive_lock (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            locked_until TIMESTAMP
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO log_archive_lock (name) VALUES ('stock_logs')")
+
+
+def _lock_until(now=None):
+    return ((now or datetime.now()) + timedelta(seconds=LOG_ARCHIVE_LOCK_SECONDS)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def acquire_lock(cursor, owner):
+    """Take the archive lease unless another run holds it - commit right after"""
+    now = datetime.now()
+    cursor.execute('''
+        UPDATE log_archive_lock SET owner = ?, locked_until = ?
+        WHERE name = 'stock_logs' AND (owner IS NULL OR locked_until < ?)
+    ''', (owner, _lock_until(now), now.strftime('%Y-%m-%d %H:%M:%S')))
+    return cursor.rowcount == 1
+
+
+def renew_lock(cursor, owner):
+    """
+    First statement of a delete transaction - False when the lease was lost
+
+    The UPDATE locks the row (the SQLite database) until the commit, so the
+    rows counted and deleted after it cannot change under the run.
+    """
+    cursor.execute('''
+        UPDATE log_archive_lock SET locked_until = ?
+        WHERE name = 'stock_logs' AND owner = ?
+    ''', (_lock_until(), owner))
+    return cursor.rowcount == 1
+
+
+def release_lock(cursor, owner):
+    cursor.execute("UPDATE log_archive_lock SET owner = NULL, locked_until = NULL WHERE name = 'stock_logs' AND owner = ?",
+                   (owner,))
+
+
+# One lock per directory for every LogArchive in the process
+_directory_locks = {}
+_directory_locks_guard = threading.Lock()
+
+
+def _directory_lock(directory):
+    with _directory_locks_guard:
+        return _directory_locks.setdefault(os.path.abspath(directory), threading.RLock())
+
+
+class LogArchive:
+    """Monthly gzip NDJSON segments of archived stock_logs rows plus their manifest"""
+
+    def __init__(self, directory=LOG_ARCHIVE_DIR, persistent=LOG_ARCHIVE_PERSISTENT):
+        self.directory = directory
+        self.persistent = persistent
+        self._lock = _directory_lock(directory)
+        self._manifest = None
+        self._manifest_mtime = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _manifest_stat(self):
+        try:
+            return os.stat(self.path(MANIFEST_NAME)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def manifest(self):
+        """
+        {'archived_before', 'columns', 'segments': {YYYY-MM: {...}}} - empty when nothing was archived
+
+        Cached until the file changes on disk (another LogArchive, a restore).
+        """
+        with self._lock:
+            mtime = self._manifest_stat()
+            if self._manifest is None or mtime != self._manifest_mtime:
+                try:
+                    with open(self.path(MANIFEST_NAME), 'r', encoding='utf-8') as f:
+                        self._manifest = json.load(f)
+                except FileNotFoundError:
+                    self._manifest = {'archived_before': None, 'columns': [], 'segments': {}}
+                self._manifest_mtime = mtime
+            return self._manifest
+
+    def reload(self):
+        """Forget the cached manifest (files restored from the backup)"""
+        with self._lock:
+            self._manifest = None
+
+    def has_manifest(self):
+        return os.path.exists(self.path(MANIFEST_NAME))
+
+    @property
+    def archived_before(self):
+        return self.manifest()['archived_before']
+
+    def _write_file(self, name, write):
+        """Write through a temporary file renamed into place"""
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.path(name + '.tmp')
+        write(temp_path)
+        os.replace(temp_path, self.path(name))
+        return self.path(name)
+
+    def read_segment(self, month):
+        """Rows of one segment as tuples, ordered by (created_date, id)"""
+        segment = self.manifest()['segments'].get(month)
+        if segment is None:
+            return []
+        try:
+            with gzip.open(self.path(segment['file']), 'rt', encoding='utf-8') as f:
+                return [tuple(json.loads(line)) for line in f if line.strip()]
+        except FileNotFoundError:
+            print(f"⚠️ Log archive segment missing: {segment['file']}")
+            return []
+
+    def write_month(self, month, columns, rows, archived_before):
+        """
+        Merge rows (stock_logs tuples of one month) into the month's segment
+
+        Returns the paths written (segment, manifest) - the caller deletes the
+        rows from stock_logs only after this returned.
+        """
+        with self._lock:
+            # re-read from disk - another LogArchive may have written since it was cached
+            self.reload()
+            return self._write_month(month, columns, rows, archived_before)
+
+    def _write_month(self, month, columns, rows, archived_before):
+        merged = {row[_ID]: tuple(row) for row in self.read_segment(month)}
+        merged.update((row[_ID], tuple(row)) for row in rows)
+        ordered = sorted(merged.values(), key=lambda row: (str(row[_CREATED]), row[_ID]))
+
+        def write_segment(temp_path):
+            with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+                for row in ordered:
+                    f.write(json.dumps(row, ensure_ascii=False, default=str))
+                    f.write('\n')
+
+        name = segment_name(month)
+        segment_path = self._write_file(name, write_segment)
+        digest = hashlib.sha256()
+        with open(segment_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+
+        manifest = json.loads(json.dumps(self.manifest()))
+        manifest['columns'] = list(columns)
+        manifest['segments'][month] = {
+            'file': name,
+            'rows': len(ordered),
+            'min_id': min(row[_ID] for row in ordered),
+            'max_id': max(row[_ID] for row in ordered),
+            'first': str(ordered[0][_CREATED]),
+            'last': str(ordered[-1][_CREATED]),
+            'sha256': digest.hexdigest(),
+        }
+        if not manifest['archived_before'] or archived_before > manifest['archived_before']:
+            manifest['archived_before'] = archived_before
+
+        def write_manifest(temp_path):
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+        manifest_path = self._write_file(MANIFEST_NAME, write_manifest)
+        self._manifest = manifest
+        self._manifest_mtime = self._manifest_stat()
+        return [segment_path, manifest_path]
+
+    def months(self, start=None, end=None):
+        """Months whose segment overlaps [start, end) - newest first"""
+        months = []
+        for month, segment in self.manifest()['segments'].items():
+            if start and segment['last'] < start:
+                continue
+            if end and segment['first'] >= end:
+                continue
+            months.append(month)
+        return sorted(months, reverse=True)
+
+    def iter_rows(self):
+        """Every archived row, segment by segment"""
+        for month in self.months():
+            yield from self.read_segment(month)
+
+    def iter_matching(self, start=None, end=None, operation=None, search=None, before=None):
+        """
+        Archived logs matching the /logs filters, newest first (created_date DESC, id DESC)
+
+        start / end are 'YYYY-MM-DD HH:MM:SS' bounds (end exclusive), search is
+        a case-insensitive substring of code / brand / color / type like the
+        LIKE filter, before=(created_date, id) continues a keyset page. Only
+        one segment is held in memory at a time.
+        """
+        search = search.lower() if search else None
+        before = (str(before[0]), before[1]) if before else None
+        for month in self.months(start, end):
+            if before and self.manifest()['segments'][month]['first'] > before[0]:
+                continue
+            for row in reversed(self.read_segment(month)):
+                created = str(row[_CREATED])
+                if (start and created < start) or (end and created >= end):
+                    continue
+                if before and (created, row[_ID]) >= before:
+                    continue
+                if operation and row[_OPERATION] != operation:
+                    continue
+                if search and not any(search in str(row[i] or '').lower() for i in _SEARCH_COLUMNS):
+                    continue
+                yield row
+
+    def find(self, start=None, end=None, operation=None, search=None, before=None, limit=100):
+        """First limit rows of iter_matching()"""
+        return list(itertools.islice(self.iter_matching(start, end, operation, search, before), limit))
+
+    def stats(self):
+        manifest = self.manifest()
+        return {
+            'archived_before': manifest['archived_before'],
+            'segments': len(manifest['segments']),
+            'rows': sum(segment['rows'] for segment in manifest['segments'].values()),
+        }
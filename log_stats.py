@@ -0,0 +1,183 @@
+"""
+Log Stats Module
+Counters behind the /logs header kept up to date by database triggers
+
+log_stats holds one row per (scope, stat_key):
+    total     ''           - every log
+    day       YYYY-MM-DD   - logs of one day (the "today" counter)
+with log_count, added (sum of positive change_amount) and removed (sum of
+the absolute negative change_amount). log_product_activity counts the logs
+of every (product_code, brand_name); its log_count index serves the "most
+active products" top-N without a GROUP BY over stock_logs.
+
+Triggers on stock_logs apply every insert / delete, whichever path writes
+the row (routes, bulk logs, the background log writer, JSON imports).
+rebuild() recomputes both tables from stock_logs for repair. Logs moved to
+the archive (log_archive) stay counted - see count_rows().
+"""
+
+_UPSERT = '''
+    INSERT INTO log_stats (scope, stat_key, log_count, added, removed)
+    SELECT scope, stat_key, log_count, added, removed
+    FROM ({deltas}) d
+    WHERE true
+    ON CONFLICT (scope, stat_key) DO UPDATE SET
+        log_count = log_stats.log_count + excluded.log_count,
+        added = log_stats.added + excluded.added,
+        removed = log_stats.removed + excluded.removed
+'''
+
+_PRODUCT_UPSERT = '''
+    INSERT INTO log_product_activity (product_code, brand_name, log_count)
+    SELECT {row}.product_code, COALESCE({row}.brand_name, ''), {sign}
+    WHERE {row}.product_code IS NOT NULL
+    ON CONFLICT (product_code, brand_name) DO UPDATE SET
+        log_count = log_product_activity.log_count + excluded.log_count
+'''
+
+# stock_logs.created_date -> log_stats day key
+_DAY_KEY = "COALESCE(CAST(DATE({column}) AS TEXT), '')"
+
+
+def _deltas(row, sign):
+    """Delta rows of one log (NEW / OLD)"""
+    added = f'CASE WHEN {row}.change_amount > 0 THEN {row}.change_amount ELSE 0 END'
+    removed = f'CASE WHEN {row}.change_amount < 0 THEN -{row}.change_amount ELSE 0 END'
+    return f'''
+        SELECT 'total' AS scope, '' AS stat_key, {sign} AS log_count,
+               {sign} * {added} AS added, {sign} * {removed} AS removed
+        UNION ALL
+        SELECT 'day', {_DAY_KEY.format(column=f'{row}.created_date')}, {sign},
+               {sign} * {added}, {sign} * {removed}
+    '''
+
+
+def _trigger_bodies():
+    """(name, event, table, [statements]) for every log stats trigger"""
+    log_insert = [_UPSERT.format(deltas=_deltas('NEW', 1)),
+                  _PRODUCT_UPSERT.format(row='NEW', sign=1)]
+    log_delete = [_UPSERT.format(deltas=_deltas('OLD', -1)),
+                  _PRODUCT_UPSERT.format(row='OLD', sign=-1),
+                  '''DELETE FROM log_product_activity
+                     WHERE product_code = OLD.product_code AND log_count <= 0''']
+    return [
+        ('trg_log_stats_ins', 'INSERT', 'stock_logs', log_insert),
+        ('trg_log_stats_upd', 'UPDATE OF change_amount, created_date, product_code, brand_name',
+         'stock_logs', log_delete + log_insert),
+        ('trg_log_stats_del', 'DELETE', 'stock_logs', log_delete),
+    ]
+
+
+def create_stats_tables(db, cursor):
+    """Tables, triggers and initial fill (migration 9)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS log_stats (
+            scope TEXT NOT NULL,
+            stat_key TEXT NOT NULL,
+            log_count INTEGER NOT NULL DEFAULT 0,
+            added INTEGER NOT NULL DEFAULT 0,
+            removed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, stat_key)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS log_product_activity (
+            product_code TEXT NOT NULL,
+            brand_name TEXT NOT NULL DEFAULT '',
+            log_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (product_code, brand_name)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_log_product_activity_count ON log_product_activity(log_count)')
+
+    for name, event, table, statements in _trigger_bodies():
+        body = ';\n'.join(statements)
+        if db.db_type == 'postgresql':
+            cursor.execute(f'''
+                CREATE OR REPLACE FUNCTION {name}_fn() RETURNS trigger AS $$
+                BEGIN
+                    {body};
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name} ON {table}')
+            cursor.execute(f'''
+                CREATE TRIGGER {name} AFTER {event} ON {table}
+                FOR EACH ROW EXECUTE PROCEDURE {name}_fn()
+            ''')
+        else:
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table}
+                BEGIN
+                    {body};
+                END
+            ''')
+
+    rebuild(cursor)
+
+
+def rebuild(cursor):
+    """Recompute log_stats and log_product_activity from stock_logs"""
+    cursor.execute('DELETE FROM log_stats')
+    cursor.execute('DELETE FROM log_product_activity')
+
+    sums = '''COUNT(*),
+              COALESCE(SUM(CASE WHEN change_amount > 0 THEN change_amount ELSE 0 END), 0),
+              COALESCE(SUM(CASE WHEN change_amount < 0 THEN -change_amount ELSE 0 END), 0)'''
+    cursor.execute(f'''
+        INSERT INTO log_stats (scope, stat_key, log_count, added, removed)
+        SELECT 'total', '', {sums} FROM stock_logs
+    ''')
+    day_key = _DAY_KEY.format(column='created_date')
+    cursor.execute(f'''
+        INSERT INTO log_stats (scope, stat_key, log_count, added, removed)
+        SELECT 'day', {day_key}, {sums} FROM stock_logs
+        GROUP BY {day_key}
+    ''')
+    cursor.execute('''
+        INSERT INTO log_product_activity (product_code, brand_name, log_count)
+        SELECT product_code, COALESCE(brand_name, ''), COUNT(*)
+        FROM stock_logs
+        WHERE product_code IS NOT NULL
+        GROUP BY product_code, COALESCE(brand_name, '')
+    ''')
+
+
+def count_rows(cursor, rows):
+    """
+    Add stock_logs rows (tuples in column order) to the counters
+
+    Called with the rows being archived before they are deleted - the delete
+    triggers then take them out again, so archived logs keep counting - and
+    by the archive-aware rebuild for the rows already in the archive.
+    """
+    totals = {}
+    products = {}
+    for row in rows:
+        change = row[11] or 0
+        for key in (('total', ''), ('day', str(row[16])[:10] if row[16] else '')):
+            counter = totals.setdefault(key, [0, 0, 0])
+            counter[0] += 1
+            counter[1] += max(change, 0)
+            counter[2] += max(-change, 0)
+        if row[4] is not None:
+            product = (row[4], row[5] or '')
+            products[product] = products.get(product, 0) + 1
+
+    if totals:
+        cursor.executemany('''
+            INSERT INTO log_stats (scope, stat_key, log_count, added, removed)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (scope, stat_key) DO UPDATE SET
+                log_count = log_stats.log_count + excluded.log_count,
+                added = log_stats.added + excluded.added,
+                removed = log_stats.removed + excluded.removed
+        ''', [(*key, *counter) for key, counter in totals.items()])
+    if products:
+        cursor.executemany('''
+            INSERT INTO log_product_activity (product_code, brand_name, log_count)
+            VALUES (?, ?, ?)
+            ON CONFLICT (product_code, brand_name) DO UPDATE SET
+                log_count = log_product_activity.log_count + excluded.log_count
+        ''', [(*product, count) for product, count in products.items()])
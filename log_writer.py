@@ -0,0 +1,190 @@
+"""
+Stock Log Writer Module
+Background writer that group-commits stock_logs rows
+
+Callers hand rows to submit() and return immediately; one thread drains the
+bounded queue and writes a batch with a single executemany + commit every
+STOCK_LOG_BATCH_SIZE rows or STOCK_LOG_FLUSH_MS milliseconds, whichever
+comes first. When the queue is full the caller gets the rows back and
+writes them itself, so a slow database slows requests down instead of
+growing memory. close() drains the queue - it is registered to run on
+shutdown.
+
+A batch that fails (typically "database is locked" while an import chunk or
+the log archive holds the SQLite write lock) is retried STOCK_LOG_RETRIES
+times with exponential backoff, then written row by row so one bad row
+cannot take the others with it. Rows that still fail are appended to
+STOCK_LOG_FAILED_FILE (NDJSON, STOCK_LOG_INSERT column order) and reported
+in stats() - /health turns degraded - instead of being dropped.
+
+Enabled with STOCK_LOG_ASYNC=1; without it every log is written inline.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+
+
+STOCK_LOG_ASYNC = os.environ.get('STOCK_LOG_ASYNC', '0').lower() in ('1', 'true', 'yes')
+STOCK_LOG_QUEUE_SIZE = int(os.environ.get('STOCK_LOG_QUEUE_SIZE', 10000))
+STOCK_LOG_BATCH_SIZE = int(os.environ.get('STOCK_LOG_BATCH_SIZE', 500))
+STOCK_LOG_FLUSH_MS = int(os.environ.get('STOCK_LOG_FLUSH_MS', 200))
+STOCK_LOG_RETRIES = int(os.environ.get('STOCK_LOG_RETRIES', 4))
+STOCK_LOG_RETRY_MS = int(os.environ.get('STOCK_LOG_RETRY_MS', 100))
+STOCK_LOG_FAILED_FILE = os.environ.get('STOCK_LOG_FAILED_FILE', 'stock_logs_failed.ndjson')
+
+# how long submit() waits for room in a full queue before handing rows back
+_PUT_TIMEOUT = 1.0
+
+_STOP = object()
+
+
+class StockLogWriter:
+    """Bounded queue of stock_logs rows drained by one group-commit thread"""
+
+    def __init__(self, write_rows, max_queue=STOCK_LOG_QUEUE_SIZE,
+                 batch_size=STOCK_LOG_BATCH_SIZE, flush_ms=STOCK_LOG_FLUSH_MS,
+                 retries=STOCK_LOG_RETRIES, retry_ms=STOCK_LOG_RETRY_MS,
+                 failed_file=STOCK_LOG_FAILED_FILE):
+        # write_rows(rows) inserts a list of row tuples in one transaction
+        self._write_rows = write_rows
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000.0
+        self.retries = retries
+        self.retry_delay = retry_ms / 1000.0
+        self.failed_file = failed_file
+        self._lock = threading.Lock()
+        self._closed = False
+        self._written = 0
+        self._batches = 0
+        self._failed = 0
+        self._retried = 0
+        self._last_error = None
+        self._overflow = 0
+        self._thread = threading.Thread(target=self._run, daemon=True, name='stock-log-writer')
+        self._thread.start()
+
+    def submit(self, rows):
+        """Queue rows - returns how many were queued, the caller writes the rest itself"""
+        if self._closed:
+            return 0
+        for queued, row in enumerate(rows):
+            try:
+                self._queue.put(row, timeout=_PUT_TIMEOUT)
+            except queue.Full:
+                with self._lock:
+                    self._overflow += len(rows) - queued
+                return queued
+        return len(rows)
+
+    def flush(self):
+        """Block until every queued row is written"""
+        self._queue.join()
+
+    def close(self):
+        """Write what is left and stop the thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write(self, batch):
+        error = self._write_with_retries(batch)
+        if error is None:
+            with self._lock:
+                self._written += len(batch)
+                self._batches += 1
+            return
+
+        print(f"⚠️ Writing {len(batch)} stock logs failed ({error}) - writing them one by one")
+        failed = []
+        for row in batch:
+            try:
+                self._write_rows([row])
+            except Exception as e:
+                failed.append(row)
+                error = e
+        with self._lock:
+            self._written += len(batch) - len(failed)
+            self._batches += 1
+        if failed:
+            self._keep_failed(failed, error)
+
+    def _write_with_retries(self, rows):
+        """None once written, else the last exception after self.retries retries"""
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                self._write_rows(rows)
+                return None
+            except Exception as e:
+                error = e
+            if attempt < self.retries:
+                with self._lock:
+                    self._retried += 1
+                time.sleep(delay)
+                delay *= 2
+        return error
+
+    def _keep_failed(self, rows, error):
+        """Append rows that could not be written to failed_file so they can be inserted again"""
+        with self._lock:
+            self._failed += len(rows)
+            self._last_error = f'{time.strftime("%Y-%m-%d %H:%M:%S")}: {error}'
+        try:
+            with open(self.failed_file, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False, default=str))
+                    f.write('\n')
+            print(f"❌ {len(rows)} stock logs could not be written ({error}) - kept in {self.failed_file}")
+        except OSError as e:
+            print(f"❌ {len(rows)} stock logs lost ({error}), could not write {self.failed_file}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_queue': self._queue.maxsize,
+                'batch_size': self.batch_size,
+                'flush_ms': int(self.flush_interval * 1000),
+                'written': self._written,
+                'batches': self._batches,
+                'failed': self._failed,
+                'retried': self._retried,
+                'last_error': self._last_error,
+                'failed_file': self.failed_file if self._failed else None,
+                'overflow': self._overflow,
+                'closed': self._closed,
+            }
@@ -0,0 +1,149 @@
+"""
+Payload Cache Module
+Server-side cache of computed page payloads (dashboard, stock trend API)
+
+Every key remembers the function that computes it. A fresh entry is served
+as is; an entry older than the TTL is still served while the background
+worker recomputes it (stale-while-revalidate). Only the very first request
+for a key waits for the computation.
+
+mark_stale() is called after stock-changing requests: bursts of writes are
+debounced into one refresh of every cached key, and readers keep getting
+the previous payload until the new one is ready.
+
+The cache holds at most PAYLOAD_CACHE_MAX_KEYS keys (least recently used
+evicted) and every refresh runs on a single worker thread, one key after
+the other, so neither the memory nor the load of a refresh grows with the
+number of distinct requests.
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+PAYLOAD_CACHE_TTL = float(os.environ.get('DASHBOARD_CACHE_TTL', 60))
+PAYLOAD_REFRESH_DEBOUNCE = float(os.environ.get('DASHBOARD_REFRESH_DEBOUNCE', 2))
+PAYLOAD_CACHE_MAX_KEYS = int(os.environ.get('DASHBOARD_CACHE_MAX_KEYS', 64))
+
+
+class PayloadCache:
+    """Keyed payloads with TTL, LRU bound, stale-while-revalidate and debounced refresh"""
+
+    def __init__(self, ttl=PAYLOAD_CACHE_TTL, debounce=PAYLOAD_REFRESH_DEBOUNCE,
+                 max_keys=PAYLOAD_CACHE_MAX_KEYS):
+        self.ttl = ttl
+        self.debounce = debounce
+        self.max_keys = max_keys
+        self._entries = OrderedDict()   # key -> (payload, computed_at), least recently used first
+        self._computes = {}             # key -> compute()
+        self._refreshing = set()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._timer = None
+        self._hits = 0
+        self._misses = 0
+        self._refreshes = 0
+        self._evictions = 0
+
+    def get(self, key, compute):
+        """Cached payload of key - compute() runs inline only when nothing is cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._hits += 1
+                self._computes[key] = compute
+                self._entries.move_to_end(key)
+                if time.monotonic() - entry[1] >= self.ttl:
+                    self._start_refresh(key)
+                return entry[0]
+            self._misses += 1
+
+        payload = compute()
+        with self._lock:
+            self._computes[key] = compute
+            self._store(key, payload)
+        return payload
+
+    def mark_stale(self):
+        """Schedule one refresh of every key - repeated calls within the debounce window collapse"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce, self._refresh_all)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._computes.clear()
+
+    def _store(self, key, payload):
+        # caller holds self._lock
+        self._entries[key] = (payload, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            evicted, _ = self._entries.popitem(last=False)
+            self._computes.pop(evicted, None)
+            self._evictions += 1
+
+    def _refresh_all(self):
+        with self._lock:
+            self._timer = None
+            for key in list(self._entries):
+                self._start_refresh(key)
+
+    def _start_refresh(self, key):
+        # caller holds self._lock
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        self._queue.put(key)
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, daemon=True, name='payload-refresh')
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            self._refresh(self._queue.get())
+
+    def _refresh(self, key):
+        try:
+            with self._lock:
+                compute = self._computes.get(key)
+            # evicted while it waited in the queue
+            if compute is None:
+                return
+            payload = compute()
+            with self._lock:
+                # in place - a refresh does not make the key recently used
+                if key in self._entries:
+                    self._entries[key] = (payload, time.monotonic())
+                    self._refreshes += 1
+        except Exception as e:
+            # keep serving the previous payload
+            print(f"❌ Payload refresh failed for {key}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'keys': len(self._entries),
+                'max_keys': self.max_keys,
+                'oldest_age': round(max((now - at for _, at in self._entries.values()), default=0), 1),
+                'refreshing': len(self._refreshing),
+                'refresh_pending': self._timer is not None,
+                'hits': self._hits,
+                'misses': self._misses,
+                'refreshes': self._refreshes,
+                'evictions': self._evictions,
+                'ttl': self.ttl,
+                'debounce': self.debounce,
+            }
@@ -0,0 +1,297 @@
+"""
+Snapshot Trends Module
+Stock quantity / value trend series built from stock_snapshots
+
+stock_snapshots holds one row per day. For long ranges the dashboard chart
+reads stock_snapshot_rollups instead - one row per week (starting Monday)
+and per month with the lowest and highest quantity / value of the period
+and the days they were reached, so a spike inside a week still shows on a
+five year chart. The rollups are refreshed from the snapshots each time
+snapshots are written.
+
+stock_snapshot_dimensions keeps the daily quantity / value per brand,
+trader category and product type, copied by the snapshot job from the
+inventory_summary rows the triggers already maintain. Trends filtered by
+one of them read only that dimension's daily rows.
+
+Whatever the range, a trend returns at most max_points points: the finest
+resolution that keeps the rows read small is picked, then the series is
+reduced with LTTB (largest-triangle-three-buckets), which keeps the points
+that shape the curve - peaks and troughs survive the downsampling.
+"""
+
+import os
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+
+TREND_MAX_POINTS = int(os.environ.get('TREND_MAX_POINTS', 200))
+
+# a resolution is used while it has at most this many points per returned point
+_RESOLUTION_FACTOR = 4
+
+PERIODS = ('week', 'month')
+
+# stock_snapshot_dimensions.dimension values - the matching inventory_summary scopes
+DIMENSIONS = ('brand', 'category', 'type')
+
+# stock_snapshots column -> rollup column suffix
+_SERIES = {'total_quantity': 'quantity', 'total_value': 'value'}
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+def period_start(day, period):
+    """First day of the week (Monday) / month containing day"""
+    day = _to_date(day)
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _period_starts(start, end, period):
+    """Every period start from the period of start to the period of end, as YYYY-MM-DD"""
+    if period == 'day':
+        days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+        return days.astype(str).tolist()
+    if period == 'week':
+        weeks = np.arange(np.datetime64(period_start(start, 'week'), 'D'),
+                          np.datetime64(end, 'D') + 1, 7)
+        return weeks.astype(str).tolist()
+    months = np.arange(np.datetime64(start, 'M'), np.datetime64(end, 'M') + 1)
+    return months.astype('datetime64[D]').astype(str).tolist()
+
+
+def create_rollup_table(db, cursor):
+    """Rollup table and initial fill (migration 6)"""
+    value_type = 'DOUBLE PRECISION' if db.db_type == 'postgresql' else 'REAL'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS stock_snapshot_rollups (
+            period TEXT NOT NULL,
+            period_start DATE NOT NULL,
+            snapshot_count INTEGER NOT NULL DEFAULT 0,
+            min_quantity INTEGER,
+            min_quantity_date DATE,
+            max_quantity INTEGER,
+            max_quantity_date DATE,
+            min_value {value_type},
+            min_value_date DATE,
+            max_value {value_type},
+            max_value_date DATE,
+            PRIMARY KEY (period, period_start)
+        )
+    ''')
+    refresh_rollups(cursor)
+
+
+def refresh_rollups(cursor, since=None):
+    """
+    Recompute the week / month rollups of every period containing a day >= since
+
+    since=None rebuilds all of them. Called in the same transaction as the
+    snapshot writes.
+    """
+    params = ()
+    query = 'SELECT snapshot_date, total_quantity, total_value FROM stock_snapshots'
+    if since is not None:
+        since = min(period_start(since, period) for period in PERIODS).strftime('%Y-%m-%d')
+        query += ' WHERE snapshot_date >= ?'
+        params = (since,)
+    cursor.execute(query + ' ORDER BY snapshot_date', params)
+    snapshots = [(_to_date(row[0]), row[1], row[2]) for row in cursor.fetchall()]
+
+    rows = []
+    for period in PERIODS:
+        periods = {}
+        for day, quantity, value in snapshots:
+            start = period_start(day, period).strftime('%Y-%m-%d')
+            day = day.strftime('%Y-%m-%d')
+            row = periods.get(start)
+            if row is None:
+                periods[start] = [1, quantity, day, quantity, day, value, day, value, day]
+                continue
+            row[0] += 1
+            if quantity < row[1]:
+                row[1:3] = quantity, day
+            if quantity > row[3]:
+                row[3:5] = quantity, day
+            if value < row[5]:
+                row[5:7] = value, day
+            if value > row[7]:
+                row[7:9] = value, day
+        # a period that starts before since is only partly read - it did not change
+        rows.extend((period, start, *row) for start, row in periods.items()
+                    if since is None or start >= since)
+
+    if since is None:
+        cursor.execute('DELETE FROM stock_snapshot_rollups')
+    else:
+        cursor.execute('DELETE FROM stock_snapshot_rollups WHERE period_start >= ?', (since,))
+    if rows:
+        cursor.executemany('''
+            INSERT INTO stock_snapshot_rollups
+            (period, period_start, snapshot_count, min_quantity, min_quantity_date,
+             max_quantity, max_quantity_date, min_value, min_value_date, max_value, max_value_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+
+def create_dimension_table(db, cursor):
+    """Per brand / category / type snapshot table (migration 7)"""
+    value_type = 'DOUBLE PRECISION' if db.db_type == 'postgresql' else 'REAL'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS stock_snapshot_dimensions (
+            snapshot_date DATE NOT NULL,
+            dimension TEXT NOT NULL,
+            dimension_key TEXT NOT NULL,
+            total_quantity INTEGER NOT NULL DEFAULT 0,
+            total_value {value_type} NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, dimension_key, snapshot_date)
+        )
+    ''')
+
+
+def write_dimension_snapshot(cursor, day):
+    """Replace the dimension rows of day with the current inventory_summary totals"""
+    placeholders = ', '.join('?' for _ in DIMENSIONS)
+    cursor.execute('DELETE FROM stock_snapshot_dimensions WHERE snapshot_date = ?', (day,))
+    cursor.execute(f'''
+        INSERT INTO stock_snapshot_dimensions
+        (snapshot_date, dimension, dimension_key, total_quantity, total_value)
+        SELECT DATE(?), scope, summary_key, total_stock, stock_value
+        FROM inventory_summary
+        WHERE scope IN ({placeholders})
+    ''', (day, *DIMENSIONS))
+
+
+def lttb(x, y, threshold):
+    """
+    Indices of the threshold points of (x, y) picked by largest-triangle-three-buckets
+
+    The first and last points are always kept. The inner points are split
+    into threshold - 2 buckets; from each bucket the point forming the
+    largest triangle with the previously kept point and the average of the
+    next bucket is kept.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    edges = np.floor(np.linspace(1, n - 1, threshold - 1)).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+
+    a = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_x = x[end:edges[bucket + 2]].mean()
+            next_y = y[end:edges[bucket + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        areas = np.abs((x[a] - next_x) * (y[start:end] - y[a])
+                       - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[bucket + 1] = a
+    return selected
+
+
+def trend(cursor, column, days, max_points=TREND_MAX_POINTS, dimension=None):
+    """
+    Trend of one stock_snapshots column over the last days days (or 'lifetime')
+
+    dimension=(dimension, key) - e.g. ('brand', 3) or ('category', 'A') -
+    reads the daily rows of that key in stock_snapshot_dimensions instead.
+
+    Returns {'dates', 'points', 'missing_dates', 'has_data', 'resolution'}:
+    Daily series hold None where a date has no snapshot; week / month series
+    hold the low and high of each period on the days they were reached.
+    Series longer than max_points are reduced with lttb() - gaps are dropped
+    there. missing_dates lists the days / period starts without data.
+    """
+    if column not in _SERIES:
+        raise ValueError(f'Unknown snapshot column: {column}')
+
+    source, where, params = 'stock_snapshots', '', ()
+    if dimension is not None:
+        if dimension[0] not in DIMENSIONS:
+            raise ValueError(f'Unknown snapshot dimension: {dimension[0]}')
+        source = 'stock_snapshot_dimensions'
+        where = ' AND dimension = ? AND dimension_key = ?'
+        params = (dimension[0], str(dimension[1]))
+
+    today = datetime.now().date()
+    if days == 'lifetime':
+        cursor.execute(f'SELECT MIN(snapshot_date) FROM {source} WHERE true{where}', params)
+        first = cursor.fetchone()[0]
+        if first is None:
+            return {'dates': [], 'points': [], 'missing_dates': [], 'has_data': False, 'resolution': 'day'}
+        start = min(_to_date(first), today)
+    else:
+        start = today - timedelta(days=int(days) - 1)
+
+    span = (today - start).days + 1
+    if span <= max_points * _RESOLUTION_FACTOR or dimension is not None:
+        resolution = 'day'
+    elif span // 7 <= max_points * _RESOLUTION_FACTOR:
+        resolution = 'week'
+    else:
+        resolution = 'month'
+
+    if resolution == 'day':
+        cursor.execute(f'''
+            SELECT snapshot_date, {column}
+            FROM {source}
+            WHERE snapshot_date >= ?{where}
+            ORDER BY snapshot_date ASC
+        ''', (start.strftime('%Y-%m-%d'), *params))
+        stored = {str(row[0])[:10]: row[1] for row in cursor.fetchall()}
+        labels = _period_starts(start, today, 'day')
+        points = [stored.get(label) for label in labels]
+        missing_dates = [label for label, point in zip(labels, points) if point is None]
+    else:
+        # low and high of every period, placed on the days they were reached
+        series = _SERIES[column]
+        cursor.execute(f'''
+            SELECT period_start, min_{series}_date, min_{series}, max_{series}_date, max_{series}
+            FROM stock_snapshot_rollups
+            WHERE period = ? AND period_start >= ?
+            ORDER BY period_start ASC
+        ''', (resolution, period_start(start, resolution).strftime('%Y-%m-%d')))
+        rows = cursor.fetchall()
+        stored = {str(row[0])[:10] for row in rows}
+        missing_dates = [label for label in _period_starts(start, today, resolution) if label not in stored]
+        extremes = {}
+        for row in rows:
+            extremes[str(row[1])[:10]] = row[2]
+            extremes[str(row[3])[:10]] = row[4]
+        first_day = start.strftime('%Y-%m-%d')
+        labels = sorted(day for day in extremes if day >= first_day)
+        points = [extremes[day] for day in labels]
+
+    if len(labels) > max_points:
+        present = [i for i, point in enumerate(points) if point is not None]
+        ordinals = np.array([labels[i] for i in present], dtype='datetime64[D]').astype(np.int64)
+        values = np.array([points[i] for i in present], dtype=np.float64)
+        keep = lttb(ordinals, values, max_points)
+        labels = [labels[present[i]] for i in keep]
+        points = [points[present[i]] for i in keep]
+
+    return {
+        'dates': labels,
+        'points': points,
+        'missing_dates': missing_dates,
+        'has_data': len(stored) > 0,
+        'resolution': resolution,
+    }
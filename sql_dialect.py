@@ -0,0 +1,304 @@
+"""
+SQL Dialect Module
+Runs the SQLite flavoured SQL used across the app on PostgreSQL as well
+
+StockDatabase and the routes keep writing SQLite SQL ("?" placeholders,
+INSERT OR IGNORE, GROUP_CONCAT, DATE('now', ...), cursor.lastrowid).
+On PostgreSQL every cursor handed out by the pool is a DialectCursor that
+compiles each statement once (cached) and normalizes result values to the
+types sqlite3 returns, so callers never branch on the database type.
+"""
+
+import re
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+
+
+# Conflict target for INSERT OR REPLACE statements that do not list the id column
+UPSERT_KEYS = {
+    'color_images': ('variant_id',),
+    'stock_snapshots': ('snapshot_date',),
+    'barcodes': ('variant_id',),
+    'pages': ('page_key',),
+    'user_permissions': ('user_id', 'page_key'),
+    'product_tags': ('product_id', 'tag_id'),
+}
+
+# Tables without an "id" column - INSERTs into them get no RETURNING id
+TABLES_WITHOUT_ID = frozenset({'bulk_write_deferred', 'log_archive_lock'})
+
+
+class SQLiteDialect:
+    """SQLite is the reference dialect - nothing to translate"""
+
+    name = 'sqlite'
+    placeholder = '?'
+
+    def compile(self, sql, has_params=True, many=False):
+        return sql, False
+
+    def wrap_cursor(self, cursor):
+        return cursor
+
+
+class PostgresDialect:
+    """Translates SQLite SQL to PostgreSQL"""
+
+    name = 'postgresql'
+    placeholder = '%s'
+
+    def compile(self, sql, has_params=True, many=False):
+        """Return (postgres_sql, returns_id) - cached per statement text"""
+        return _compile_postgres(sql, has_params, many)
+
+    def wrap_cursor(self, cursor):
+        return DialectCursor(cursor, self)
+
+
+def get_dialect(db_type):
+    """Dialect object for StockDatabase.db_type"""
+    if db_type == 'postgresql':
+        return PostgresDialect()
+    return SQLiteDialect()
+
+
+class DialectCursor:
+    """
+    DB-API cursor wrapper used for PostgreSQL connections
+
+    Compiles SQL before execution, fills lastrowid from RETURNING id and
+    returns plain tuples with SQLite-like values (datetime/date -> str,
+    Decimal -> int/float), matching what the sqlite3 module gives callers.
+    """
+
+    def __init__(self, cursor, dialect):
+        self._cursor = cursor
+        self._dialect = dialect
+        self.lastrowid = None
+
+    def execute(self, sql, params=None):
+        compiled, returns_id = self._dialect.compile(sql, params is not None)
+        if params is None:
+            self._cursor.execute(compiled)
+        else:
+            self._cursor.execute(compiled, tuple(params))
+
+        self.lastrowid = None
+        if returns_id:
+            row = self._cursor.fetchone()
+            self.lastrowid = row[0] if row else None
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        compiled, _ = self._dialect.compile(sql, True, many=True)
+        self._cursor.executemany(compiled, [tuple(p) for p in seq_of_params])
+        self.lastrowid = None
+        return self
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        return _normalize_row(row) if row is not None else None
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        return [_normalize_row(row) for row in rows]
+
+    def fetchall(self):
+        return [_normalize_row(row) for row in self._cursor.fetchall()]
+
+    def __iter__(self):
+        for row in self._cursor:
+            yield _normalize_row(row)
+
+    def close(self):
+        self._cursor.close()
+
+    def __getattr__(self, name):
+        # rowcount, description, arraysize, ...
+        return getattr(self._cursor, name)
+
+
+def _normalize_value(value):
+    if isinstance(value, datetime):
+        # keeps microseconds when present so (created_date, id) keyset cursors stay exact
+        return value.isoformat(sep=' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        # SUM() over INTEGER columns comes back as NUMERIC with no fraction
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    return value
+
+
+def _normalize_row(row):
+    return tuple(_normalize_value(value) for value in row)
+
+
+# === COMPILER ===
+
+_AUTOINCREMENT_RE = re.compile(r'\bINTEGER\s+PRIMARY\s+KEY\s+AUTOINCREMENT\b', re.IGNORECASE)
+_DATETIME_TYPE_RE = re.compile(r'\bDATETIME\b(?!\s*\()', re.IGNORECASE)
+_ADD_COLUMN_RE = re.compile(r'\bADD\s+COLUMN\s+(?!IF\s+NOT\s+EXISTS\b)', re.IGNORECASE)
+_LIKE_RE = re.compile(r'\bLIKE\b', re.IGNORECASE)
+_INSERT_OR_RE = re.compile(
+    r'^\s*INSERT\s+OR\s+(IGNORE|REPLACE)\s+INTO\s+(\w+)\s*(?:\(([^)]*)\))?',
+    re.IGNORECASE
+)
+_INSERT_VALUES_RE = re.compile(r'^\s*INSERT\s+INTO\s+(\w+)\b.*\bVALUES\b', re.IGNORECASE | re.DOTALL)
+_RETURNING_RE = re.compile(r'\bRETURNING\b', re.IGNORECASE)
+_CONFLICT_RE = re.compile(r'\bON\s+CONFLICT\b', re.IGNORECASE)
+_DISTINCT_RE = re.compile(r'^DISTINCT\s+(.*)$', re.IGNORECASE | re.DOTALL)
+
+
+@lru_cache(maxsize=2048)
+def _compile_postgres(sql, has_params, many):
+    # DDL types
+    sql = _AUTOINCREMENT_RE.sub('SERIAL PRIMARY KEY', sql)
+    sql = _DATETIME_TYPE_RE.sub('TIMESTAMP', sql)
+    sql = _ADD_COLUMN_RE.sub('ADD COLUMN IF NOT EXISTS ', sql)
+
+    # Functions
+    sql = _rewrite_calls(sql, 'DATETIME', lambda args: _render_date(args, 'TIMESTAMP'))
+    sql = _rewrite_calls(sql, 'DATE', lambda args: _render_date(args, 'DATE'))
+    sql = _rewrite_calls(sql, 'GROUP_CONCAT', _render_group_concat)
+
+    # SQLite LIKE is case-insensitive for ASCII, PostgreSQL LIKE is not
+    sql = _LIKE_RE.sub('ILIKE', sql)
+
+    sql = _rewrite_insert_or(sql)
+
+    returns_id = False
+    if not many:
+        match = _INSERT_VALUES_RE.match(sql)
+        if match and match.group(1).lower() not in TABLES_WITHOUT_ID and not _RETURNING_RE.search(sql):
+            sql = _append_clause(sql, 'RETURNING id')
+            returns_id = True
+
+    return _convert_placeholders(sql, has_params), returns_id
+
+
+def _rewrite_insert_or(sql):
+    match = _INSERT_OR_RE.match(sql)
+    if not match:
+        return sql
+
+    action = match.group(1).upper()
+    table = match.group(2)
+    columns = [c.strip() for c in (match.group(3) or '').split(',') if c.strip()]
+    head = f"INSERT INTO {table}" + (f" ({', '.join(columns)})" if columns else '')
+    sql = head + sql[match.end():]
+
+    if _CONFLICT_RE.search(sql):
+        return sql
+    if action == 'IGNORE':
+        return _append_clause(sql, 'ON CONFLICT DO NOTHING')
+
+    if 'id' in columns:
+        keys = ('id',)
+    elif table.lower() in UPSERT_KEYS:
+        keys = UPSERT_KEYS[table.lower()]
+    else:
+        raise ValueError(f"INSERT OR REPLACE INTO {table}: no conflict key known for PostgreSQL")
+
+    updates = [c for c in columns if c not in keys]
+    if updates:
+        assignments = ', '.join(f'{c} = EXCLUDED.{c}' for c in updates)
+        clause = f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {assignments}"
+    else:
+        clause = f"ON CONFLICT ({', '.join(keys)}) DO NOTHING"
+    return _append_clause(sql, clause)
+
+
+def _append_clause(sql, clause):
+    body = sql.rstrip().rstrip(';').rstrip()
+    return f'{body} {clause}'
+
+
+def _render_date(args, cast_type):
+    """DATE()/DATETIME() with SQLite modifiers -> CAST(... + INTERVAL AS type)"""
+    base, modifiers = args[0], args[1:]
+    if base.strip().lower() == "'now'":
+        expr = 'CURRENT_TIMESTAMP'
+    elif not modifiers:
+        return f'CAST({base} AS {cast_type})'
+    else:
+        expr = f'CAST({base} AS TIMESTAMP)'
+    for modifier in modifiers:
+        expr = f'{expr} + CAST({modifier} AS INTERVAL)'
+    return f'CAST({expr} AS {cast_type})'
+
+
+def _render_group_concat(args):
+    expr = args[0]
+    separator = args[1] if len(args) > 1 else "','"
+    distinct = ''
+    match = _DISTINCT_RE.match(expr)
+    if match:
+        distinct = 'DISTINCT '
+        expr = match.group(1)
+    return f'STRING_AGG({distinct}CAST({expr} AS TEXT), {separator})'
+
+
+def _rewrite_calls(sql, name, render):
+    """Replace every NAME(args) call with render(args), innermost calls included"""
+    pattern = re.compile(r'\b%s\s*\(' % name, re.IGNORECASE)
+    parts = []
+    pos = 0
+    while True:
+        match = pattern.search(sql, pos)
+        if not match:
+            break
+        args, end = _split_args(sql, match.end())
+        parts.append(sql[pos:match.start()])
+        parts.append(render([_rewrite_calls(arg, name, render) for arg in args]))
+        pos = end
+    parts.append(sql[pos:])
+    return ''.join(parts)
+
+
+def _split_args(sql, start):
+    """Split the argument list that starts right after "(" - returns (args, end)"""
+    args = []
+    depth = 1
+    quoted = False
+    current = start
+    i = start
+    while i < len(sql):
+        ch = sql[i]
+        if quoted:
+            if ch == "'":
+                quoted = False
+        elif ch == "'":
+            quoted = True
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+            if depth == 0:
+                args.append(sql[current:i].strip())
+                return args, i + 1
+        elif ch == ',' and depth == 1:
+            args.append(sql[current:i].strip())
+            current = i + 1
+        i += 1
+    raise ValueError(f'Unbalanced parentheses in SQL: {sql!r}')
+
+
+def _convert_placeholders(sql, has_params):
+    """? -> %s outside string literals; literal % doubled when params are bound"""
+    if not has_params:
+        return sql
+    out = []
+    quoted = False
+    for ch in sql:
+        if ch == "'":
+            quoted = not quoted
+            out.append(ch)
+        elif ch == '%':
+            out.append('%%')
+        elif ch == '?' and not quoted:
+            out.append('%s')
+        else:
+            out.append(ch)
+    return ''.join(out)
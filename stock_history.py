@@ -0,0 +1,272 @@
+"""
+Stock History Module
+Point-in-time inventory reconstructed from stock_logs
+
+Every stock change - Excel imports included - is logged with
+change_amount = new_value - old_value.
+The stock of a variant at the end of day D is therefore its current stock
+minus the sum of the changes logged after D. StockHistory keeps the log
+deltas in NumPy arrays sorted by time, so a reconstruction is one
+searchsorted for the cut-off plus one bincount over the later deltas,
+whatever the date.
+
+daily_totals() answers many dates at once - the snapshot backfill - with
+prefix sums over the same arrays instead of one reconstruction per date.
+
+The arrays are loaded once and extended with new log rows on each query.
+Ids are not committed in order on PostgreSQL, so every sync re-reads the
+last STOCK_HISTORY_SYNC_WINDOW ids below the loaded MAX(id) and skips the
+ids it already has; when the loaded rows still do not add up to COUNT(*)
+(a row committed even later, logs deleted) or MIN(id) changed - logs
+archived - the arrays are reloaded in full, which also reads the rows moved
+to the log archive so dates before the archive cut-off still reconstruct.
+"""
+
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+
+STOCK_HISTORY_SYNC_WINDOW = int(os.environ.get('STOCK_HISTORY_SYNC_WINDOW', 1000))
+
+_LOG_FILTER = 'variant_id IS NOT NULL AND change_amount IS NOT NULL AND change_amount <> 0'
+
+
+class StockHistory:
+    """Cached (variant_id, created_date, change_amount) arrays of stock_logs"""
+
+    def __init__(self, archive=None, window=STOCK_HISTORY_SYNC_WINDOW):
+        # archive: LogArchive whose rows count as logs too (see log_archive)
+        self._archive = archive
+        self.window = window
+        self._lock = threading.Lock()
+        self._ids = np.empty(0, dtype=np.int64)
+        self._variant_ids = np.empty(0, dtype=np.int64)
+        self._times = np.empty(0, dtype='datetime64[us]')
+        self._changes = np.empty(0, dtype=np.int64)
+        self._min_id = None
+        self._max_id = None
+        self._log_count = None   # stock_logs rows loaded (archived rows not included)
+
+    def _fetch(self, cursor, after_id=None):
+        """(ids, variant_ids, times, changes) of the rows with id > after_id - all of them plus the archive when None"""
+        query = f'SELECT id, variant_id, created_date, change_amount FROM stock_logs WHERE {_LOG_FILTER}'
+        params = ()
+        if after_id is not None:
+            query += ' AND id > ?'
+            params = (after_id,)
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        if after_id is None and self._archive is not None:
+            rows = list(rows) + [(row[0], row[3], row[16], row[11]) for row in self._archive.iter_rows()
+                                 if row[3] is not None and row[11]]
+        if not rows:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                    np.empty(0, dtype='datetime64[us]'), np.empty(0, dtype=np.int64))
+        ids, variant_ids, times, changes = zip(*rows)
+        return (np.array(ids, dtype=np.int64),
+                np.array(variant_ids, dtype=np.int64),
+                np.array(times, dtype='datetime64[us]'),
+                np.array(changes, dtype=np.int64))
+
+    def sync(self, cursor):
+        """Bring the arrays up to date with stock_logs"""
+        cursor.execute(f'SELECT MIN(id), MAX(id), COUNT(*) FROM stock_logs WHERE {_LOG_FILTER}')
+        min_id, max_id, log_count = cursor.fetchone()
+
+        with self._lock:
+            if (min_id, max_id, log_count) == (self._min_id, self._max_id, self._log_count):
+                return
+
+            loaded = (self._ids, self._variant_ids, self._times, self._changes)
+            parts = None
+            if (self._max_id is not None and min_id == self._min_id
+                    and max_id is not None and max_id >= self._max_id):
+                # ids that committed after a higher one fall inside the trailing window
+                window_start = self._max_id - self.window
+                fetched = self._fetch(cursor, window_start)
+                new = ~np.isin(fetched[0], self._ids[self._ids > window_start])
+                if self._log_count + int(new.sum()) == log_count:
+                    parts = tuple(np.concatenate((old, part[new])) for old, part in zip(loaded, fetched))
+            if parts is None:
+                parts = self._fetch(cursor)
+
+            # imported logs can be older than the newest rows - keep the arrays time ordered
+            order = np.argsort(parts[2], kind='stable')
+            self._ids, self._variant_ids, self._times, self._changes = (part[order] for part in parts)
+            self._min_id, self._max_id, self._log_count = min_id, max_id, log_count
+
+    def changes_after(self, variant_ids, cutoff):
+        """
+        Sum of the changes logged at or after cutoff, per entry of variant_ids
+
+        variant_ids must be sorted ascending; logs of unknown variants are ignored.
+        """
+        with self._lock:
+            start = np.searchsorted(self._times, np.datetime64(cutoff, 'us'), side='left')
+            log_variants = self._variant_ids[start:]
+            log_changes = self._changes[start:]
+
+        if len(variant_ids) == 0 or len(log_variants) == 0:
+            return np.zeros(len(variant_ids), dtype=np.int64)
+
+        positions = np.searchsorted(variant_ids, log_variants)
+        positions = np.minimum(positions, len(variant_ids) - 1)
+        known = variant_ids[positions] == log_variants
+        return np.bincount(positions[known], weights=log_changes[known],
+                           minlength=len(variant_ids)).astype(np.int64)
+
+    def arrays(self):
+        """(variant_ids, times, changes) as currently loaded, ordered by time"""
+        with self._lock:
+            return self._variant_ids, self._times, self._changes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'log_rows': int(len(self._changes)),
+                'min_id': self._min_id,
+                'max_id': self._max_id,
+                'log_count': self._log_count,
+            }
+
+
+def end_of_day(as_of):
+    """Cut-off datetime for "stock at the end of day as_of" (date or YYYY-MM-DD)"""
+    if isinstance(as_of, str):
+        as_of = datetime.strptime(as_of[:10], '%Y-%m-%d').date()
+    elif isinstance(as_of, datetime):
+        as_of = as_of.date()
+    if not isinstance(as_of, date):
+        raise ValueError(f'Invalid date: {as_of!r}')
+    return datetime.combine(as_of + timedelta(days=1), datetime.min.time())
+
+
+def inventory_as_of(history, cursor, as_of):
+    """
+    Reconstructed inventory at the end of day as_of
+
+    Returns {'date', 'variants', 'brands', 'total_stock', 'total_value'}:
+    variants are (variant_id, product_code, brand_name, type_name, color_name,
+    wholesale_price, stock, value) ordered by brand / code / color, brands are
+    (brand_name, stock, value) ordered by stock. Values use today's wholesale
+    prices - price history is not logged. Variants created after the date
+    are left out.
+    """
+    cutoff = end_of_day(as_of)
+    history.sync(cursor)
+
+    cursor.execute('''
+        SELECT pv.id, bp.product_code, b.brand_name, pt.type_name, c.color_name,
+               COALESCE(bp.wholesale_price, 0), pv.current_stock, pv.created_date
+        FROM product_variants pv
+        JOIN base_products bp ON pv.base_product_id = bp.id
+        LEFT JOIN brands b ON bp.brand_id = b.id
+        LEFT JOIN product_types pt ON bp.product_type_id = pt.id
+        LEFT JOIN colors c ON pv.color_id = c.id
+        ORDER BY pv.id
+    ''')
+    rows = cursor.fetchall()
+
+    variant_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    current = np.array([row[6] or 0 for row in rows], dtype=np.int64)
+    prices = np.array([row[5] for row in rows], dtype=np.float64)
+    created = np.array([row[7] or '1970-01-01' for row in rows], dtype='datetime64[us]')
+
+    stock = current - history.changes_after(variant_ids, cutoff)
+    existed = created < np.datetime64(cutoff, 'us')
+    stock = np.where(existed, stock, 0)
+    values = stock * prices
+
+    brand_names = np.array([row[2] or '' for row in rows], dtype=object)
+    brand_labels, brand_index = np.unique(brand_names[existed], return_inverse=True)
+    brand_stock = np.bincount(brand_index, weights=stock[existed], minlength=len(brand_labels))
+    brand_value = np.bincount(brand_index, weights=values[existed], minlength=len(brand_labels))
+    brands = sorted(
+        ((str(name), int(brand_stock[i]), round(float(brand_value[i]), 2))
+         for i, name in enumerate(brand_labels)),
+        key=lambda brand: (-brand[1], brand[0])
+    )
+
+    variants = [
+        (row[0], row[1], row[2], row[3], row[4], row[5], int(stock[i]), round(float(values[i]), 2))
+        for i, row in enumerate(rows) if existed[i]
+    ]
+    variants.sort(key=lambda variant: (variant[2] or '', variant[1] or '', variant[4] or ''))
+
+    return {
+        'date': (cutoff - timedelta(days=1)).date().isoformat(),
+        'variants': variants,
+        'brands': brands,
+        'total_stock': int(stock.sum()),
+        'total_value': round(float(values.sum()), 2),
+    }
+
+
+def _sums_from(keys, weights, cutoffs):
+    """Sum of weights whose key is >= each cutoff - keys must be sorted"""
+    prefix = np.concatenate(([0], np.cumsum(weights)))
+    return prefix[-1] - prefix[np.searchsorted(keys, cutoffs, side='left')]
+
+
+def daily_totals(history, cursor, cutoffs):
+    """
+    Total stock and stock value at each cutoff datetime, in one pass over the logs
+
+    A variant counts at cutoff T when it was created before T, with its
+    current stock minus the changes logged at or after T. Summed over the
+    catalog that is
+
+        sum(current of variants created before T)
+        - sum(changes logged at or after T)
+        + sum(changes of variants created at or after T, logged at or after their creation)
+
+    and every term is a prefix sum over a sorted array, so all cutoffs are
+    answered with searchsorted. Returns (quantities, values) arrays aligned
+    with cutoffs; values use today's wholesale prices like inventory_as_of().
+    """
+    history.sync(cursor)
+    cursor.execute('''
+        SELECT pv.id, pv.current_stock, COALESCE(bp.wholesale_price, 0), pv.created_date
+        FROM product_variants pv
+        JOIN base_products bp ON pv.base_product_id = bp.id
+        ORDER BY pv.id
+    ''')
+    rows = cursor.fetchall()
+    cutoffs = np.array([np.datetime64(cutoff, 'us') for cutoff in cutoffs], dtype='datetime64[us]')
+    if not rows:
+        return np.zeros(len(cutoffs), dtype=np.int64), np.zeros(len(cutoffs), dtype=np.float64)
+
+    variant_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    current = np.array([row[1] or 0 for row in rows], dtype=np.int64)
+    prices = np.array([row[2] for row in rows], dtype=np.float64)
+    created = np.array([row[3] or '1970-01-01' for row in rows], dtype='datetime64[us]')
+
+    # variants that already existed at each cutoff, with their current stock
+    current_values = current * prices
+    by_created = np.argsort(created, kind='stable')
+    quantities = current.sum() - _sums_from(created[by_created], current[by_created], cutoffs)
+    values = current_values.sum() - _sums_from(created[by_created], current_values[by_created], cutoffs)
+
+    log_variants, log_times, log_changes = history.arrays()
+    if len(log_variants):
+        positions = np.minimum(np.searchsorted(variant_ids, log_variants), len(variant_ids) - 1)
+        known = variant_ids[positions] == log_variants
+        positions = positions[known]
+        log_times = log_times[known]
+        log_changes = log_changes[known]
+        log_values = log_changes * prices[positions]
+
+        # logs after the cutoff are undone ...
+        quantities = quantities - _sums_from(log_times, log_changes, cutoffs)
+        values = values - _sums_from(log_times, log_values, cutoffs)
+
+        # ... except for variants that did not exist yet (already left out above)
+        born = np.minimum(created[positions], log_times)
+        by_born = np.argsort(born, kind='stable')
+        quantities = quantities + _sums_from(born[by_born], log_changes[by_born], cutoffs)
+        values = values + _sums_from(born[by_born], log_values[by_born], cutoffs)
+
+    return quantities.astype(np.int64), np.round(values, 2)
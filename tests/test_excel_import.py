@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+from database import StockDatabase
+
+
+def import_row(code, stock=5, color='Red'):
+    return {'Product Code': code, 'Brand Name': 'Nike', 'Product Type': 'Shirt', 'Color Name': color,
+            'Category': 'Men', 'Size': 'L', 'Wholesale Price': 10, 'Retail Price': 20, 'Stock': stock}
+
+
+class ImportRowErrorsTest(unittest.TestCase):
+    """A bad row fails on its own - the other rows of its chunk are still imported"""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db = StockDatabase(os.path.join(self._tmp.name, 'stock_management.db'))
+        self.db.add_default_data()
+
+    def tearDown(self):
+        self.db.pool.close_all()
+        self._tmp.cleanup()
+
+    def imported_codes(self):
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT product_code FROM base_products ORDER BY product_code')
+        codes = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return codes
+
+    def test_out_of_range_stock(self):
+        rows = [import_row(f'R{i}') for i in range(5)]
+        rows[2]['Stock'] = '99999999999999999999999'
+        result = self.db.bulk_add_products_from_excel_enhanced([list(enumerate(rows, 2))])
+        self.assertEqual(result['success_count'], 4)
+        self.assertEqual([item['row'] for item in result['failed_products']], [4])
+        self.assertEqual(self.imported_codes(), ['R0', 'R1', 'R3', 'R4'])
+
+    def test_database_error_fails_only_its_row(self):
+        conn = self.db.get_connection()
+        conn.cursor().execute('''
+            CREATE TRIGGER reject_bad_code BEFORE INSERT ON base_products
+            WHEN NEW.product_code = 'BAD'
+            BEGIN SELECT RAISE(ABORT, 'bad product code'); END
+        ''')
+        conn.commit()
+        conn.close()
+
+        rows = [import_row('R0'), import_row('R1'), import_row('BAD'), import_row('R3'), import_row('R0', 7, 'Blue')]
+        result = self.db.bulk_add_products_from_excel_enhanced([list(enumerate(rows, 2))])
+        self.assertEqual(result['success_count'], 4)
+        self.assertEqual([(item['row'], item['product_code']) for item in result['failed_products']], [(4, 'BAD')])
+        self.assertIn('bad product code', result['failed_products'][0]['error'])
+        self.assertEqual(self.imported_codes(), ['R0', 'R1', 'R3'])
+
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*), SUM(pv.current_stock) FROM product_variants pv
+            JOIN base_products bp ON bp.id = pv.base_product_id
+            WHERE bp.product_code = 'R0'
+        ''')
+        self.assertEqual(cursor.fetchone(), (2, 12))
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
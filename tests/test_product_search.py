@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+
+from database import StockDatabase
+
+
+class ProductSearchTest(unittest.TestCase):
+    """Product code lookups match anywhere in the code, not only at the start of a word"""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db = StockDatabase(os.path.join(self._tmp.name, 'stock_management.db'))
+        self.db.add_default_data()
+        brand = self.db.get_all_brands()[0][0]
+        product_type = self.db.get_all_product_types()[0][0]
+        color = self.db.get_all_colors()[0][0]
+        for code in ('AB123', '123X', 'ZZ999'):
+            self.db.add_base_product_with_variants(code, brand, product_type, 'L', 'M', 10, 20, [color], [])
+
+    def tearDown(self):
+        self.db.pool.close_all()
+        self._tmp.cleanup()
+
+    def codes(self, search_term):
+        return sorted(product[1] for product in self.db.search_products(search_term))
+
+    def test_code_substring(self):
+        self.assertEqual(self.codes('123'), ['123X', 'AB123'])
+        self.assertEqual(self.codes('b12'), ['AB123'])
+
+    def test_code_substring_in_listing_pages(self):
+        products, _ = self.db.get_products_page('123')
+        self.assertEqual(sorted(product[1] for product in products), ['123X', 'AB123'])
+
+
+if __name__ == '__main__':
+    unittest.main()
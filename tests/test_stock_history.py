@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from database import StockDatabase
+
+
+def import_rows(db, stock):
+    row = {'Product Code': 'HX100', 'Brand Name': 'Nike', 'Product Type': 'Shirt', 'Color Name': 'Red',
+           'Category': 'Men', 'Size': 'L', 'Wholesale Price': 10, 'Retail Price': 20, 'Stock': stock}
+    return db.bulk_add_products_from_excel_enhanced([[(2, row)]])
+
+
+class ImportStockHistoryTest(unittest.TestCase):
+    """Stock changes made by an Excel import are logged, so earlier dates reconstruct the same"""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db = StockDatabase(os.path.join(self._tmp.name, 'stock_management.db'))
+        self.db.add_default_data()
+
+    def tearDown(self):
+        self.db.pool.close_all()
+        self._tmp.cleanup()
+
+    def backdate(self, created_date):
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE product_variants SET created_date = ?', (created_date,))
+        cursor.execute('UPDATE stock_logs SET created_date = ?', (created_date,))
+        conn.commit()
+        conn.close()
+
+    def test_reimport_keeps_earlier_dates(self):
+        self.assertTrue(import_rows(self.db, 5)['success'])
+        self.backdate('2026-05-01 10:00:00')
+        self.assertEqual(self.db.get_inventory_as_of('2026-06-01')['total_stock'], 5)
+
+        self.assertTrue(import_rows(self.db, 50)['success'])
+        self.assertEqual(self.db.get_inventory_as_of('2026-06-01')['total_stock'], 5)
+
+        conn = self.db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT old_value, new_value, change_amount FROM stock_logs ORDER BY id')
+        self.assertEqual(cursor.fetchall(), [(0, 5, 5), (5, 50, 45)])
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()